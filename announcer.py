@@ -0,0 +1,254 @@
+"""
+@author Thomas Churchman
+
+Module that implements the announcer, which announces the torrents of this
+host (e.g., those of torrent clients using the local API) to the DHT.
+
+Every torrent is re-announced every interval seconds, with random jitter so
+torrents added at once do not stay bunched up. An announce is a get_peers
+lookup to find the K nodes closest to the info-hash and collect their
+tokens, followed by an announce_peer query to each of those nodes.
+
+To send fewer packets, lookup results are shared between torrents close
+to each other. The ID space is divided into neighborhoods that hold about
+K nodes each; their size is estimated from the distance to the K-th
+closest node in completed lookups. The closest nodes found for one torrent
+seed the lookups of the other torrents in its neighborhood, which then
+only query the nodes around them. A torrent that becomes due while a
+lookup in its neighborhood is running waits for that lookup.
+
+The announcer starts new queries only while the number of queries in
+flight on the node (the outstanding queries of the KRPC handler, including
+those of lookups and the crawler) is under a cap.
+"""
+
+import time
+import heapq
+import random
+import statistics
+import collections
+
+import krpc.krpccoder
+from dht.lookup import Lookup
+from hash.hash import Hash
+
+# Interval between rounds of the announcer, in seconds
+TICK = 0.5
+
+# Delay before retrying a torrent whose lookup collected no tokens, in seconds
+RETRY_INTERVAL = 60
+
+# Number of recent lookups the neighborhood size is estimated from
+NEIGHBORHOOD_SAMPLES = 32
+
+class Announcer:
+    """
+    Class to represent the announcer of the node with the given context.
+
+    Torrents are added with add; once started, the announcer announces
+    them through the given (IPv4) KRPC handler.
+    """
+    def __init__(self, context, interval=1500, jitter=0.1, maxQueriesInFlight=256, neighborhoodTTL=300):
+        self.context = context
+        self.interval = interval
+        self.jitter = jitter
+        self.maxQueriesInFlight = maxQueriesInFlight
+        self.neighborhoodTTL = neighborhoodTTL
+        self.random = random.Random()
+
+        # {hash bytes: Peer}
+        self.torrents = {}
+
+        # {hash bytes: time the torrent is due, or None while it is being announced}
+        self._dueAt = {}
+
+        # Heap of (time, hash bytes); entries that do not match _dueAt are stale
+        self._schedule = []
+
+        # Torrents that are due: (hash bytes, whether it may wait for a lookup in its neighborhood)
+        self._due = collections.deque()
+
+        # announce_peer queries waiting to be sent: (hash bytes, Node, token)
+        self._announces = collections.deque()
+
+        # Bit lengths of the distance to the K-th closest node of recent lookups
+        self._radii = collections.deque(maxlen=NEIGHBORHOOD_SAMPLES)
+
+        # {(shift, prefix): (expiry time, closest nodes)}
+        self._neighborhoods = {}
+
+        # {(shift, prefix): [hash bytes]} of neighborhoods with a lookup
+        # running, and the torrents waiting for it
+        self._running = {}
+
+        # Packets sent and torrents announced
+        self.queries = 0
+        self.announces = 0
+        self.announced = 0
+
+        self.protocol = None
+        self.callLater = None
+        self.seconds = time.time
+        self._tickCall = None
+        self._nextPurge = 0
+
+    def start(self, protocol, callLater, seconds=time.time):
+        """
+        Start announcing through the given (IPv4) KRPC handler. seconds is
+        the clock the schedule runs on.
+        """
+        self.protocol = protocol
+        self.callLater = callLater
+        self.seconds = seconds
+        self.__tick()
+
+    def stop(self):
+        if self._tickCall is not None:
+            self._tickCall.cancel()
+            self._tickCall = None
+
+    def add(self, hash, peer):
+        """
+        Announce the given peer for the torrent with the given info-hash.
+        The first announce of a new torrent is spread over the jitter of the
+        interval.
+        """
+        key = bytes(hash)
+        isNew = key not in self.torrents
+        self.torrents[key] = peer
+        if isNew:
+            self.__schedule(key, self.random.uniform(0, self.jitter * self.interval))
+
+    def remove(self, hash):
+        """
+        Stop announcing the torrent with the given info-hash.
+        """
+        key = bytes(hash)
+        self.torrents.pop(key, None)
+        self._dueAt.pop(key, None)
+
+    def packetsPerAnnounce(self):
+        """
+        Get the mean number of queries sent per torrent announced.
+        """
+        if self.announced == 0:
+            return None
+        return (self.queries + self.announces) / self.announced
+
+    def queriesInFlight(self):
+        return len(self.context.outstandingQueries)
+
+    def __schedule(self, key, delay):
+        due = self.seconds() + delay
+        self._dueAt[key] = due
+        heapq.heappush(self._schedule, (due, key))
+
+    def __nextInterval(self):
+        return self.interval * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def __neighborhood(self, key):
+        """
+        Get the neighborhood of the given target, or None if its size has
+        not been estimated yet.
+        """
+        if not self._radii:
+            return None
+        shift = int(statistics.median(self._radii))
+        return (shift, int.from_bytes(key, byteorder='big') >> shift)
+
+    def __tick(self):
+        """
+        Move the torrents that are due to the queue, and start announcing.
+        """
+        now = self.seconds()
+        while self._schedule and self._schedule[0][0] <= now:
+            (due, key) = heapq.heappop(self._schedule)
+            if self._dueAt.get(key) == due:
+                self._dueAt[key] = None
+                self._due.append((key, True))
+
+        if now >= self._nextPurge:
+            self._neighborhoods = dict((neighborhood, entry) for (neighborhood, entry) in self._neighborhoods.items() if entry[0] > now)
+            self._nextPurge = now + self.neighborhoodTTL
+
+        self.__pump()
+        self._tickCall = self.callLater(TICK, self.__tick)
+
+    def __pump(self):
+        """
+        Send waiting announces and start lookups for due torrents, as long
+        as the cap on queries in flight allows.
+        """
+        while self._announces and self.queriesInFlight() < self.maxQueriesInFlight:
+            (key, node, token) = self._announces.popleft()
+            peer = self.torrents.get(key)
+            if peer is None:
+                continue
+            query = krpc.krpccoder.KRPCQuery(toNode=node, type=b'announce_peer', targetID=Hash(key), token=token, peer=peer)
+            self.announces += 1
+            waiter = self.protocol.sendQuery(query)
+            self.protocol.whenAnswered(waiter, self.__answered, self.__failed)
+
+        # A lookup keeps up to alpha queries in flight
+        while self._due and self.queriesInFlight() + 3 <= self.maxQueriesInFlight:
+            (key, mayWait) = self._due.popleft()
+            if key not in self.torrents:
+                continue
+            self.__lookup(key, mayWait)
+
+    def __lookup(self, key, mayWait):
+        now = self.seconds()
+        target = Hash(key)
+        neighborhood = self.__neighborhood(key)
+        nodes = self.context.routingTable.findClosestNodes(target)
+        if neighborhood is not None:
+            entry = self._neighborhoods.get(neighborhood)
+            if entry is not None and entry[0] > now:
+                nodes = entry[1] + nodes
+            elif mayWait and neighborhood in self._running:
+                self._running[neighborhood].append(key)
+                return
+            elif mayWait:
+                self._running[neighborhood] = []
+            else:
+                neighborhood = None
+
+        lookup = Lookup(self.protocol, target, b'get_peers')
+        lookup.start(nodes, lambda lookup: self.__lookupDone(lookup, key, neighborhood))
+
+    def __lookupDone(self, lookup, key, neighborhood):
+        self.queries += lookup.queries
+        closest = lookup.closestNodes()
+
+        if len(closest) >= lookup.k:
+            self._radii.append((int(closest[-1].hash) ^ int(lookup.target)).bit_length())
+
+        # Release the torrents waiting for this lookup; if it found no
+        # nodes, they look up their targets without waiting
+        waiting = self._running.pop(neighborhood, None) if neighborhood is not None else None
+        if closest and neighborhood is not None:
+            self._neighborhoods[neighborhood] = (self.seconds() + self.neighborhoodTTL, closest)
+        if waiting:
+            self._due.extendleft((waitingKey, False) for waitingKey in reversed(waiting))
+
+        announced = False
+        for node in closest:
+            token = lookup.tokens.get(bytes(node.hash))
+            if token is not None:
+                self._announces.append((key, node, token[1]))
+                announced = True
+
+        if key in self.torrents:
+            if announced:
+                self.announced += 1
+                self.__schedule(key, self.__nextInterval())
+            else:
+                self.__schedule(key, RETRY_INTERVAL)
+
+        self.__pump()
+
+    def __answered(self, response):
+        pass
+
+    def __failed(self, exception):
+        pass
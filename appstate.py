@@ -2,46 +2,52 @@
 @author Thomas Churchman
 
 Module that provides the application state functionality.
+
+The state of the node lives in a NodeContext (see nodecontext.py), which is
+passed to the KRPC handler explicitly. AppState remains as a shim for the
+main script: its attributes are those of the node context built by prepare().
+The config is loaded separately by loadConfig(), so that a supervisor (see
+supervisor.py) does not build the state of a node it does not serve.
 """
 
-from hashlib import sha1
+from nodecontext import NodeContext
 
-import config
-import utils
-from dht.routing import RoutingTable
-from dht.node import Node
-import dht.peerstorage
-from hash.hash import Hash
+class _AppStateType(type):
+    """
+    Forwards attribute access on AppState to AppState.context.
+    """
+    def __getattr__(cls, name):
+        if cls.context is None:
+            raise AttributeError("AppState has not been prepared; '%s' is not available" % name)
+        return getattr(cls.context, name)
 
-class AppState:
+    def __setattr__(cls, name, value):
+        if name in ('context', 'config'):
+            type.__setattr__(cls, name, value)
+        else:
+            setattr(cls.context, name, value)
+
+class AppState(metaclass=_AppStateType):
     """
     Class to hold the global application state.
     """
+    # The config module of this process, loaded by loadConfig()
+    config = None
+
+    # The node context of this process, built by prepare()
+    context = None
+
+    def loadConfig():
+        """
+        Load the config.
+        """
+        import config
+        AppState.config = config
+        return config
+
     def prepare():
         """
-        Prepare the application state.
+        Prepare the application state from the config.
         """
-        thisNodeIP = config.NODE_IP
-        thisNodePort = config.NODE_PORT
-        thisNodeHash = Hash(sha1(config.NODE_ID_NAME).digest())
-        AppState.thisNode = Node(thisNodeHash, (thisNodeIP, thisNodePort))
-    
-        AppState.heartbeat = config.HEARTBEAT
-
-        AppState.tokenSecret = utils.randomBits(160)
-    
-        AppState.maxPeersPerTorrent = config.MAX_PEERS_PER_TORRENT
-    
-        AppState.k = config.K
-        AppState.maxNodesPerPucket = config.MAX_NODES_PER_BUCKET
-    
-        AppState.routingTable = RoutingTable()
-    
-        if config.PEER_STORAGE == 'file':
-            AppState.peerStorage = dht.peerstorage.FilePeerStorage(config.PEER_STORAGE_DIR)
-        elif config.PEER_STORAGE == 'mysql':
-            AppState.peerStorage = dht.peerstorage.MySQLPeerStorage()
-    
-        # {transactionID: {(RPCQuery, Node, timestamp)}}
-        AppState.outstandingQueries = {}
-    
+        AppState.context = NodeContext.fromConfig(AppState.config)
+        return AppState.context
@@ -0,0 +1,567 @@
+"""
+@author Thomas Churchman
+
+Micro-benchmark suite for the node's hot paths:
+- encoding and decoding of each KRPC message type;
+- adding nodes to and finding the closest nodes in a routing table that
+  has been offered 1k, 10k and 100k nodes;
+- announcing to and getting peers from the file peer storage at various
+  swarm sizes;
+- decoding queries with and without interning of the IDs they carry (see
+  hash/hash.py);
+- bloom filter insertion and estimation; and
+- KRPC.datagramReceived throughput for datagrams received over a loopback
+  socket (without an event loop, so only the packet handling is measured).
+
+Each benchmark is calibrated to run for at least 0.2 seconds and repeated a
+number of times; the median, minimum and standard deviation of the time per
+operation are reported. Results are written as JSON, so runs on different
+commits can be compared.
+
+The config.py found in the current directory is used.
+
+Usage:
+    python benchmarks/benchsuite.py run [output.json] [nameFilter]
+    python benchmarks/benchsuite.py compare base.json head.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import shutil
+import timeit
+import weakref
+import platform
+import tempfile
+import statistics
+import subprocess
+import collections
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[0:0] = [os.getcwd(), ROOT]
+
+import config
+import bloom
+import utils
+import krpc.krpccoder
+from nodecontext import NodeContext
+from krpc.krpc import KRPC
+from dht.node import Node
+from dht.peer import Peer
+from dht.routing import RoutingTable
+import dht.nodepool
+import dht.secureid
+import dht.nodecache
+import dht.peerstorage
+from hash.hash import Hash
+
+REPEAT = 5
+
+# [(name, setup)], where setup() returns (f, ops): f() performs ops operations.
+# It may return (f, ops, metrics) to report other metrics ({name: value}) as well
+BENCHMARKS = []
+
+def benchmark(name):
+    """
+    Register a benchmark setup function under the given name.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+_random = random.Random(0)
+
+def randomHash():
+    return Hash(_random.getrandbits(160).to_bytes(20, byteorder='big'))
+
+def randomNode():
+    address = '10.%d.%d.%d' % (_random.randrange(256), _random.randrange(256), _random.randrange(256))
+    return Node(randomHash(), (address, _random.randrange(1024, 65536)))
+
+# The node context the benchmarked code runs in, built by prepareContext()
+context = None
+
+def prepareContext():
+    """
+    Build the node context the benchmarked code runs in, without
+    creating sockets, storage directories or worker threads.
+    """
+    global context
+    context = NodeContext(
+        Node(randomHash(), ('127.0.0.1', config.NODE_PORT)),
+        k=config.K,
+        maxNodesPerBucket=config.MAX_NODES_PER_BUCKET,
+        maxFailedQueries=config.MAX_FAILED_QUERIES,
+        maxPeersPerTorrent=config.MAX_PEERS_PER_TORRENT,
+        queryTimeout=config.QUERY_TIMEOUT,
+        minQueryTimeout=config.MIN_QUERY_TIMEOUT,
+        nodeCacheSize=config.NODE_CACHE_SIZE)
+
+def newRoutingTable():
+    return RoutingTable(context.thisNode, None, config.K, config.MAX_NODES_PER_BUCKET, config.MAX_FAILED_QUERIES)
+
+def fillRoutingTable(routingTable, numNodes):
+    for i in range(numNodes):
+        routingTable.addNode(randomNode())
+
+# Codec
+
+def _query(type):
+    remote = randomNode()
+    query = krpc.krpccoder.KRPCQuery(transactionID=b'aa', fromNode=remote, toNode=context.thisNode, type=type)
+    if type != b'ping':
+        query.targetID = randomHash()
+    if type == b'announce_peer':
+        query.peer = Peer(remote.host)
+        query.token = utils.getToken(remote, context.tokenSecrets.current())
+    return query
+
+def _response(type, withPeers=False):
+    """
+    Create a response from a remote node to an outstanding query of ours.
+    """
+    remote = randomNode()
+    query = krpc.krpccoder.KRPCQuery(transactionID=b'aa', fromNode=context.thisNode, toNode=remote, type=type, targetID=randomHash())
+    context.outstandingQueries[b'aa'] = (query, remote, time.time())
+
+    response = krpc.krpccoder.KRPCResponse(transactionID=b'aa', fromNode=remote, toNode=context.thisNode, responseTo=query, type=type)
+    if type in (b'find_node', b'get_peers'):
+        response.nodes = [randomNode() for i in range(context.k)]
+    if type == b'get_peers':
+        response.token = randomHash()
+        if withPeers:
+            response.nodes = None
+            response.peers = [Peer(randomNode().host) for i in range(50)]
+    return response
+
+def _encodedQuery(type):
+    query = _query(type)
+    return (krpc.krpccoder.encode(query), query.fromNode.host)
+
+for _type in [b'ping', b'find_node', b'get_peers', b'announce_peer']:
+    @benchmark('codec.decode.query.%s' % _type.decode())
+    def _setup(type=_type):
+        (data, addressPort) = _encodedQuery(type)
+        return (lambda: krpc.krpccoder.decode(data, addressPort, context), 1)
+
+for _type in [b'ping', b'find_node', b'get_peers', b'announce_peer']:
+    @benchmark('codec.encode.query.%s' % _type.decode())
+    def _setup(type=_type):
+        query = _query(type)
+        return (lambda: krpc.krpccoder.encode(query), 1)
+
+for (_name, _type, _withPeers) in [
+        ('ping', b'ping', False),
+        ('find_node', b'find_node', False),
+        ('get_peers.nodes', b'get_peers', False),
+        ('get_peers.values', b'get_peers', True),
+        ('announce_peer', b'announce_peer', False)]:
+    @benchmark('codec.decode.response.%s' % _name)
+    def _setup(type=_type, withPeers=_withPeers):
+        response = _response(type, withPeers)
+        data = krpc.krpccoder.encode(response)
+        return (lambda: krpc.krpccoder.decode(data, response.fromNode.host, context), 1)
+
+    @benchmark('codec.encode.response.%s' % _name)
+    def _setup(type=_type, withPeers=_withPeers):
+        response = _response(type, withPeers)
+        return (lambda: krpc.krpccoder.encode(response, context.responseBudget), 1)
+
+@benchmark('codec.encode.response.get_peers.values.truncated')
+def _setup():
+    # A large swarm, cut to the response budget
+    response = _response(b'get_peers', withPeers=True)
+    response.peers = [Peer(randomNode().host) for i in range(2000)]
+    return (lambda: krpc.krpccoder.encode(response, context.responseBudget), 1)
+
+@benchmark('codec.decode.error')
+def _setup():
+    response = _response(b'get_peers')
+    error = krpc.krpccoder.KRPCError(transactionID=b'aa', toNode=context.thisNode, errorCode=202, errorMessage=b'Server error')
+    data = krpc.krpccoder.encode(error)
+    return (lambda: krpc.krpccoder.decode(data, response.fromNode.host, context), 1)
+
+@benchmark('codec.encode.error')
+def _setup():
+    query = _query(b'get_peers')
+    error = krpc.krpccoder.KRPCError.fromQuery(query, errorCode=202, errorMessage=b'Server error')
+    return (lambda: krpc.krpccoder.encode(error), 1)
+
+# Routing table
+
+for _numNodes in [1000, 10000, 100000]:
+    @benchmark('routing.addNode.%dk' % (_numNodes // 1000))
+    def _setup(numNodes=_numNodes):
+        nodes = [randomNode() for i in range(numNodes)]
+        def f():
+            routingTable = newRoutingTable()
+            for node in nodes:
+                routingTable.addNode(node)
+        return (f, numNodes)
+
+    @benchmark('routing.findClosestNodes.%dk' % (_numNodes // 1000))
+    def _setup(numNodes=_numNodes):
+        routingTable = newRoutingTable()
+        fillRoutingTable(routingTable, numNodes)
+        targets = [randomHash() for i in range(100)]
+        def f():
+            for target in targets:
+                routingTable.findClosestNodes(target)
+        return (f, len(targets))
+
+# Node pools; the NumPy pool is only benchmarked if NumPy is installed
+
+_nodePools = [('python', False)]
+if dht.nodepool.isNumpyAvailable():
+    _nodePools.append(('numpy', True))
+
+for (_poolName, _useNumpy) in _nodePools:
+    for _numNodes in [10000, 100000, 500000]:
+        @benchmark('nodepool.%s.findClosestNodes.%dk' % (_poolName, _numNodes // 1000))
+        def _setup(numNodes=_numNodes, useNumpy=_useNumpy):
+            pool = dht.nodepool.createNodePool([randomNode() for i in range(numNodes)], useNumpy)
+            targets = [randomHash() for i in range(10)]
+            def f():
+                for target in targets:
+                    pool.findClosestNodes(target, config.K)
+            return (f, len(targets))
+
+# Peer storage
+
+_storageDirs = []
+
+def _fileStorage(swarmSize):
+    """
+    Create a file peer storage with one torrent of the given swarm size.
+    """
+    storageDir = tempfile.mkdtemp()
+    _storageDirs.append(storageDir)
+    storage = dht.peerstorage.FilePeerStorage(storageDir)
+    hash = randomHash()
+    peers = [Peer(randomNode().host) for i in range(swarmSize)]
+    storage.addPeers(hash, peers)
+    return (storage, hash, peers)
+
+for _swarmSize in [10, 100, 1000]:
+    @benchmark('storage.file.announce.%d' % _swarmSize)
+    def _setup(swarmSize=_swarmSize):
+        (storage, hash, peers) = _fileStorage(swarmSize)
+        # Peers re-announce periodically; most announces are for known peers
+        announces = [_random.choice(peers) for i in range(100)]
+        def f():
+            for peer in announces:
+                storage.addPeer(hash, peer)
+        return (f, len(announces))
+
+    @benchmark('storage.file.get.%d' % _swarmSize)
+    def _setup(swarmSize=_swarmSize):
+        (storage, hash, peers) = _fileStorage(swarmSize)
+        return (lambda: storage.getPeers(hash, socket.AF_INET), 1)
+
+# Hash interning
+
+class _InternedHash(Hash):
+    __slots__ = ('__weakref__',)
+
+def _interning(recentHashes=4096):
+    """
+    Create a function that interns Hashes: all users of an ID in use share
+    one object. The recentHashes most recently interned hashes are kept
+    alive, so popular IDs that nothing holds on to between packets stay
+    interned.
+    """
+    # {hash bytes: Hash}
+    interned = weakref.WeakValueDictionary()
+    recent = collections.deque(maxlen=recentHashes)
+    def intern(hash):
+        internedHash = interned.get(hash)
+        if internedHash is None:
+            internedHash = _InternedHash(hash)
+            interned[hash] = internedHash
+            recent.append(internedHash)
+        return internedHash
+    return intern
+
+def _getPeersQueries(numQueries, numTorrents=None, numSources=None):
+    """
+    Create get_peers queries, as (data, (address, port)) tuples, from
+    numSources repeat sources for numTorrents info-hashes whose popularity
+    follows Zipf's law (the torrent of rank r is queried with weight 1/r).
+    Without numTorrents (numSources), every query is for a new info-hash
+    (from a new source).
+    """
+    import bencodepy
+    if numTorrents is None:
+        infohashes = [bytes(randomHash()) for i in range(numQueries)]
+    else:
+        torrents = [bytes(randomHash()) for i in range(numTorrents)]
+        infohashes = _random.choices(torrents, [1 / rank for rank in range(1, numTorrents + 1)], k=numQueries)
+    if numSources is None:
+        sources = [randomNode() for i in range(numQueries)]
+    else:
+        sources = _random.choices([randomNode() for i in range(numSources)], k=numQueries)
+    return [(bencodepy.encode({'t': b'aa', 'y': 'q', 'q': 'get_peers', 'a': {'id': bytes(source.hash), 'info_hash': infohash}}), source.host)
+            for (infohash, source) in zip(infohashes, sources)]
+
+for (_traffic, _numTorrents, _numSources) in [('skewed', 1000, 200), ('unique', None, None)]:
+    for _intern in [True, False]:
+        @benchmark('codec.decode.%s.%s' % (_traffic, 'interned' if _intern else 'uninterned'))
+        def _setup(numTorrents=_numTorrents, numSources=_numSources, intern=_intern):
+            # Decoding a get_peers query and finding the torrent's file in
+            # the peer storage. Each run decodes the next of 50 batches, so
+            # the hashes kept alive by the interning are those of earlier
+            # traffic rather than of the same batch
+            storageDir = tempfile.mkdtemp()
+            _storageDirs.append(storageDir)
+            storage = dht.peerstorage.FilePeerStorage(storageDir)
+            queries = _getPeersQueries(50 * 2000, numTorrents, numSources)
+            batches = collections.deque(queries[i:i + 2000] for i in range(0, len(queries), 2000))
+            hashClass = _interning() if intern else Hash
+            def f():
+                batch = batches[0]
+                batches.rotate(-1)
+                krpc.krpccoder.Hash = hashClass
+                try:
+                    for (data, addressPort) in batch:
+                        query = krpc.krpccoder.decode(data, addressPort, context)
+                        storage._filePath(query.targetID)
+                finally:
+                    krpc.krpccoder.Hash = Hash
+            return (f, 2000)
+
+# Bloom filter
+
+@benchmark('bloom.insertIP')
+def _setup():
+    bloomFilter = bloom.BloomFilter()
+    ips = ['10.0.%d.%d' % (i // 256, i % 256) for i in range(1000)]
+    def f():
+        for ip in ips:
+            bloomFilter.insertIP(ip)
+    return (f, len(ips))
+
+@benchmark('bloom.estimate')
+def _setup():
+    bloomFilter = bloom.BloomFilter()
+    for i in range(1000):
+        bloomFilter.insertIP('10.0.%d.%d' % (i // 256, i % 256))
+    return (bloomFilter.estimate, 1)
+
+# Secure node IDs
+
+def _secureNodes(numNodes):
+    """
+    Create nodes with secure IDs at public IPv4 addresses.
+    """
+    nodes = []
+    for i in range(numNodes):
+        address = '8.%d.%d.%d' % (_random.randrange(256), _random.randrange(256), _random.randrange(256))
+        hash = dht.secureid.generateID(address, randomHash())
+        nodes.append(Node(hash, (address, _random.randrange(1024, 65536))))
+    return nodes
+
+@benchmark('secureid.verify.cached')
+def _setup():
+    verifier = dht.secureid.IDVerifier()
+    nodes = _secureNodes(1000)
+    for node in nodes:
+        verifier.isValid(node)
+    def f():
+        for node in nodes:
+            verifier.isValid(node)
+    return (f, len(nodes))
+
+@benchmark('secureid.verify.uncached')
+def _setup():
+    # A cache of size 0 calculates the checksum for every verification
+    verifier = dht.secureid.IDVerifier(0)
+    nodes = _secureNodes(1000)
+    def f():
+        for node in nodes:
+            verifier.isValid(node)
+    return (f, len(nodes))
+
+# Node cache
+
+@benchmark('nodecache.seen.repeat')
+def _setup():
+    # Sources that query again, as crawlers do
+    cache = dht.nodecache.NodeCache()
+    nodes = [randomNode() for i in range(1000)]
+    for node in nodes:
+        cache.seen(node.hash, node.host)
+    def f():
+        for node in nodes:
+            cache.seen(node.hash, node.host)
+    return (f, len(nodes))
+
+@benchmark('nodecache.seen.new')
+def _setup():
+    # Sources seen once, each evicting the least recently seen source
+    cache = dht.nodecache.NodeCache(1000)
+    nodes = [randomNode() for i in range(10000)]
+    def f():
+        for node in nodes:
+            cache.seen(node.hash, node.host)
+    return (f, len(nodes))
+
+# End-to-end packet handling
+
+class _SocketTransport:
+    """
+    Minimal datagram transport writing to a socket.
+    """
+    def __init__(self, sock):
+        self.socket = sock
+
+    def write(self, data, addressPort):
+        self.socket.sendto(data, addressPort)
+
+_sockets = []
+
+def _loopback(queries, batchSize=64):
+    """
+    Create a function that sends the given queries to a KRPC handler over a
+    loopback socket, in batches, and has the handler receive and answer them.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(('127.0.0.1', 0))
+    _sockets.extend([server, client])
+    serverAddress = server.getsockname()
+
+    protocol = KRPC(context)
+    protocol.transport = _SocketTransport(server)
+
+    batches = [queries[i:i + batchSize] for i in range(0, len(queries), batchSize)]
+    def f():
+        for batch in batches:
+            for query in batch:
+                client.sendto(query, serverAddress)
+            for query in batch:
+                (data, addressPort) = server.recvfrom(2048)
+                protocol.datagramReceived(data, addressPort)
+            for query in batch:
+                client.recvfrom(2048)
+    return (f, len(queries), client.getsockname())
+
+def _rawQuery(type, arguments):
+    import bencodepy
+    arguments = dict(arguments, id=bytes(randomHash()))
+    return bencodepy.encode({'t': b'aa', 'y': 'q', 'q': type, 'a': arguments})
+
+@benchmark('datagramReceived.ping')
+def _setup():
+    queries = [_rawQuery('ping', {}) for i in range(256)]
+    (f, ops, clientAddress) = _loopback(queries)
+    return (f, ops)
+
+@benchmark('datagramReceived.find_node')
+def _setup():
+    fillRoutingTable(context.routingTable, 10000)
+    queries = [_rawQuery('find_node', {'target': bytes(randomHash())}) for i in range(256)]
+    (f, ops, clientAddress) = _loopback(queries)
+    return (f, ops)
+
+@benchmark('datagramReceived.get_peers')
+def _setup():
+    fillRoutingTable(context.routingTable, 10000)
+    hash = randomHash()
+    context.peerStorage.addPeers(hash, [Peer(randomNode().host) for i in range(50)])
+    queries = [_rawQuery('get_peers', {'info_hash': bytes(hash)}) for i in range(128)]
+    queries += [_rawQuery('get_peers', {'info_hash': bytes(randomHash())}) for i in range(128)]
+    (f, ops, clientAddress) = _loopback(queries)
+    return (f, ops)
+
+def runBenchmark(setup):
+    """
+    Run a benchmark and return the time per operation of each repetition,
+    and the other metrics the benchmark reports.
+    """
+    prepareContext()
+    result = setup()
+    (f, ops) = result[:2]
+    timer = timeit.Timer(f)
+    (number, timeTaken) = timer.autorange()
+    times = timer.repeat(REPEAT, number)
+    return ([t / number / ops for t in times], result[2] if len(result) > 2 else {})
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def formatTime(seconds):
+    for (unit, scale) in [('s', 1), ('ms', 1e3), ('us', 1e6)]:
+        if seconds * scale >= 1:
+            return '%.2f %s' % (seconds * scale, unit)
+    return '%.0f ns' % (seconds * 1e9)
+
+def run(output, nameFilter):
+    results = {}
+    try:
+        for (name, setup) in BENCHMARKS:
+            if nameFilter and nameFilter not in name:
+                continue
+            (times, metrics) = runBenchmark(setup)
+            results[name] = {
+                'median': statistics.median(times),
+                'min': min(times),
+                'stdev': statistics.stdev(times),
+                'times': times,
+                'metrics': metrics
+            }
+            print("%-40s %12s +- %-12s %12.0f ops/s%s" % (
+                name, formatTime(results[name]['median']), formatTime(results[name]['stdev']), 1 / results[name]['median'],
+                ''.join('  %s %.2f' % item for item in sorted(metrics.items()))))
+    finally:
+        for storageDir in _storageDirs:
+            shutil.rmtree(storageDir, ignore_errors=True)
+        for sock in _sockets:
+            sock.close()
+
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': gitCommit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'benchmarks': results
+        }, f, indent=2, sort_keys=True)
+    print("Results written to %s" % output)
+
+def compare(basePath, headPath):
+    with open(basePath) as f:
+        base = json.load(f)
+    with open(headPath) as f:
+        head = json.load(f)
+
+    print("base: %s\nhead: %s\n" % (base['commit'], head['commit']))
+    print("%-40s %12s %12s %8s" % ('benchmark', 'base', 'head', 'change'))
+    for (name, result) in sorted(head['benchmarks'].items()):
+        if name not in base['benchmarks']:
+            print("%-40s %12s %12s" % (name, '-', formatTime(result['median'])))
+            continue
+        baseMedian = base['benchmarks'][name]['median']
+        change = (result['median'] - baseMedian) / baseMedian * 100
+        print("%-40s %12s %12s %+7.1f%%" % (name, formatTime(baseMedian), formatTime(result['median']), change))
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    if command == 'run':
+        output = sys.argv[2] if len(sys.argv) > 2 else 'bench.json'
+        nameFilter = sys.argv[3] if len(sys.argv) > 3 else None
+        run(output, nameFilter)
+    elif command == 'compare':
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        print(__doc__)
+
+if __name__ == '__main__':
+    main()
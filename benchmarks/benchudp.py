@@ -0,0 +1,182 @@
+"""
+@author Thomas Churchman
+
+Benchmark harness that compares node variants (event loops, transports).
+
+A node is started for each variant (a set of config overrides on top of the
+config.py found in the current directory). For each variant the harness
+reports:
+- start-up time: from spawning the process until it answers a ping;
+- memory: peak resident set size of the node process (Linux only); and
+- packets per second: the reply rate while a local load generator sends
+  ping queries from several source ports, keeping a fixed number of
+  queries in flight per port.
+
+Usage: python benchmarks/benchudp.py [duration] [sockets] [window]
+"""
+
+import os
+import sys
+import time
+import shutil
+import select
+import socket
+import tempfile
+import subprocess
+
+import bencodepy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VARIANTS = [
+    ('twisted', {'REACTOR': 'twisted', 'TRANSPORT': 'default'}),
+    ('mmsg', {'REACTOR': 'twisted', 'TRANSPORT': 'mmsg'}),
+    ('asyncio', {'REACTOR': 'asyncio'})
+]
+
+def startNode(overrides, port):
+    """
+    Start a node with the given config overrides and wait until it answers pings.
+    
+    Returns the node process, a directory that should be removed once the
+    node has stopped and the number of seconds the node took to start.
+    """
+    configDir = tempfile.mkdtemp()
+    with open(os.path.join(os.getcwd(), 'config.py')) as f:
+        config = f.read()
+    overrides = dict(overrides, NODE_PORT=port, WORKERS=1, PEER_STORAGE_DIR=configDir)
+    config += '\n' + '\n'.join('%s = %r' % item for item in overrides.items()) + '\n'
+    with open(os.path.join(configDir, 'config.py'), 'w') as f:
+        f.write(config)
+        
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([configDir, ROOT]))
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'otdht.py')], 
+        env=env, stdout=subprocess.DEVNULL)
+    
+    if not waitForNode(port):
+        process.kill()
+        raise Exception('Node did not start')
+    return (process, configDir, time.time() - start)
+    
+def stopNode(process, configDir):
+    process.terminate()
+    process.wait()
+    shutil.rmtree(configDir, ignore_errors=True)
+    
+def peakMemory(process):
+    """
+    Get the peak resident set size of the given process in kB,
+    or None if it cannot be determined.
+    """
+    try:
+        with open('/proc/%d/status' % process.pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+    
+def pingQuery(transactionID):
+    return bencodepy.encode({
+        't': transactionID,
+        'y': 'q',
+        'q': 'ping',
+        'a': {'id': b'\x00' * 20}
+    })
+    
+def waitForNode(port, timeout=10.0):
+    """
+    Ping the node until it answers or the timeout expires.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.1)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            sock.sendto(pingQuery(b'w'), ('127.0.0.1', port))
+            try:
+                sock.recvfrom(2048)
+                return True
+            except socket.timeout:
+                pass
+    finally:
+        sock.close()
+    return False
+
+def generateLoad(port, duration=5.0, numSockets=8, window=32):
+    """
+    Send pings to the node on the given port for the given duration.
+    
+    Each source socket keeps up to window queries in flight; a query that
+    is not answered within a second is considered lost.
+    
+    Returns (repliesPerSecond, lost).
+    """
+    sockets = []
+    for i in range(numSockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind(('127.0.0.1', 0))
+        sockets.append(sock)
+    inFlight = dict((sock, 0) for sock in sockets)
+    lastReply = dict((sock, time.time()) for sock in sockets)
+    
+    query = pingQuery(b'aa')
+    replies = 0
+    lost = 0
+    start = time.time()
+    end = start + duration
+    
+    try:
+        while True:
+            now = time.time()
+            if now >= end:
+                break
+                
+            for sock in sockets:
+                if now - lastReply[sock] > 1.0:
+                    # Assume the outstanding queries were dropped
+                    lost += inFlight[sock]
+                    inFlight[sock] = 0
+                    lastReply[sock] = now
+                while inFlight[sock] < window:
+                    sock.sendto(query, ('127.0.0.1', port))
+                    inFlight[sock] += 1
+                    
+            (readable, writable, exceptional) = select.select(sockets, [], [], 0.1)
+            for sock in readable:
+                while True:
+                    try:
+                        sock.recvfrom(2048)
+                    except BlockingIOError:
+                        break
+                    replies += 1
+                    inFlight[sock] -= 1
+                    lastReply[sock] = time.time()
+    finally:
+        for sock in sockets:
+            sock.close()
+            
+    return (replies / (time.time() - start), lost)
+    
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    numSockets = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    window = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+    port = 18043
+    
+    print("%-10s %10s %10s %12s %8s" % ('variant', 'startup', 'peak kB', 'replies/s', 'lost'))
+    for (name, overrides) in VARIANTS:
+        (process, configDir, startup) = startNode(overrides, port)
+        try:
+            (pps, lost) = generateLoad(port, duration, numSockets, window)
+            memory = peakMemory(process)
+        finally:
+            stopNode(process, configDir)
+        print("%-10s %9.3fs %10s %12.0f %8d" % (name, startup, memory, pps, lost))
+    
+if __name__ == '__main__':
+    main()
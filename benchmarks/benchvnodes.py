@@ -0,0 +1,72 @@
+"""
+@author Thomas Churchman
+
+Benchmark that measures the memory used per virtual node, to plan how many
+virtual nodes a process can host.
+
+For each number of virtual nodes, the virtual nodes are created and each
+routing table is offered a number of random nodes, as it would be by the
+network; the memory allocated (traced with tracemalloc) is divided by the
+number of virtual nodes. The time to dispatch a query to the closest
+virtual node is reported as well.
+
+The config.py found in the current directory is used.
+
+Usage: python benchmarks/benchvnodes.py [nodesOfferedPerVirtualNode]
+"""
+
+import os
+import sys
+import time
+import random
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[0:0] = [os.getcwd(), ROOT]
+
+import config
+from dht.node import Node
+from dht.virtualnode import VirtualNode
+from dht.virtualnode import VirtualNodes
+from hash.hash import Hash
+
+_random = random.Random(0)
+
+def randomHash():
+    return Hash(_random.getrandbits(160).to_bytes(20, byteorder='big'))
+
+def randomNode():
+    address = '10.%d.%d.%d' % (_random.randrange(256), _random.randrange(256), _random.randrange(256))
+    return Node(randomHash(), (address, _random.randrange(1024, 65536)))
+
+def createVirtualNodes(numVirtualNodes, nodesOffered):
+    virtualNodes = []
+    for i in range(numVirtualNodes):
+        virtualNode = VirtualNode(Node(randomHash(), ('127.0.0.1', config.NODE_PORT)), config.K, config.MAX_NODES_PER_BUCKET, config.MAX_FAILED_QUERIES)
+        for j in range(nodesOffered):
+            virtualNode.routingTable.addNode(randomNode())
+        virtualNodes.append(virtualNode)
+    return VirtualNodes(virtualNodes)
+
+def main():
+    nodesOffered = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    print("%10s %14s %12s %16s" % ('vnodes', 'kB per vnode', 'table size', 'dispatch us'))
+    for numVirtualNodes in [1, 10, 100, 1000]:
+        tracemalloc.start()
+        virtualNodes = createVirtualNodes(numVirtualNodes, nodesOffered)
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        tableSize = sum(len(virtualNode.routingTable) for virtualNode in virtualNodes) / numVirtualNodes
+
+        targets = [randomHash() for i in range(10000)]
+        start = time.perf_counter()
+        for target in targets:
+            virtualNodes.closestTo(target)
+        dispatch = (time.perf_counter() - start) / len(targets)
+
+        print("%10d %14.1f %12.1f %16.2f" % (numVirtualNodes, current / 1024 / numVirtualNodes, tableSize, dispatch * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+@author Thomas Churchman
+
+Replays a packet capture (see capture.py and the "capture" admin commands)
+against a running node, to benchmark it with real traffic.
+
+The datagrams are sent at the rate they were received, at a multiple of
+that rate, or as fast as possible (speed 0). The sources of the capture are
+spread over a number of local sockets, each source always sending from the
+same socket, so the node sees many source ports.
+
+Queries are matched to replies by source socket and transaction ID. The
+replayer reports the rate at which datagrams were sent and replies were
+received, the latency percentiles of the replies and the number of queries
+that were not answered within the timeout (dropped). Other datagrams in the
+capture (e.g., responses to the node's own queries) are sent as well, but
+are not expected to be answered.
+
+Usage: python benchmarks/replay.py capture.bin [host:port] [speed] [sockets] [timeout]
+"""
+
+import os
+import sys
+import time
+import socket
+import select
+import collections
+
+import bencodepy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[0:0] = [ROOT]
+
+import capture
+
+# Maximum number of datagrams sent between checks for replies when
+# replaying as fast as possible
+BURST = 64
+
+def transactionID(data, type):
+    """
+    Get the transaction ID of the given KRPC message if it is of the given
+    type (b'q', b'r' or b'e'), or None.
+    """
+    try:
+        message = bencodepy.decode(data)
+    except Exception:
+        return None
+    if not isinstance(message, dict) or message.get(b'y') != type:
+        return None
+    return message.get(b't')
+
+def loadCapture(path):
+    """
+    Load the capture at the given path as a list of (offset in seconds from
+    the first datagram, data, source, transaction ID of a query or None).
+    """
+    records = []
+    first = None
+    for (timestamp, data, source) in capture.readCapture(path):
+        if first is None:
+            first = timestamp
+        records.append((timestamp - first, data, source, transactionID(data, b'q')))
+    return records
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def replay(records, addressPort, speed=1.0, numSockets=64, timeout=1.0):
+    """
+    Send the given capture records to the node at the given address.
+
+    Returns a dictionary of the results.
+    """
+    family = socket.AF_INET6 if ':' in addressPort[0] else socket.AF_INET
+    sockets = []
+    for i in range(numSockets):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind(('::1' if family == socket.AF_INET6 else '127.0.0.1', 0))
+        sockets.append(sock)
+    byFileno = dict((sock.fileno(), i) for (i, sock) in enumerate(sockets))
+
+    # {source: socket index}
+    sourceSockets = {}
+    # {(socket index, transaction ID): deque of send times}
+    pending = {}
+    # (send time, key) of the queries sent, oldest first
+    sent = collections.deque()
+
+    latencies = []
+    (queries, replies, errors, dropped, unmatched) = (0, 0, 0, 0, 0)
+    i = 0
+    start = time.perf_counter()
+    lastActivity = start
+
+    try:
+        while i < len(records) or pending:
+            now = time.perf_counter()
+
+            # Send the datagrams that are due
+            burst = 0
+            while i < len(records) and burst < BURST:
+                (offset, data, source, tid) = records[i]
+                if speed > 0 and offset / speed > now - start:
+                    break
+                index = sourceSockets.setdefault(source, len(sourceSockets) % numSockets)
+                try:
+                    sockets[index].sendto(data, addressPort)
+                except BlockingIOError:
+                    break
+                if tid is not None:
+                    queries += 1
+                    key = (index, tid)
+                    pending.setdefault(key, collections.deque()).append(now)
+                    sent.append((now, key))
+                i += 1
+                burst += 1
+            if burst:
+                lastActivity = now
+
+            # Queries not answered in time are dropped
+            while sent and sent[0][0] + timeout < now:
+                (sendTime, key) = sent.popleft()
+                times = pending.get(key)
+                if times and times[0] <= sendTime:
+                    times.popleft()
+                    dropped += 1
+                    if not times:
+                        del pending[key]
+
+            if i < len(records):
+                wait = 0 if speed <= 0 else max(0, min(0.01, records[i][0] / speed - (now - start)))
+            else:
+                wait = 0.01
+            (readable, writable, exceptional) = select.select(sockets, [], [], wait)
+            for sock in readable:
+                index = byFileno[sock.fileno()]
+                while True:
+                    try:
+                        (data, fromAddressPort) = sock.recvfrom(2048)
+                    except BlockingIOError:
+                        break
+                    received = time.perf_counter()
+                    lastActivity = received
+                    tid = transactionID(data, b'r')
+                    if tid is None:
+                        tid = transactionID(data, b'e')
+                        if tid is not None:
+                            errors += 1
+                    times = pending.get((index, tid))
+                    if not times:
+                        unmatched += 1
+                        continue
+                    latencies.append(received - times.popleft())
+                    replies += 1
+                    if not times:
+                        del pending[(index, tid)]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+    latencies.sort()
+    duration = max(lastActivity - start, 1e-9)
+    return {
+        'datagrams': i,
+        'queries': queries,
+        'replies': replies,
+        'errors': errors,
+        'dropped': dropped,
+        'unmatched': unmatched,
+        'sources': len(sourceSockets),
+        'duration': duration,
+        'sendRate': i / duration,
+        'replyRate': replies / duration,
+        'latencies': latencies
+    }
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    path = sys.argv[1]
+    (host, port) = sys.argv[2].rsplit(':', 1) if len(sys.argv) > 2 else ('127.0.0.1', '8043')
+    speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    numSockets = int(sys.argv[4]) if len(sys.argv) > 4 else 64
+    timeout = float(sys.argv[5]) if len(sys.argv) > 5 else 1.0
+
+    records = loadCapture(path)
+    if not records:
+        print("%s holds no datagrams" % path)
+        return
+    length = records[-1][0]
+    print("%d datagrams (%d queries) from %d sources over %.1fs" % (
+        len(records), sum(1 for record in records if record[3] is not None),
+        len(set(record[2] for record in records)), length))
+    print("replaying to %s:%s %s" % (host, port, 'as fast as possible' if speed <= 0 else 'at %gx speed' % speed))
+
+    result = replay(records, (host.strip('[]'), int(port)), speed, numSockets, timeout)
+    latencies = result['latencies']
+    print("sent %d datagrams in %.2fs (%.0f/s) from %d sockets" % (
+        result['datagrams'], result['duration'], result['sendRate'], min(numSockets, result['sources'])))
+    print("replies: %d of %d queries (%.0f/s), %d errors, %d unmatched" % (
+        result['replies'], result['queries'], result['replyRate'], result['errors'], result['unmatched']))
+    print("dropped: %d (%.2f%%)" % (result['dropped'], 100 * result['dropped'] / max(1, result['queries'])))
+    print("latency: p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, max %.3f ms" % (
+        percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+        percentile(latencies, 99) * 1000, (latencies[-1] if latencies else float('nan')) * 1000))
+
+if __name__ == '__main__':
+    main()
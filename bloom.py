@@ -16,21 +16,18 @@ class BloomFilter:
     K = 2
     M = 256 * 8
     def __init__(self):
-        self.bloom = [0] * (self.M/8)
+        self.bloom = [0] * (self.M//8)
         
     def insertIP(self, ip):
         """
         Insert an IP into the bloom filter.
         """
         # IP to bytes
-        bytes = ipaddress.ip_address(unicode(ip)).packed
+        bytes = ipaddress.ip_address(str(ip)).packed
         
         # Calculate SHA1 hash
         hash = hashlib.sha1(bytes).digest()
                 
-        # Convert characters to integers
-        hash = map(ord, hash)
-        
         index1 = hash[0] | (hash[1] << 8)
         index2 = hash[2] | (hash[3] << 8)
         
@@ -39,8 +36,8 @@ class BloomFilter:
         index2 %= self.M
         
         # Set bits at index1 and index2
-        self.bloom[index1 / 8] |= 0x01 << (index1 % 8)
-        self.bloom[index2 / 8] |= 0x01 << (index2 % 8)
+        self.bloom[index1 // 8] |= 0x01 << (index1 % 8)
+        self.bloom[index2 // 8] |= 0x01 << (index2 % 8)
         
     def _countZeroBits(self):
         """
@@ -60,4 +57,43 @@ class BloomFilter:
         Estimate the number of items in the bloom filter.
         """
         c = float(min(self.M-1, self._countZeroBits()))
-        return math.log(c / self.M) / (self.K * math.log(1 - 1. / self.M))
\ No newline at end of file
+        return math.log(c / self.M) / (self.K * math.log(1 - 1. / self.M))
+
+class HashBloomFilter:
+    """
+    Class representing a bloom filter for deduplicating byte strings, such
+    as info-hashes, sized for a given capacity and false positive rate.
+    """
+    def __init__(self, capacity, errorRate=0.001):
+        self.capacity = capacity
+        self.errorRate = errorRate
+        
+        # Optimal number of bits and hash functions for the capacity and error rate
+        self.M = int(math.ceil(-capacity * math.log(errorRate) / (math.log(2) ** 2)))
+        self.K = max(1, int(round(self.M / capacity * math.log(2))))
+        self.bloom = bytearray((self.M + 7) // 8)
+        
+    def _indices(self, key):
+        """
+        Get the K bit indices for a key, using double hashing.
+        """
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], byteorder='little')
+        h2 = int.from_bytes(digest[8:], byteorder='little') | 1
+        return [(h1 + i * h2) % self.M for i in range(self.K)]
+        
+    def add(self, key):
+        """
+        Add a key to the bloom filter.
+        Returns True if the key was not in the filter yet.
+        """
+        new = False
+        for index in self._indices(key):
+            mask = 0x01 << (index % 8)
+            if not self.bloom[index // 8] & mask:
+                self.bloom[index // 8] |= mask
+                new = True
+        return new
+        
+    def __contains__(self, key):
+        return all(self.bloom[index // 8] & (0x01 << (index % 8)) for index in self._indices(key))
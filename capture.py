@@ -0,0 +1,77 @@
+"""
+@author Thomas Churchman
+
+Module that reads and writes packet captures: the datagrams received by a
+node, with the time they were received and their source address, so real
+traffic can be replayed against a node (see benchmarks/replay.py).
+
+A capture file starts with MAGIC, followed by one record per datagram:
+the receive time in seconds (a double), the source port, the length of the
+source address (4 or 16 bytes) and the length of the payload, then the
+packed source address and the payload.
+"""
+
+import struct
+from socket import inet_pton
+from socket import inet_ntop
+from socket import AF_INET
+from socket import AF_INET6
+
+import utils
+
+MAGIC = b'OTDHTCAP\x01'
+
+# Format >dHBH:
+# >   - Format using big endian (network byte order)
+# d   - receive time in seconds
+# H   - source port
+# B   - length of the packed source address (4 or 16)
+# H   - length of the payload
+RECORD_HEADER = struct.Struct('>dHBH')
+
+class CaptureWriter:
+    """
+    Class to write received datagrams to the capture file at the given path.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self.bytes = 0
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+
+    def write(self, timestamp, data, addressPort):
+        (address, port) = addressPort
+        if utils.isIPv6(address):
+            packed = inet_pton(AF_INET6, address)
+        else:
+            packed = inet_pton(AF_INET, address)
+        self._file.write(RECORD_HEADER.pack(timestamp, port, len(packed), len(data)))
+        self._file.write(packed)
+        self._file.write(data)
+        self.records += 1
+        self.bytes += len(data)
+
+    def close(self):
+        self._file.close()
+
+def readCapture(path):
+    """
+    Generate the (timestamp, data, (address, port)) records of the capture
+    file at the given path.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception('%s is not a capture file' % path)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # End of the file, or a record cut off when the node stopped
+                return
+            (timestamp, port, addressLength, dataLength) = RECORD_HEADER.unpack(header)
+            packed = f.read(addressLength)
+            data = f.read(dataLength)
+            if len(data) < dataLength:
+                return
+            address = inet_ntop(AF_INET6 if addressLength == 16 else AF_INET, packed)
+            yield (timestamp, data, (address, port))
@@ -7,27 +7,150 @@ import os.path
 # UDP port the node listens on
 NODE_PORT = 6881
 
+# Number of worker processes serving the UDP port. With more than one
+# worker the node runs as a supervisor that spawns the workers, each binding
+# the port with SO_REUSEPORT (Linux 3.9+) so datagrams are spread across cores
+WORKERS = 1
+
+# Event loop to run the node on. One of: twisted, asyncio
+# The asyncio loop does not load Twisted, starting faster and using less
+# memory, and runs on uvloop if that is installed
+REACTOR = 'twisted'
+
+# UDP transport (twisted only). One of: default, mmsg
+# The mmsg transport (Linux only) receives and sends datagrams in batches of
+# up to MMSG_BATCH_SIZE using recvmmsg/sendmmsg, saving system calls under load
+TRANSPORT = 'default'
+MMSG_BATCH_SIZE = 64
+
 # The name this node's ID is derived from
 NODE_ID_NAME = b"An Adequately Random Node Name For Entropy"
 
+# Secure node IDs (BEP 42): derive this node's ID from its external IP
+# address NODE_EXTERNAL_IP, and only add nodes to the routing tables whose
+# ID matches their IP address (nodes on local networks are exempt). The
+# checks for the last SECURE_ID_CACHE_SIZE IP addresses seen are cached.
+# The IDs of additional virtual nodes are not derived from the IP address
+SECURE_NODE_IDS = False
+NODE_EXTERNAL_IP = None
+SECURE_ID_CACHE_SIZE = 65536
+
+# Number of node IDs this node hosts. The node IDs of the virtual nodes are
+# derived from NODE_ID_NAME; each has its own routing table, and they share 
+# the socket, peer storage and token secret
+VIRTUAL_NODES = 1
+
 # Heartbeat interval in seconds
 HEARTBEAT = 3.0
 
+# File the secrets get_peers tokens are derived from are kept in, so tokens
+# stay valid across restarts and are shared by the workers; None to keep
+# them in memory (only with WORKERS = 1). The secrets are rotated every
+# TOKEN_ROTATION_INTERVAL seconds; tokens of the current and previous
+# secret are accepted
+TOKEN_SECRET_FILE = os.path.join('.', 'token_secret')
+TOKEN_ROTATION_INTERVAL = 300
+
+# Print every received datagram and decoded message (for debugging)
+LOG_PACKETS = False
+
 # Bootstrap into the DHT network
 BOOTSTRAP = [   ("dht.transmissionbt.com", 6881),
                 ("router.utorrent.com", 6881)]
 
 # The external IP of this node
 NODE_IP = '0.0.0.0'
+
+# Also serve IPv6 nodes (BEP 32) on a second socket bound to NODE_PORT
+IPV6 = True
                 
 # Specify which type of peer storage you wish to use.
-# One of: file, mysql (currently only file is supported)
+# One of: file, memory, mysql (mysql is not supported yet). 
+# Peers in memory storage are lost when the node stops
 PEER_STORAGE = 'file'
 
 # Specify where to store peers (only used for file peer storage)
 PEER_STORAGE_DIR = os.path.join('.', 'peer_storage')
 
+# Maximum number of torrent files kept open by the file peer storage
+PEER_STORAGE_MAX_OPEN_FILES = 256
+
+# Number of threads performing blocking peer storage operations off the event
+# loop (0 to perform them on the event loop), and the maximum number of
+# pending operations. Queries that arrive while the queue is full are answered
+# with a 202 (server) error
+STORAGE_THREADS = 4
+STORAGE_QUEUE_DEPTH = 1000
+
+# Announced peers are buffered in memory and written to the peer storage in
+# bulk every ANNOUNCE_BUFFER_INTERVAL seconds, or as soon as
+# ANNOUNCE_BUFFER_SIZE peers are buffered. Set the interval to 0 to write
+# every announce immediately
+ANNOUNCE_BUFFER_INTERVAL = 10.0
+ANNOUNCE_BUFFER_SIZE = 10000
+
+# Seconds to wait for a reply to an outbound query. As in TCP, a query is
+# sent again when it takes longer than the round-trip times of the node (or
+# of all nodes) suggest, and queries to nodes with a known round-trip time
+# fail sooner. Timeouts are never shorter than MIN_QUERY_TIMEOUT
+QUERY_TIMEOUT = 5.0
+MIN_QUERY_TIMEOUT = 0.5
+
+# Maximum size in bytes of responses to IPv4 and IPv6 nodes, to avoid IP
+# fragmentation. Peers (a random selection) and nodes (the closest) that do
+# not fit are left out. 1232 bytes fit in the minimum IPv6 MTU of 1280
+# At the defaults, a get_peers response holds at most 164 IPv4 or 54 IPv6
+# peers, and a find_node response 51 IPv4 or 30 IPv6 nodes
+MAX_RESPONSE_SIZE = 1400
+MAX_RESPONSE_SIZE6 = 1232
+
+# Number of recent sources of queries (nodes not in the routing table) to
+# remember, with their query counts. Buckets that lose a node are refilled
+# with the most recently seen source in their range
+NODE_CACHE_SIZE = 65536
+
+# Crawler mode: log the info-hash of every get_peers and announce_peer query
+# received to CRAWLER_LOG, deduplicated by a bloom filter sized for
+# CRAWLER_CAPACITY info-hashes. The crawler sends CRAWLER_QUERY_RATE
+# find_node queries per second to spread node IDs close to the nodes it
+# contacts over the network (see crawler.py). Workers spawned by a
+# supervisor log to CRAWLER_LOG + '.' + their index
+CRAWLER = False
+CRAWLER_LOG = os.path.join('.', 'infohashes.log')
+CRAWLER_CAPACITY = 10000000
+CRAWLER_QUERY_RATE = 100
+
+# Announcer mode: announce the torrents of torrent clients on this host
+# (added through the local API) to the DHT every ANNOUNCER_INTERVAL seconds,
+# give or take ANNOUNCER_JITTER of it (see announcer.py). Peers are commonly
+# kept for 30 minutes. The closest nodes found for a torrent are reused for
+# torrents near it for ANNOUNCER_NEIGHBORHOOD_TTL seconds. The announcer
+# only starts queries while fewer than MAX_QUERIES_IN_FLIGHT queries of the
+# node are outstanding
+ANNOUNCER = False
+ANNOUNCER_INTERVAL = 1500
+ANNOUNCER_JITTER = 0.1
+ANNOUNCER_NEIGHBORHOOD_TTL = 300
+MAX_QUERIES_IN_FLIGHT = 256
+
+# Unix socket a running node hands its UDP sockets and state over to a new
+# process on when it receives SIGUSR2 (see handoff.py), to restart without
+# dropping packets; None to disable. Not supported with several workers
+HANDOFF_SOCKET = os.path.join('.', 'otdht.handoff')
+
+# Local admin endpoint for toggling profiling at runtime (see profiling.py),
+# bound to 127.0.0.1 only; 0 to disable. Workers spawned by a supervisor
+# listen on ADMIN_PORT + 1 + their index. Profiles are written to PROFILE_DIR
+ADMIN_PORT = 0
+PROFILE_DIR = os.path.join('.', 'profiles')
+
+# Unix socket path of the local bulk API for torrent clients on this host
+# (see localapi.py); None to disable. Workers spawned by a supervisor listen
+# on LOCAL_API_SOCKET + '.' + their index
+LOCAL_API_SOCKET = None
+
 # Protocol settings (should not be changed)
 K = 8
 MAX_NODES_PER_BUCKET = K
+MAX_FAILED_QUERIES = 2
 MAX_PEERS_PER_TORRENT = 6000
\ No newline at end of file
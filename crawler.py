@@ -0,0 +1,231 @@
+"""
+@author Thomas Churchman
+
+Module that implements the crawler mode, in which the node indexes the
+info-hashes of the get_peers and announce_peer queries it receives.
+
+Info-hashes are deduplicated by a bloom filter and appended to a log of
+fixed-size records (info-hash, Unix time, source query). The bloom filter is
+rebuilt from the log at start-up, so an info-hash is logged once across
+restarts (barring false positives of the filter).
+
+To receive many queries, the crawler presents a different node ID to every
+node it talks to: an ID sharing its first bytes with the other node's ID
+(or the query's target). Nodes insert such a neighbor ID in their fullest,
+closest bucket and pass it on to nodes looking up info-hashes near them, so
+the single socket is reached by queries for targets all over the ID space.
+The crawler actively queries the nodes it learns about at a configurable
+rate to spread its IDs.
+"""
+
+import os
+import time
+import socket
+import struct
+import collections
+
+import bloom
+import utils
+import krpc.krpccoder
+from dht.node import Node
+from hash.hash import Hash
+
+# Number of leading bytes a neighbor ID shares with the ID it is close to
+NEIGHBOR_PREFIX = 15
+
+# Log record: info-hash, Unix time, source query
+RECORD = struct.Struct('>20sIB')
+SOURCE_GET_PEERS = 0
+SOURCE_ANNOUNCE_PEER = 1
+
+# Interval between rounds of outbound queries, in seconds
+TICK = 0.1
+
+def neighborID(hash, ownHash):
+    """
+    Get a node ID close to the given ID: the first NEIGHBOR_PREFIX bytes of
+    the given ID followed by the remaining bytes of our own ID.
+    """
+    return Hash(bytes(hash)[:NEIGHBOR_PREFIX] + bytes(ownHash)[NEIGHBOR_PREFIX:])
+
+class InfohashLog:
+    """
+    Class to represent an append-only log of unique info-hashes.
+    """
+    def __init__(self, path, capacity):
+        self.path = path
+        self.filter = bloom.HashBloomFilter(capacity)
+
+        # Number of info-hashes offered and number of unique info-hashes logged
+        self.seen = 0
+        self.unique = 0
+
+        self._load()
+        self._file = open(path, 'ab')
+
+    def _load(self):
+        """
+        Add the info-hashes in an existing log to the bloom filter. A
+        partially written record at the end of the log is cut off.
+        """
+        if not os.path.isfile(self.path):
+            return
+
+        size = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(RECORD.size * 4096)
+                for offset in range(0, len(chunk) - RECORD.size + 1, RECORD.size):
+                    (hash, timestamp, source) = RECORD.unpack_from(chunk, offset)
+                    if self.filter.add(hash):
+                        self.unique += 1
+                    size += RECORD.size
+                if len(chunk) < RECORD.size * 4096:
+                    break
+
+        if os.path.getsize(self.path) != size:
+            os.truncate(self.path, size)
+
+    def add(self, hash, source):
+        """
+        Log an info-hash if it has not been logged before.
+        Returns whether the info-hash was logged.
+        """
+        self.seen += 1
+        key = bytes(hash)
+        if not self.filter.add(key):
+            return False
+
+        self.unique += 1
+        self._file.write(RECORD.pack(key, int(time.time()), source))
+        return True
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class Crawler:
+    """
+    Class to represent the crawler of the node with the given context.
+
+    The KRPC handler passes every received query to queryReceived. Once
+    started, the crawler sends find_node queries for random targets to the
+    nodes it has learned about, queryRate queries per second.
+    """
+    def __init__(self, context, log, queryRate, maxQueuedNodes=10000):
+        self.context = context
+        self.log = log
+        self.queryRate = queryRate
+
+        # Nodes to query, learned from responses and received queries
+        self.nodes = collections.deque(maxlen=maxQueuedNodes)
+        self.bootstrapNodes = []
+
+        # Unique info-hashes logged in each of the last 60 minutes
+        self.uniquePerMinute = collections.deque(maxlen=60)
+        self._minuteUnique = 0
+        self._minuteSeen = 0
+
+        self.protocol = None
+        self.callLater = None
+        self._tickCall = None
+        self._reportCall = None
+
+    def start(self, protocol, callLater, bootstrap):
+        """
+        Start crawling through the given (IPv4) KRPC handler, from the
+        given bootstrap (host, port) tuples.
+        """
+        self.protocol = protocol
+        self.callLater = callLater
+
+        for (host, port) in bootstrap:
+            try:
+                address = socket.gethostbyname(host)
+            except socket.error as e:
+                print("crawler: could not resolve bootstrap node %s: %s" % (host, e))
+                continue
+            # The bootstrap node's ID is unknown; any ID will do to query it
+            self.bootstrapNodes.append(Node(Hash(self.__randomID()), (address, port)))
+
+        self.__tick()
+        self._reportCall = self.callLater(60, self.__report)
+
+    def stop(self):
+        """
+        Stop crawling and close the log.
+        """
+        for call in (self._tickCall, self._reportCall):
+            if call is not None:
+                call.cancel()
+        self._tickCall = None
+        self._reportCall = None
+        self.log.close()
+
+    def __randomID(self):
+        return utils.randomBits(160).to_bytes(20, byteorder='big')
+
+    def queryReceived(self, krpcQuery):
+        """
+        Log the info-hash of a get_peers or announce_peer query, and answer
+        the query with a node ID close to the querying node.
+        """
+        if krpcQuery.type == b'get_peers':
+            source = SOURCE_GET_PEERS
+        elif krpcQuery.type == b'announce_peer':
+            source = SOURCE_ANNOUNCE_PEER
+        else:
+            source = None
+
+        if source is not None:
+            self._minuteSeen += 1
+            if self.log.add(krpcQuery.targetID, source):
+                self._minuteUnique += 1
+
+        thisNode = self.context.thisNode
+        krpcQuery.toNode = Node(neighborID(krpcQuery.fromNode.hash, thisNode.hash), thisNode.host)
+        if not utils.isIPv6(krpcQuery.fromNode.address()):
+            self.nodes.append(krpcQuery.fromNode)
+
+    def __tick(self):
+        """
+        Send a round of find_node queries.
+        """
+        if not self.nodes:
+            self.nodes.extend(self.bootstrapNodes)
+
+        thisNode = self.context.thisNode
+        for i in range(max(1, int(self.queryRate * TICK))):
+            if not self.nodes:
+                break
+            node = self.nodes.popleft()
+            query = krpc.krpccoder.KRPCQuery(
+                fromNode=Node(neighborID(node.hash, thisNode.hash), thisNode.host),
+                toNode=node,
+                type=b'find_node',
+                targetID=Hash(self.__randomID()))
+            waiter = self.protocol.sendQuery(query)
+            self.protocol.whenAnswered(waiter, self.__answered, self.__failed)
+
+        self._tickCall = self.callLater(TICK, self.__tick)
+
+    def __answered(self, response):
+        if response.nodes is not None:
+            self.nodes.extend(response.nodes)
+
+    def __failed(self, exception):
+        pass
+
+    def __report(self):
+        """
+        Report the number of unique info-hashes logged in the last minute.
+        """
+        self.uniquePerMinute.append(self._minuteUnique)
+        print("crawler: %d unique info-hashes in the last minute (%d seen, %d unique in total)" % (self._minuteUnique, self._minuteSeen, self.log.unique))
+        self._minuteUnique = 0
+        self._minuteSeen = 0
+        self.log.flush()
+
+        self._reportCall = self.callLater(60, self.__report)
@@ -4,39 +4,65 @@
 Module that provides node bucket functionality.
 """
 
-import appstate
-
 class Bucket:
     """
     Class to represent a bucket for use in the routing table.
+    
+    Nodes are kept in order of when they were last seen, least recently 
+    seen first.
     """
-    def __init__(self, low, high, refreshed, nodes=[]):
+    def __init__(self, low, high, refreshed, nodes=None, maxNodes=8):
         self.low = low # inclusive
         self.high = high # inclusive
         self.refreshed = refreshed
-        self.nodes = nodes
+        self.maxNodes = maxNodes
+        self.nodes = nodes if nodes != None else []
         
     def inRange(self, node):
         """
         Check if the given node (ID) falls in this bucket's ID space.
         """
-        return self.low <= node and node <= self.high
+        return self.low <= int(node) and int(node) <= self.high
+        
+    def findNode(self, hash):
+        """
+        Find the node with the given ID in the bucket.
+        """
+        for node in self.nodes:
+            if node.hash == hash:
+                return node
+        return None
         
     def addNode(self, node):
         """
         Attempt to add a node to the bucket.
         """
-        if not inRange(node):
+        if not self.inRange(node):
             return False
         
-        if len(self.nodes) >= appstate.AppState.maxBucketSize:
+        if len(self.nodes) >= self.maxNodes:
             return False
 
-        if node in self.nodes:
+        if self.findNode(node.hash) != None:
             return False
            
         self.nodes.append(node)
         node.bucket = self
+        return True
+        
+    def removeNode(self, node):
+        """
+        Remove a node from the bucket.
+        """
+        self.nodes.remove(node)
+        node.bucket = None
+        
+    def touchNode(self, node):
+        """
+        Mark a node in the bucket as most recently seen.
+        """
+        self.nodes.remove(node)
+        self.nodes.append(node)
         
     def __repr__(self):
         return "Bucket(low=%r,high=%r,refreshed=%r,nodes=%r)" % (self.low, self.high, self.refreshed, self.nodes)
\ No newline at end of file
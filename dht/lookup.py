@@ -0,0 +1,179 @@
+"""
+@author Thomas Churchman
+
+Module that provides iterative (Kademlia) lookups of the nodes closest
+to a target ID, and of the peers of a torrent.
+"""
+
+import heapq
+from socket import AF_INET
+
+import utils
+import krpc.krpccoder
+
+class Lookup:
+    """
+    Class to represent an iterative find_node or get_peers lookup.
+
+    Starting from a set of known nodes, up to alpha queries are kept in
+    flight to the closest nodes that have not been queried yet. Nodes
+    returned in responses become candidates themselves. The lookup is done
+    when the K closest candidates have all answered or failed.
+
+    Among the K closest candidates, nodes at the same order of distance
+    (the same bit length of the XOR distance) are queried in order of
+    their smoothed round-trip time, so fast nodes are tried first. A query
+    that takes longer than usual (see KRPCHandler.sendQuery) no longer
+    counts towards alpha, but its answer is still used; the lookup only
+    waits for it if the node is among the K closest candidates.
+    
+    The lookup sends its queries through a KRPCHandler and does not depend
+    on the event loop the handler runs on. The handler serves a socket of
+    the given address family; nodes of the other family (e.g., nodes6 in
+    responses, BEP 32) are not candidates.
+    """
+    def __init__(self, protocol, target, type=b'find_node', alpha=3, k=None, family=AF_INET):
+        self.protocol = protocol
+        self.family = family
+        self.target = target
+        self.type = type
+        self.alpha = alpha
+        self.k = k if k != None else protocol.context.k
+
+        # {hash bytes: (Node, hop)}, where hop is the number of responses
+        # it took to learn about the node
+        self.candidates = {}
+        self.queried = set()
+        self.failed = set()
+
+        # {hash bytes: (Node, hop)}
+        self.responded = {}
+
+        # Tokens returned by get_peers responses {hash bytes: (Node, token)}
+        self.tokens = {}
+        self.peers = []
+
+        self.inFlight = 0
+        # Hashes of the nodes with a slow query in flight
+        self.slow = set()
+        self.queries = 0
+        self.finished = False
+        self._onDone = None
+
+    def start(self, nodes, onDone):
+        """
+        Start the lookup from the given nodes. onDone(lookup) is called
+        when the lookup is done.
+        """
+        self._onDone = onDone
+        for node in nodes:
+            self.__addCandidate(node, 1)
+        self.__step()
+
+    def closestNodes(self):
+        """
+        Get the K closest nodes to the target that answered a query.
+        """
+        return [node for (node, hop) in self.__closest(self.responded.values())]
+
+    def hops(self):
+        """
+        Get the number of hops it took to reach the closest node that
+        answered, or None if no node answered.
+        """
+        closest = self.__closest(self.responded.values())
+        if not closest:
+            return None
+        (node, hop) = closest[0]
+        return hop
+
+    def __closest(self, candidates):
+        return heapq.nsmallest(self.k, candidates, key=lambda candidate: candidate[0].distanceToHash(self.target))
+
+    def __queryOrder(self, candidate):
+        (node, hop) = candidate
+        rtt = node.srtt if node.srtt is not None else self.protocol.context.queryTimeout
+        return (node.distanceToHash(self.target).bit_length(), rtt)
+
+    def __addCandidate(self, node, hop):
+        key = bytes(node.hash)
+        if key in self.candidates or node.hash == self.protocol.context.thisNode.hash:
+            return
+        if utils.addressFamily(node.address()) != self.family:
+            return
+        # Use the routing table's node, which knows its round-trip time
+        known = self.protocol.context.routingTableFor(node.address()).findNode(node.hash)
+        if known is not None and known.host == node.host:
+            node = known
+        self.candidates[key] = (node, hop)
+
+    def __step(self):
+        """
+        Send queries to the closest unqueried candidates until alpha queries
+        are in flight, or finish the lookup if there is nothing left to do.
+        """
+        if self.finished:
+            return
+
+        live = [candidate for (key, candidate) in self.candidates.items() if key not in self.failed]
+        closest = self.__closest(live)
+        for (node, hop) in sorted(closest, key=self.__queryOrder):
+            if self.inFlight >= self.alpha:
+                break
+            if bytes(node.hash) not in self.queried:
+                self.__query(node, hop)
+
+        waiting = any(bytes(node.hash) in self.slow for (node, hop) in closest)
+        if self.inFlight == 0 and not waiting:
+            self.finished = True
+            self._onDone(self)
+
+    def __query(self, node, hop):
+        self.queried.add(bytes(node.hash))
+        self.inFlight += 1
+        self.queries += 1
+
+        query = krpc.krpccoder.KRPCQuery(toNode=node, type=self.type, targetID=self.target)
+        waiter = self.protocol.sendQuery(query, onSlow=lambda: self.__slow(node))
+        self.protocol.whenAnswered(
+            waiter,
+            lambda response: self.__answered(response, node, hop),
+            lambda exception: self.__failed(exception, node))
+
+    def __slow(self, node):
+        self.inFlight -= 1
+        self.slow.add(bytes(node.hash))
+        self.__step()
+
+    def __done(self, node):
+        """
+        Account for the end of the query to the given node.
+        """
+        key = bytes(node.hash)
+        if key in self.slow:
+            self.slow.discard(key)
+        else:
+            self.inFlight -= 1
+
+    def __answered(self, response, node, hop):
+        self.__done(node)
+        self.responded[bytes(node.hash)] = (node, hop)
+
+        for nodes in (response.nodes, response.nodes6):
+            if nodes != None:
+                for newNode in nodes:
+                    self.__addCandidate(newNode, hop + 1)
+
+        if response.token is not None:
+            self.tokens[bytes(node.hash)] = (node, response.token)
+        if response.peers is not None:
+            for peer in response.peers:
+                if peer not in self.peers:
+                    self.peers.append(peer)
+
+        self.__step()
+
+    def __failed(self, exception, node):
+        self.__done(node)
+        self.failed.add(bytes(node.hash))
+        self.__step()
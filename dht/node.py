@@ -2,6 +2,32 @@
 @author Thomas Churchman
 """
 
+# Gains of the smoothed round-trip time and its variation (RFC 6298)
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+
+def smoothRTT(srtt, rttvar, rtt):
+    """
+    Update a smoothed round-trip time and round-trip time variation with a
+    measured round-trip time, as TCP does (RFC 6298). Returns the new
+    (srtt, rttvar); pass None for both before the first measurement.
+    """
+    if srtt is None:
+        return (rtt, rtt / 2)
+    rttvar = (1 - RTT_BETA) * rttvar + RTT_BETA * abs(srtt - rtt)
+    srtt = (1 - RTT_ALPHA) * srtt + RTT_ALPHA * rtt
+    return (srtt, rttvar)
+
+def rttTimeout(srtt, rttvar, minimum, maximum):
+    """
+    Get the time to wait for a reply: the smoothed round-trip time plus four
+    times its variation, clamped to [minimum, maximum]. Without a smoothed
+    round-trip time, the maximum is returned.
+    """
+    if srtt is None:
+        return maximum
+    return min(maximum, max(minimum, srtt + 4 * rttvar))
+
 class Node:
     """
     Class to represent a node in the DHT network.
@@ -13,6 +39,14 @@ class Node:
         self.host = (address, port)
         self.bucket = bucket
         
+        # Number of consecutive queries the node did not answer
+        self.failedQueries = 0
+        
+        # Smoothed round-trip time and round-trip time variation in seconds,
+        # or None if the node has not answered a query yet
+        self.srtt = None
+        self.rttvar = None
+        
     def address(self):
         (address, port) = self.host
         return address
@@ -21,6 +55,19 @@ class Node:
         (address, port) = self.host
         return port
         
+    def addRTTSample(self, rtt):
+        """
+        Update the smoothed round-trip time with a measured round-trip time.
+        """
+        (self.srtt, self.rttvar) = smoothRTT(self.srtt, self.rttvar, rtt)
+        
+    def queryTimeout(self, minimum, maximum):
+        """
+        Get the time to wait for a reply to a query to this node (see
+        rttTimeout).
+        """
+        return rttTimeout(self.srtt, self.rttvar, minimum, maximum)
+        
     def distanceToNode(self, otherNode):
         return self.hash.distance(otherNode.hash)
 
@@ -35,4 +82,6 @@ class Node:
         
     def __repr__(self):
         (address, port) = self.host
-        return "Node(hash=%r,(address=%r,port=%r),bucket=%r)" % (self.hash, address, port, self.bucket)
\ No newline at end of file
+        # Only show the bucket's range; the bucket's repr includes its nodes
+        bucket = (self.bucket.low, self.bucket.high) if self.bucket != None else None
+        return "Node(hash=%r,(address=%r,port=%r),bucket=%r)" % (self.hash, address, port, bucket)
\ No newline at end of file
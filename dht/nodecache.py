@@ -0,0 +1,143 @@
+"""
+@author Thomas Churchman
+
+Module that provides a cache of the nodes that recently sent us queries.
+
+Most queries come from nodes that are not in the routing table, and many
+of those (crawlers in particular) query again within milliseconds. The
+cache keeps the Node of each recent source, so it is not created anew for
+every query, along with the number of queries it sent. Sources are keyed by (ID, address, port); the least recently
+seen source is evicted when the cache is full.
+
+Recently seen sources are the candidates to fill a bucket of the routing
+table when a node is removed from it, and their query rates can be used
+to spot nodes that flood us with queries.
+"""
+
+import time
+import heapq
+import collections
+
+import utils
+from dht.node import Node
+
+# Sources not seen for this many seconds are no longer candidates to fill
+# buckets (nodes are "good" for 15 minutes after their last query, BEP 5)
+GOOD_NODE_AGE = 15 * 60
+
+class CachedNode:
+    """
+    Class to represent a source in the node cache.
+    """
+    __slots__ = ('node', 'firstSeen', 'lastSeen', 'queries')
+
+    def __init__(self, node, now):
+        self.node = node
+        self.firstSeen = now
+        self.lastSeen = now
+        self.queries = 1
+
+    def queryRate(self):
+        """
+        Get the number of queries per second the source sent since it was
+        first seen, or None if it was seen only once.
+        """
+        if self.lastSeen <= self.firstSeen:
+            return None
+        return (self.queries - 1) / (self.lastSeen - self.firstSeen)
+
+class NodeCache:
+    """
+    Class to represent a bounded cache of at most capacity recently seen
+    sources of queries.
+
+    seconds is the clock the first-seen and last-seen times are taken from.
+    """
+    def __init__(self, capacity=65536, seconds=time.time):
+        self.capacity = capacity
+        self.seconds = seconds
+
+        # {(hash bytes, address, port): CachedNode}, least recently seen first
+        self._entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def seen(self, hash, addressPort):
+        """
+        Record a query from the node with the given ID and address, and get
+        its Node; the cached Node if the source was seen before.
+        """
+        (address, port) = addressPort
+        key = (bytes(hash), address, port)
+        now = self.seconds()
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            entry.lastSeen = now
+            entry.queries += 1
+            # A node that sends us queries is alive, whether or not it
+            # answered ours
+            entry.node.failedQueries = 0
+            return entry.node
+
+        self.misses += 1
+        node = Node(hash, (address, port))
+        self._entries[key] = CachedNode(node, now)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return node
+
+    def find(self, hash, addressPort):
+        """
+        Get the cache entry of the node with the given ID and address, or
+        None if it is not in the cache.
+        """
+        (address, port) = addressPort
+        return self._entries.get((bytes(hash), address, port))
+
+    def candidates(self, low, high, ipv6=False, maxAge=GOOD_NODE_AGE):
+        """
+        Generate the cached Nodes of the given address family with an ID in
+        [low, high], most recently seen first, that were seen in the last
+        maxAge seconds.
+        """
+        since = self.seconds() - maxAge
+        for entry in reversed(self._entries.values()):
+            if entry.lastSeen < since:
+                return
+            node = entry.node
+            if low <= int(node.hash) <= high and utils.isIPv6(node.address()) == ipv6:
+                yield node
+
+    def busiest(self, n=10):
+        """
+        Get the entries of the n sources that sent the most queries.
+        """
+        return heapq.nlargest(n, self._entries.values(), key=lambda entry: entry.queries)
+
+    def dump(self):
+        """
+        Show the cache statistics and the busiest sources as text.
+        """
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 'No queries received'
+
+        lines = [
+            'sources %d/%d, hits %d (%.1f%%), misses %d, evictions %d' % (
+                len(self._entries), self.capacity, self.hits, 100 * self.hits / lookups, self.misses, self.evictions),
+            '%-46s %10s %10s' % ('source', 'queries', 'queries/s')
+        ]
+        for entry in self.busiest():
+            rate = entry.queryRate()
+            (address, port) = entry.node.host
+            lines.append('%-46s %10d %10s' % (
+                '%s:%d' % (address, port), entry.queries, '%.1f' % rate if rate is not None else '-'))
+        return '\n'.join(lines)
+
+    def __len__(self):
+        return len(self._entries)
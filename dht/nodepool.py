@@ -0,0 +1,221 @@
+"""
+@author Thomas Churchman
+
+Module that provides node pools: large sets of nodes that can be ranked by
+XOR distance to a target ID.
+
+If NumPy is installed, the IDs of the nodes in the pool are kept as rows of
+five 32-bit words, and the nodes closest to a target are found with one
+vectorised XOR and numpy.argpartition. Otherwise, the pool falls back to
+ranking the nodes in Python.
+"""
+
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def isNumpyAvailable():
+    """
+    Check whether the vectorised node pool can be used.
+    """
+    return numpy is not None
+
+def createNodePool(nodes=(), useNumpy=None):
+    """
+    Create a node pool holding the given nodes: the vectorised pool if NumPy
+    is available, and the pure-Python pool otherwise. Pass useNumpy to
+    choose explicitly.
+    """
+    if useNumpy is None:
+        useNumpy = isNumpyAvailable()
+    elif useNumpy and not isNumpyAvailable():
+        raise Exception('NumPy is not installed')
+
+    if useNumpy:
+        return NumpyNodePool(nodes)
+    return PythonNodePool(nodes)
+
+class _NodePool:
+    """
+    Class to represent a set of nodes, keyed by ID.
+    """
+    def __init__(self, nodes=()):
+        self.addNodes(nodes)
+
+    def addNode(self, node):
+        """
+        Add a node to the pool, replacing the node with the same ID if there is one.
+        """
+        raise NotImplementedError()
+
+    def addNodes(self, nodes):
+        """
+        Add the given nodes to the pool.
+        """
+        for node in nodes:
+            self.addNode(node)
+
+    def removeNode(self, node):
+        """
+        Remove the node with the ID of the given node from the pool, if it is in the pool.
+        """
+        raise NotImplementedError()
+
+    def findNode(self, hash):
+        """
+        Find the node with the given ID in the pool.
+        """
+        raise NotImplementedError()
+
+    def findClosestNodes(self, target, k=8):
+        """
+        Find the k nodes in the pool closest to the given target ID, closest first.
+        """
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def __iter__(self):
+        raise NotImplementedError()
+
+class PythonNodePool(_NodePool):
+    """
+    Node pool that ranks the nodes in Python.
+    """
+    def __init__(self, nodes=()):
+        # {hash bytes: Node}
+        self.nodes = {}
+        _NodePool.__init__(self, nodes)
+
+    def addNode(self, node):
+        self.nodes[bytes(node.hash)] = node
+
+    def removeNode(self, node):
+        self.nodes.pop(bytes(node.hash), None)
+
+    def findNode(self, hash):
+        return self.nodes.get(bytes(hash))
+
+    def findClosestNodes(self, target, k=8):
+        target = int(target)
+        return heapq.nsmallest(k, self.nodes.values(), key=lambda node: int(node.hash) ^ target)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+class NumpyNodePool(_NodePool):
+    """
+    Node pool that ranks the nodes with NumPy.
+
+    Row i of the ID array holds the ID of nodes[i] as five big-endian 32-bit
+    words. The rows are kept packed: a removed node is replaced by the last
+    node. The array doubles in size when it is full.
+    """
+    def __init__(self, nodes=()):
+        self.nodes = []
+        self.ids = numpy.zeros((64, 5), dtype=numpy.uint32)
+
+        # {hash bytes: row}
+        self.rows = {}
+        _NodePool.__init__(self, nodes)
+
+    def addNode(self, node):
+        key = bytes(node.hash)
+        if key in self.rows:
+            self.nodes[self.rows[key]] = node
+            return
+
+        row = len(self.nodes)
+        self.__reserve(row + 1)
+        self.ids[row] = numpy.frombuffer(key, dtype='>u4')
+        self.nodes.append(node)
+        self.rows[key] = row
+
+    def addNodes(self, nodes):
+        """
+        Add the given nodes to the pool, copying the IDs of new nodes into
+        the ID array at once.
+        """
+        keys = []
+        for node in nodes:
+            key = bytes(node.hash)
+            if key in self.rows:
+                self.nodes[self.rows[key]] = node
+                continue
+            self.rows[key] = len(self.nodes)
+            self.nodes.append(node)
+            keys.append(key)
+
+        if keys:
+            size = len(self.nodes)
+            self.__reserve(size)
+            self.ids[size - len(keys):size] = numpy.frombuffer(b''.join(keys), dtype='>u4').reshape(-1, 5)
+
+    def __reserve(self, size):
+        """
+        Grow the ID array to hold at least size IDs.
+        """
+        capacity = len(self.ids)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        ids = numpy.zeros((capacity, 5), dtype=numpy.uint32)
+        ids[:len(self.ids)] = self.ids
+        self.ids = ids
+
+    def removeNode(self, node):
+        row = self.rows.pop(bytes(node.hash), None)
+        if row is None:
+            return
+
+        last = self.nodes.pop()
+        if row < len(self.nodes):
+            self.nodes[row] = last
+            self.ids[row] = self.ids[len(self.nodes)]
+            self.rows[bytes(last.hash)] = row
+
+    def findNode(self, hash):
+        row = self.rows.get(bytes(hash))
+        if row is None:
+            return None
+        return self.nodes[row]
+
+    def findClosestNodes(self, target, k=8):
+        """
+        Find the k nodes in the pool closest to the given target ID.
+
+        The nodes are partitioned on the first 64 bits of their distance to
+        the target. Nodes tying with the k-th node on those bits are all
+        kept, and the candidates are sorted on the full distance.
+        """
+        size = len(self.nodes)
+        if size == 0 or k <= 0:
+            return []
+
+        distances = self.ids[:size] ^ numpy.frombuffer(bytes(target), dtype='>u4').astype(numpy.uint32)
+        prefixes = (distances[:, 0].astype(numpy.uint64) << numpy.uint64(32)) | distances[:, 1]
+
+        if k < size:
+            kth = prefixes[numpy.argpartition(prefixes, k - 1)[k - 1]]
+            candidates = numpy.flatnonzero(prefixes <= kth)
+        else:
+            candidates = numpy.arange(size)
+
+        # numpy.lexsort sorts on the last key first
+        candidateDistances = distances[candidates]
+        order = numpy.lexsort(candidateDistances.T[::-1])
+        return [self.nodes[i] for i in candidates[order[:k]]]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
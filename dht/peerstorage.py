@@ -3,23 +3,495 @@
 """
 
 import os.path
+import time
+import random
 import struct
-from socket import inet_ntoa
-from socket import inet_aton
+import threading
+import collections
+from socket import inet_ntop
+from socket import inet_pton
+from socket import AF_INET
+from socket import AF_INET6
 
 import utils
-import appstate
+import workerpool
 from dht.peer import Peer
+from hash.hash import Hash
+
+# Number of info-hashes in a sample_infohashes response (BEP 51)
+SAMPLE_SIZE = 20
+
+# Bounds of the interval (in seconds) after which a sample_infohashes
+# response asks to be queried again
+MIN_SAMPLE_INTERVAL = 60
+MAX_SAMPLE_INTERVAL = 21600
+
+class InfohashSample:
+    """
+    Class to represent a uniform random sample of the info-hashes of the
+    stored torrents, for sample_infohashes responses (BEP 51).
+
+    The sample is a reservoir of fixed size: every new torrent replaces a
+    random info-hash in the sample with probability size/torrents. The
+    info-hashes are kept concatenated in a buffer, so the encoded sample is
+    a single slice.
+
+    Torrents may be added from the storage worker threads.
+    """
+    def __init__(self, size=SAMPLE_SIZE):
+        self.size = size
+        self.buffer = bytearray(20 * size)
+        self.length = 0
+
+        # Number of torrents offered to the sample: loaded at start-up, and
+        # created since
+        self.loaded = 0
+        self.created = 0
+        self.started = time.time()
+
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    def __add(self, key):
+        seen = self.loaded + self.created
+        if self.length < self.size:
+            slot = self.length
+            self.length += 1
+        else:
+            slot = self._random.randrange(seen)
+            if slot >= self.size:
+                return
+        self.buffer[20 * slot:20 * (slot + 1)] = key
+
+    def load(self, keys):
+        """
+        Offer the info-hashes (bytes) of the torrents stored at start-up.
+        """
+        with self._lock:
+            for key in keys:
+                self.loaded += 1
+                self.__add(key)
+
+    def add(self, key):
+        """
+        Offer the info-hash (bytes) of a newly created torrent.
+        """
+        with self._lock:
+            self.created += 1
+            self.__add(key)
+
+    def samples(self):
+        """
+        Get the concatenated info-hashes in the sample.
+        """
+        return bytes(self.buffer[:20 * self.length])
+
+    def num(self):
+        """
+        Get the number of torrents the sample is drawn from.
+        """
+        return self.loaded + self.created
+
+    def interval(self):
+        """
+        Get the number of seconds after which about half of the sample is
+        expected to have been replaced, at the rate torrents have been
+        created since start-up.
+        """
+        rate = self.created / max(1.0, time.time() - self.started)
+        if rate == 0:
+            return MAX_SAMPLE_INTERVAL
+        # Each new torrent replaces an info-hash with probability size/num
+        interval = self.num() / (2 * rate)
+        return int(min(MAX_SAMPLE_INTERVAL, max(MIN_SAMPLE_INTERVAL, interval)))
 
 class _PeerStorage:
     """
-    Class to represent a Peer Storage. 
+    Class to represent a Peer Storage.
     Handles database interaction.
+
+    The public methods return Completions (see workerpool.py). Backends implement the blocking
+    methods _torrentExists, _getPeers and _addPeers; these are run on the
+    worker pool if one is set, and called directly otherwise.
+
+    At most maxPeersPerTorrent peers per address family are stored for a
+    torrent.
+
+    Backends report the torrents they create with _torrentCreated, to keep
+    the sample of info-hashes served to sample_infohashes queries.
     """
-    
-    def __init__(self):
-        pass
+
+    def __init__(self, maxPeersPerTorrent=6000):
+        self.pool = None
+        self.maxPeersPerTorrent = maxPeersPerTorrent
+        self.sample = InfohashSample()
+
+        # Torrents (by hash bytes) with a write in progress
+        self._writing = set()
+
+        # Adds that arrived while a write to the same torrent was in progress
+        # {hash bytes: (hash, [Peer], [Completion])}
+        self._nextWrites = {}
+
+    def setPool(self, pool):
+        """
+        Run the blocking storage operations on the given WorkerPool.
+        """
+        self.pool = pool
+
+    def _run(self, f, *args):
+        """
+        Run a blocking storage operation and return a Completion with its result.
+        """
+        if self.pool is None:
+            return workerpool.execute(f, *args)
+        return self.pool.submit(f, *args)
+
+    def torrentExists(self, hash):
+        """
+        Check if we are tracking the given torrent hash.
+        Returns a Completion firing with a bool.
+        """
+        return self._run(self._torrentExists, hash)
+
+    def getPeers(self, hash, family=None):
+        """
+        Get the peers associated with the given torrent.
+        Returns a Completion firing with a list of peers (empty if the torrent is not tracked).
         
+        If family (AF_INET or AF_INET6) is given, only peers with an address
+        of that family are returned.
+        """
+        return self._run(self._getPeers, hash, family)
+
+    def addPeer(self, hash, peer):
+        """
+        Add a peer to the given torrent.
+        Create the torrent if it is not tracked yet.
+
+        Returns a Completion firing with whether the peer was added.
+
+        At most one write per torrent is in progress at any time; peers added
+        to a torrent while it is being written are coalesced into one
+        follow-up write.
+        """
+        if self.pool is not None and self.pool.isSaturated():
+            return workerpool.fail(workerpool.PoolSaturatedError())
+
+        d = workerpool.Completion()
+        self.__queueWrite(hash, [peer], [d])
+        return d
+
+    def addPeers(self, hash, peers):
+        """
+        Add multiple peers to the given torrent in one write.
+
+        Returns a Completion firing with a list of bools indicating for each
+        peer whether it was added.
+        """
+        if self.pool is not None and self.pool.isSaturated():
+            return workerpool.fail(workerpool.PoolSaturatedError())
+
+        completions = [workerpool.Completion() for peer in peers]
+        self.__queueWrite(hash, list(peers), completions)
+        return workerpool.gather(completions)
+
+    def __queueWrite(self, hash, peers, completions):
+        """
+        Write the given peers now, or coalesce them into the follow-up
+        write if the torrent is being written.
+        """
+        key = bytes(hash)
+        if key in self._writing:
+            (hash, nextPeers, nextCompletions) = self._nextWrites.setdefault(key, (hash, [], []))
+            nextPeers.extend(peers)
+            nextCompletions.extend(completions)
+        else:
+            self.__write(hash, peers, completions)
+
+    def __write(self, hash, peers, completions):
+        """
+        Write the given peers to the given torrent in one operation.
+        """
+        self._writing.add(bytes(hash))
+        job = self._run(self._addPeers, hash, peers)
+        job.addBoth(self.__writeDone, hash, completions)
+
+    def __writeDone(self, result, hash, completions):
+        """
+        Distribute the result of a write and start the follow-up write, if any.
+        """
+        key = bytes(hash)
+        self._writing.discard(key)
+
+        if isinstance(result, workerpool.Failure):
+            for d in completions:
+                d.errback(result)
+        else:
+            for (d, added) in zip(completions, result):
+                d.callback(added)
+
+        if key in self._nextWrites:
+            (hash, peers, completions) = self._nextWrites.pop(key)
+            self.__write(hash, peers, completions)
+
+    def sampleInfohashes(self):
+        """
+        Get a sample of the info-hashes of the stored torrents for a
+        sample_infohashes response (BEP 51).
+
+        Returns (samples, num, interval): the concatenated 20-byte
+        info-hashes, the number of stored torrents, and the number of
+        seconds to wait before asking for a new sample.
+        """
+        return (self.sample.samples(), self.sample.num(), self.sample.interval())
+
+    def _torrentCreated(self, hash):
+        """
+        Called by the backends (possibly on a worker thread) when a torrent
+        is stored for the first time.
+        """
+        self.sample.add(bytes(hash))
+
+    def _torrentExists(self, hash):
+        raise NotImplementedError()
+
+    def _getPeers(self, hash, family=None):
+        raise NotImplementedError()
+
+    def _addPeers(self, hash, peers):
+        """
+        Add the given peers to the given torrent.
+        Returns a list of bools indicating for each peer whether it was added.
+        """
+        raise NotImplementedError()
+
+class BufferedPeerStorage(_PeerStorage):
+    """
+    Write-behind buffer in front of another peer storage.
+
+    Added peers are kept in memory, grouped by torrent and deduplicated, and
+    written to the underlying storage in bulk: one write per torrent every
+    flush interval, or earlier when the number of buffered peers reaches
+    maxBufferedPeers. Reads merge the buffered peers, and the peers that are
+    being written, with the stored peers.
+    """
+    def __init__(self, storage, flushInterval, maxBufferedPeers):
+        _PeerStorage.__init__(self, storage.maxPeersPerTorrent)
+        self.storage = storage
+        self.flushInterval = flushInterval
+        self.maxBufferedPeers = maxBufferedPeers
+
+        # {hash bytes: (hash, [Peer])}
+        self.buffer = {}
+        self.bufferedPeers = 0
+
+        # Peers taken out of the buffer whose writes have not completed yet
+        # {hash bytes: [[Peer]]}
+        self.writing = {}
+
+        self._callLater = None
+        self._flushCall = None
+
+    def setPool(self, pool):
+        self.storage.setPool(pool)
+
+    def start(self, callLater):
+        """
+        Start flushing periodically, using the given callLater function
+        (e.g., reactor.callLater or loop.call_later).
+        """
+        self._callLater = callLater
+        self._flushCall = callLater(self.flushInterval, self.__periodicFlush)
+
+    def stop(self):
+        """
+        Stop flushing periodically and flush the buffer.
+        Returns a Completion firing once the buffer has been written.
+        """
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flushCall = None
+        return self.flush()
+
+    def __periodicFlush(self):
+        self.flush()
+        self._flushCall = self._callLater(self.flushInterval, self.__periodicFlush)
+
+    def flush(self):
+        """
+        Write all buffered peers to the underlying storage.
+        Returns a Completion firing once the writes have completed.
+
+        Peers that could not be written are put back in the buffer.
+        """
+        buffer = self.buffer
+        self.buffer = {}
+        self.bufferedPeers = 0
+
+        completions = []
+        for (hash, peers) in buffer.values():
+            self.writing.setdefault(bytes(hash), []).append(peers)
+            d = self.storage.addPeers(hash, peers)
+            d.addErrback(self.__flushFailed, hash, peers)
+            d.addBoth(self.__written, hash, peers)
+            completions.append(d)
+        return workerpool.gather(completions)
+
+    def __written(self, result, hash, peers):
+        """
+        Forget the peers of a completed write; failed peers are back in the
+        buffer by now.
+        """
+        writing = self.writing[bytes(hash)]
+        writing.remove(peers)
+        if not writing:
+            del self.writing[bytes(hash)]
+        return result
+
+    def __flushFailed(self, failure, hash, peers):
+        print("flushing announce buffer failed: %s" % failure.getErrorMessage())
+        for peer in peers:
+            self.__buffer(hash, peer)
+
+    def takeBuffered(self):
+        """
+        Take all buffered peers out of the buffer, without writing them.
+        Returns a list of (hash, [Peer]).
+        """
+        buffer = self.buffer
+        self.buffer = {}
+        self.bufferedPeers = 0
+        return list(buffer.values())
+
+    def restoreBuffered(self, buffered):
+        """
+        Put peers taken out with takeBuffered back into the buffer.
+        """
+        for (hash, peers) in buffered:
+            for peer in peers:
+                self.__buffer(hash, peer)
+
+    def __buffer(self, hash, peer):
+        """
+        Add a peer to the buffer. Returns whether the peer was not buffered yet.
+        """
+        (hash, peers) = self.buffer.setdefault(bytes(hash), (hash, []))
+        for (i, bufferedPeer) in enumerate(peers):
+            if bufferedPeer.host == peer.host:
+                # The peer may have become a seeder
+                peers[i] = peer
+                return False
+        peers.append(peer)
+        self.bufferedPeers += 1
+        return True
+
+    def torrentExists(self, hash):
+        if bytes(hash) in self.buffer or bytes(hash) in self.writing:
+            return workerpool.succeed(True)
+        return self.storage.torrentExists(hash)
+
+    def sampleInfohashes(self):
+        # Buffered torrents are sampled once they are written
+        return self.storage.sampleInfohashes()
+
+    def getPeers(self, hash, family=None):
+        d = self.storage.getPeers(hash, family)
+        # A write may complete before the read, but be reported after it;
+        # the peers it wrote are in the snapshot taken now
+        d.addCallback(self.__mergeBuffered, hash, family, self.__unwritten(hash))
+        return d
+
+    def __unwritten(self, hash):
+        """
+        Get the buffered peers and the peers being written of a torrent.
+        """
+        peers = []
+        for writing in self.writing.get(bytes(hash), []):
+            peers.extend(writing)
+        if bytes(hash) in self.buffer:
+            peers.extend(self.buffer[bytes(hash)][1])
+        return peers
+
+    def __mergeBuffered(self, peers, hash, family, unwritten):
+        """
+        Merge the peers of a torrent that were not written when the read
+        started, and those that are not written now, with its stored peers.
+        """
+        buffered = unwritten + self.__unwritten(hash)
+        if buffered:
+            if family is not None:
+                buffered = [peer for peer in buffered if utils.addressFamily(peer.address()) == family]
+            # Peers are identified by address; the latest announce wins
+            merged = collections.OrderedDict((peer.host, peer) for peer in peers)
+            for peer in buffered:
+                merged[peer.host] = peer
+            peers = list(merged.values())
+        return peers[:self.maxPeersPerTorrent]
+
+    def addPeer(self, hash, peer):
+        """
+        Buffer a peer for the given torrent.
+
+        Returns a Completion firing with True once the peer is buffered; it is
+        only known whether the torrent has room for the peer when the buffer
+        is flushed.
+        """
+        if self.bufferedPeers >= self.maxBufferedPeers:
+            self.flush()
+            if self.bufferedPeers >= self.maxBufferedPeers:
+                # Flushing failed; the underlying storage cannot keep up
+                return workerpool.fail(workerpool.PoolSaturatedError())
+
+        self.__buffer(hash, peer)
+        return workerpool.succeed(True)
+
+    def addPeers(self, hash, peers):
+        return workerpool.gather([self.addPeer(hash, peer) for peer in peers])
+
+class MemoryPeerStorage(_PeerStorage):
+    """
+    Stores peers in memory. Peers are lost when the node stops; useful for
+    simulations and nodes that do not need to persist peers.
+    """
+    def __init__(self, maxPeersPerTorrent=6000):
+        _PeerStorage.__init__(self, maxPeersPerTorrent)
+
+        # Peers keyed by address, in the order they were added
+        # {int(hash): {family: {(address, port): Peer}}}
+        self.torrents = {}
+
+    def _torrentExists(self, hash):
+        return int(hash) in self.torrents
+
+    def _getPeers(self, hash, family=None):
+        peersByFamily = self.torrents.get(int(hash), {})
+        if family is None:
+            peers = []
+            for familyPeers in list(peersByFamily.values()):
+                peers.extend(familyPeers.values())
+            return peers
+        return list(peersByFamily.get(family, {}).values())
+
+    def _addPeers(self, hash, newPeers):
+        if int(hash) not in self.torrents:
+            self._torrentCreated(hash)
+        peersByFamily = self.torrents.setdefault(int(hash), {})
+
+        added = []
+        for peer in newPeers:
+            peers = peersByFamily.setdefault(utils.addressFamily(peer.address()), {})
+            if peer.host in peers:
+                # Known address; the peer may have become a seeder
+                peers[peer.host] = peer
+                added.append(False)
+            elif len(peers) >= self.maxPeersPerTorrent:
+                added.append(False)
+            else:
+                peers[peer.host] = peer
+                added.append(True)
+        return added
+
 class MySQLPeerStorage(_PeerStorage):
     """
     Stores peers in and reads peers from a MySQL database.
@@ -30,86 +502,285 @@ class MySQLPeerStorage(_PeerStorage):
 class FilePeerStorage(_PeerStorage):
     """
     Stores peers in and reads peers from files on the disk.
+    
+    Each torrent has a file named after the 40-digit hexadecimal info-hash,
+    fanned out over two levels of directories named after the first two
+    pairs of digits (e.g., ab/cd/abcd...). IPv6 peers are stored in a
+    separate file with the suffix '.6'. Open files are kept in a bounded
+    LRU cache, and the set of tracked torrents is kept in memory, built by
+    walking the storage directory once at start-up.
+    
+    If the storage is shared with other processes (shared=True), torrents
+    created by those processes are not in the in-memory set; for those the
+    disk is checked when a torrent is not found in the set.
     """
-    def __init__(self, storageDir):
-        _PeerStorage.__init__(self)
+    def __init__(self, storageDir, maxOpenFiles=256, shared=False, maxPeersPerTorrent=6000):
+        _PeerStorage.__init__(self, maxPeersPerTorrent)
         self.storageDir = storageDir
+        self.maxOpenFiles = maxOpenFiles
+        self.shared = shared
+        
+        # {file path: (file, lock)}, least recently used first
+        self._files = collections.OrderedDict()
+        self._filesLock = threading.Lock()
+        
+        # Info-hashes (as ints) of the torrents with IPv4 and IPv6 peers
+        (self.torrents, self.torrents6) = self._buildIndex()
+        self.sample.load(hash.to_bytes(20, byteorder='big') for hash in self.torrents | self.torrents6)
+        
+    def _buildIndex(self):
+        """
+        Find all tracked torrents by walking the storage directory.
+        Returns the sets of torrents with IPv4 and with IPv6 peers.
+        """
+        torrents = set()
+        torrents6 = set()
+        if not os.path.isdir(self.storageDir):
+            os.makedirs(self.storageDir)
+            
+        for (dirPath, dirNames, fileNames) in os.walk(self.storageDir):
+            if dirPath == self.storageDir and any(name.startswith('0x') for name in fileNames):
+                print("warning: %s contains torrents in the old flat layout; run migratestorage.py" % self.storageDir)
+                
+            for name in fileNames:
+                try:
+                    if len(name) == 40:
+                        torrents.add(int(name, 16))
+                    elif len(name) == 42 and name.endswith('.6'):
+                        torrents6.add(int(name[:40], 16))
+                except ValueError:
+                    pass
+        return (torrents, torrents6)
+        
+    def _index(self, family):
+        """
+        Get the set of torrents with peers of the given address family.
+        """
+        return self.torrents6 if family == AF_INET6 else self.torrents
     
-    def _filePath(self, hash):
-        return os.path.join(self.storageDir, hex(int(hash)))
+    @staticmethod
+    def _fileName(hash):
+        return '%040x' % int(hash)
+    
+    def _filePath(self, hash, family=AF_INET):
+        name = self._fileName(hash)
+        if family == AF_INET6:
+            return os.path.join(self.storageDir, name[0:2], name[2:4], name + '.6')
+        return os.path.join(self.storageDir, name[0:2], name[2:4], name)
+        
+    def _openFile(self, hash, family):
+        """
+        Get the (file, lock) pair of the given torrent's file for peers of
+        the given address family from the cache of
+        open files, opening the file (and creating it if necessary) if it
+        is not in the cache.
+        
+        The file must only be used while holding the lock, and must be
+        checked for being closed (evicted) after acquiring the lock.
+        """
+        filePath = self._filePath(hash, family)
+        
+        with self._filesLock:
+            if filePath in self._files:
+                self._files.move_to_end(filePath)
+                return self._files[filePath]
+                
+        dirPath = os.path.dirname(filePath)
+        if not os.path.isdir(dirPath):
+            os.makedirs(dirPath, exist_ok=True)
+        entry = (open(filePath, 'a+b'), threading.Lock())
+        
+        evicted = []
+        with self._filesLock:
+            if filePath in self._files:
+                # Opened concurrently by another thread
+                evicted.append(entry)
+                entry = self._files[filePath]
+            else:
+                self._files[filePath] = entry
+            while len(self._files) > self.maxOpenFiles:
+                (path, oldEntry) = self._files.popitem(last=False)
+                evicted.append(oldEntry)
+                
+        for (f, lock) in evicted:
+            with lock:
+                f.close()
+                
+        return entry
+        
+    def close(self):
+        """
+        Close all open files.
+        """
+        with self._filesLock:
+            entries = list(self._files.values())
+            self._files.clear()
+        for (f, lock) in entries:
+            with lock:
+                f.close()
     
     def _decodePeerInfo(self, str):    
-        # Decode peer represented as as a 7-byte string
+        # Decode peer represented as as a 7-byte (IPv4) or 19-byte (IPv6) string
         # https://docs.python.org/2/library/struct.html
-        # Format >4sH?: 
+        # Format >4sH? or >16sH?: 
         # >   - Format using big endian (network byte order)
-        # 4s  - ip address takes 4 bytes
+        # 4s  - IPv4 address takes 4 bytes
+        # 16s - IPv6 address takes 16 bytes
         # H   - ports are unsigned shorts (16 bits; max value of 65535)
         # ?   - bool indicating whether the peer is a seeder (true) or a leecher (false)
+        if len(str) == 19:
+            (ipBytes, port, seeder) = struct.unpack('>16sH?', str)
+            return Peer((inet_ntop(AF_INET6, ipBytes), port), seeder)
+            
         (ipBytes, port, seeder) = struct.unpack('>4sH?', str)
         
-        return Peer((inet_ntoa(ipBytes), port), seeder)
+        return Peer((inet_ntop(AF_INET, ipBytes), port), seeder)
     
-    def _decodePeersInfo(self, str):
+    def _decodePeersInfo(self, str, family=AF_INET):
         """
         Decode all peers.
         """
-        peers = utils.chunks(str, 7)
+        peers = utils.chunks(str, 19 if family == AF_INET6 else 7)
         peers = map(self._decodePeerInfo, peers)
         
         return list(peers)
     
     def _encodePeerInfo(self, peer):
-        # Encode peer represented as as a 7-byte string
+        # Encode peer represented as as a 7-byte (IPv4) or 19-byte (IPv6) string
         # https://docs.python.org/2/library/struct.html
-        # Format >4sH?: 
+        # Format >4sH? or >16sH?: 
         # >   - Format using big endian (network byte order)
-        # 4s  - ip address takes 4 bytes
+        # 4s  - IPv4 address takes 4 bytes
+        # 16s - IPv6 address takes 16 bytes
         # H   - ports are unsigned shorts (16 bits; max value of 65535)
         # ?   - bool indicating whether the peer is a seeder (true) or a leecher (false)
-        str = struct.pack('>4sH?', inet_aton(peer.address()), peer.port(), peer.seeder)
+        if utils.isIPv6(peer.address()):
+            return struct.pack('>16sH?', inet_pton(AF_INET6, peer.address()), peer.port(), peer.seeder)
+            
+        str = struct.pack('>4sH?', inet_pton(AF_INET, peer.address()), peer.port(), peer.seeder)
         
         return str
         
-    def torrentExists(self, hash):
+    def _torrentExists(self, hash):
         """
         Check if we are tracking the given torrent hash
         """
-        filePath = self._filePath(hash)
-        return os.path.isfile(filePath)
+        return self._hasPeers(hash, AF_INET) or self._hasPeers(hash, AF_INET6)
         
-    def getPeers(self, hash):
+    def _hasPeers(self, hash, family):
         """
-        Get the peers associated with the given torrent
+        Check if we have peers of the given address family for the given torrent hash
         """
-        if not self.torrentExists(hash):
-            raise Exception('That torrent is not tracked')
-        filePath = self._filePath(hash)
+        index = self._index(family)
+        if int(hash) in index:
+            return True
+        if self.shared and os.path.isfile(self._filePath(hash, family)):
+            index.add(int(hash))
+            return True
+        return False
         
-        f = open(filePath, 'rb')
-        str = f.read()
-        f.close()
-        return self._decodePeersInfo(str)
+    def _getPeers(self, hash, family=None):
+        """
+        Get the peers associated with the given torrent
+        """
+        if family is None:
+            return self._getPeers(hash, AF_INET) + self._getPeers(hash, AF_INET6)
+            
+        if not self._hasPeers(hash, family):
+            return []
+            
+        while True:
+            (f, lock) = self._openFile(hash, family)
+            with lock:
+                if f.closed:
+                    continue
+                f.seek(0)
+                str = f.read()
+            return self._decodePeersInfo(str, family)
         
-    def addPeer(self, hash, peer):
+    def _addPeers(self, hash, newPeers):
         """
-        Add a peer to the given torrent.
+        Add peers to the given torrent.
         Create the torrent if it is not tracked yet.
         """
-        filePath = self._filePath(hash)
-        if not self.torrentExists(hash):
-            peers = []
-            f = open(filePath, 'wb')
-        else:
-            peers = self.getPeers(hash)
-            f = open(filePath, 'ab')
+        # {family: {(address, port): Peer}}
+        peersByFamily = {}
+        strByFamily = {}
+        # Families whose file is rewritten, because a known peer's seeder
+        # status changed
+        rewrite = set()
         
-        if peer in peers or len(peers) >= appstate.AppState.maxPeersPerTorrent:
-            added = False
-        else:
-            f.write(self._encodePeerInfo(peer))
-            added = True
+        added = []
+        for peer in newPeers:
+            family = utils.addressFamily(peer.address())
+            if family not in peersByFamily:
+                peersByFamily[family] = collections.OrderedDict((knownPeer.host, knownPeer) for knownPeer in self._getPeers(hash, family))
+                strByFamily[family] = b""
+            peers = peersByFamily[family]
             
-        f.close()
+            if peer.host in peers:
+                if peers[peer.host].seeder != peer.seeder:
+                    peers[peer.host] = peer
+                    rewrite.add(family)
+                added.append(False)
+            elif len(peers) >= self.maxPeersPerTorrent:
+                added.append(False)
+            else:
+                strByFamily[family] += self._encodePeerInfo(peer)
+                peers[peer.host] = peer
+                added.append(True)
+        for family in rewrite:
+            strByFamily[family] = b"".join(self._encodePeerInfo(peer) for peer in peersByFamily[family].values())
+
+        # Looking up the peers above indexes torrents created by other
+        # processes sharing the storage
+        created = int(hash) not in self.torrents and int(hash) not in self.torrents6
+        for (family, str) in strByFamily.items():
+            if not str:
+                continue
+            while True:
+                (f, lock) = self._openFile(hash, family)
+                with lock:
+                    if f.closed:
+                        continue
+                    if family in rewrite:
+                        f.truncate(0)
+                    f.write(str)
+                    f.flush()
+                break
+            self._index(family).add(int(hash))
+            if created:
+                self._torrentCreated(hash)
+                created = False
         return added
-        
\ No newline at end of file
+        
+    @staticmethod
+    def migrateFlatLayout(storageDir):
+        """
+        Move torrent files stored in the old flat layout (files named
+        hex(int(hash)) directly in storageDir) to the fanned-out layout.
+        
+        Returns the number of migrated torrents.
+        """
+        migrated = 0
+        for name in os.listdir(storageDir):
+            oldPath = os.path.join(storageDir, name)
+            if not name.startswith('0x') or not os.path.isfile(oldPath):
+                continue
+                
+            newName = FilePeerStorage._fileName(int(name, 16))
+            newDir = os.path.join(storageDir, newName[0:2], newName[2:4])
+            os.makedirs(newDir, exist_ok=True)
+            
+            newPath = os.path.join(newDir, newName)
+            if os.path.exists(newPath):
+                # Both layouts have peers for this torrent; merge them
+                with open(oldPath, 'rb') as f:
+                    str = f.read()
+                with open(newPath, 'ab') as f:
+                    f.write(str)
+                os.remove(oldPath)
+            else:
+                os.rename(oldPath, newPath)
+            migrated += 1
+        return migrated
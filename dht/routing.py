@@ -4,19 +4,39 @@
 Module that provides routing table functionality.
 """
 
+import time
+import heapq
+
 import dht.node
 import dht.bucket
 import hash.hash
-import config
 
 class RoutingTable:  
     """
     Class to represent a routing table.
+    
+    The table starts with a single bucket spanning the whole ID space. 
+    A full bucket is split in two when our own node ID falls in its range;
+    otherwise, new nodes for that bucket are dropped.
+    
+    If an ID verifier (see dht/secureid.py) is given, only nodes with a
+    secure ID for their address are added.
+    
+    If a node cache (see dht/nodecache.py) is given, a node removed from a
+    bucket is replaced by the most recently seen source of queries in the
+    bucket's range; ipv6 gives the address family of the table's nodes.
     """
     
-    def __init__(self, buckets: [dht.bucket.Bucket] = None):
+    def __init__(self, ownNode: dht.node.Node, buckets: [dht.bucket.Bucket] = None, k=8, maxNodesPerBucket=8, maxFailedQueries=2, verifier=None, nodeCache=None, ipv6=False):
+        self.ownNode = ownNode
+        self.k = k
+        self.maxNodesPerBucket = maxNodesPerBucket
+        self.maxFailedQueries = maxFailedQueries
+        self.verifier = verifier
+        self.nodeCache = nodeCache
+        self.ipv6 = ipv6
         if buckets == None:
-            self.buckets = []
+            self.buckets = [dht.bucket.Bucket(0, 2**160 - 1, time.time(), maxNodes=maxNodesPerBucket)]
         else:
             self.buckets = buckets
             
@@ -29,32 +49,87 @@ class RoutingTable:
     def addNode(self, node: dht.node.Node):
         """
         Attempt to add the given node to the routing table.
+        
+        If the node is already in the table, its address is updated and it
+        is marked as most recently seen. Returns whether the node is in the 
+        table.
         """
+        if node.hash == self.ownNode.hash:
+            return False
+        
+        if self.verifier is not None and not self.verifier.isValid(node):
+            return False
         
         bucket = self._findBucket(node)
         if bucket == None:
             raise Exception("Found no bucket for given id")
         
-        if not node in bucket:
-            # We do not have this node on our routing table yet;
-            # attempt to add it.
-            if len(bucket) < MAX_NODES_PER_BUCKET:
-                bucket.append(node)
-            else:
-                if bucket.inRange(myID):
-                    # Our own node's ID is in the appropriate bucket's range,
-                    # split the bucket and recursively attempt to add the node.
-                    self._splitBucket(bucket)
-                    self.addNode(node)
-                else:
-                    # TODO: handle this
-                    pass
+        existing = bucket.findNode(node.hash)
+        if existing != None:
+            existing.host = node.host
+            existing.failedQueries = 0
+            if existing.srtt is None and node.srtt is not None:
+                (existing.srtt, existing.rttvar) = (node.srtt, node.rttvar)
+            bucket.touchNode(existing)
+            return True
+        
+        # We do not have this node on our routing table yet;
+        # attempt to add it.
+        if len(bucket.nodes) < self.maxNodesPerBucket:
+            bucket.addNode(node)
+            return True
+        elif bucket.inRange(self.ownNode):
+            # Our own node's ID is in the appropriate bucket's range,
+            # split the bucket and recursively attempt to add the node.
+            self._splitBucket(bucket)
+            return self.addNode(node)
+        else:
+            # TODO: keep a replacement cache for full buckets
+            return False
+            
+    def removeNode(self, node: dht.node.Node):
+        """
+        Remove the given node from the routing table, if it is in the table.
+        """
+        bucket = self._findBucket(node)
+        existing = bucket.findNode(node.hash)
+        if existing != None:
+            bucket.removeNode(existing)
+            self._refillBucket(bucket)
+            
+    def nodeFailed(self, node: dht.node.Node):
+        """
+        Record that the given node did not answer a query. Nodes that fail
+        to answer MAX_FAILED_QUERIES queries in a row are removed.
+        """
+        bucket = self._findBucket(node)
+        existing = bucket.findNode(node.hash)
+        if existing != None:
+            existing.failedQueries += 1
+            if existing.failedQueries >= self.maxFailedQueries:
+                bucket.removeNode(existing)
+                self._refillBucket(bucket)
+                
+    def _refillBucket(self, bucket):
+        """
+        Add the most recently seen source of queries in the node cache that
+        fits the given bucket, if any, to the bucket.
+        """
+        if self.nodeCache is None:
+            return
+        for node in self.nodeCache.candidates(bucket.low, bucket.high, self.ipv6):
+            if (node.failedQueries < self.maxFailedQueries
+                    and node.hash != self.ownNode.hash
+                    and bucket.findNode(node.hash) == None
+                    and (self.verifier is None or self.verifier.isValid(node))):
+                bucket.addNode(node)
+                return
         
     def _findBucket(self, node):
         """
         Find the appropriate bucket for the given node
         """
-        for bucket in buckets:
+        for bucket in self.buckets:
             if bucket.inRange(node):
                 return bucket
             #if bucket.low <= node and node <= bucket.high:
@@ -66,29 +141,30 @@ class RoutingTable:
         Find a node with the given ID in the routing table.
         """
         for bucket in self.buckets:
-            if bucket.inRange(nodeID):
-                for node in bucket:
-                    if node.hash == target:
-                        return node
-                        
-                return None
+            if bucket.inRange(target):
+                return bucket.findNode(target)
         return None
         
-    def findClosestNodes(self, target: hash.hash.Hash):
+    def findClosestNodes(self, target: hash.hash.Hash, k=None):
         """
         Find the K nodes in the routing table closest to the given target ID.
         """
         # TODO: make more efficient
         # See: http://stackoverflow.com/questions/30654398/implementing-find-node-on-torrent-kademlia-routing-table
+        if k == None:
+            k = self.k
         
         nodes = []
         
         for bucket in self.buckets:
             nodes = nodes + bucket.nodes
 
-        nodes.sort(key=lambda x: nodes.distanceToHash(targetHash))
-
-        return nodes[:config.K]
+        # XOR the integer IDs directly; both are unsigned
+        target = int(target)
+        return heapq.nsmallest(k, nodes, key=lambda node: int(node.hash) ^ target)
+        
+    def __len__(self):
+        return sum(len(bucket.nodes) for bucket in self.buckets)
         
     def _splitBucket(self, bucket):
         """
@@ -100,19 +176,19 @@ class RoutingTable:
         """
         idx = self.buckets.index(bucket)
         self.buckets.pop(idx)
-        middle = int(bucket.low + (bucket.high - bucket.low)/2)
+        middle = int(bucket.low + (bucket.high - bucket.low)//2)
         
-        bucketLow = Bucket(bucket.low, middle, bucket.refreshed)
-        bucketHigh = Bucket(middle+1, bucket.high, refreshed.refreshed)
+        bucketLow = dht.bucket.Bucket(bucket.low, middle, bucket.refreshed, maxNodes=self.maxNodesPerBucket)
+        bucketHigh = dht.bucket.Bucket(middle+1, bucket.high, bucket.refreshed, maxNodes=self.maxNodesPerBucket)
         
         self.buckets.append(bucketLow)
         self.buckets.append(bucketHigh)
         
-        for bucket in bucket.nodes:
-            if bucketLow.inRange(bucket):
-                bucketLow.addNode(bucket)
+        for node in bucket.nodes:
+            if bucketLow.inRange(node):
+                bucketLow.addNode(node)
             else:
-                bucketHigh.addNode(bucket)
+                bucketHigh.addNode(node)
         
         return (bucketLow, bucketHigh)
             
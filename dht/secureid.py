@@ -0,0 +1,153 @@
+"""
+@author Thomas Churchman
+
+Module that provides secure node IDs (BEP 42).
+
+A secure node ID starts with 21 bits derived from the CRC32C checksum of the
+node's (masked) IP address and a 3-bit random number r, which is stored in
+the last byte of the ID. A node cannot pick its ID freely without
+controlling many IP addresses, which makes it harder to crowd the
+routing table with Sybil nodes.
+
+See: http://www.bittorrent.org/beps/bep_0042.html
+"""
+
+import collections
+from socket import inet_pton
+from socket import AF_INET
+from socket import AF_INET6
+
+import utils
+from hash.hash import Hash
+
+V4_MASK = bytes([0x03, 0x0f, 0x3f, 0xff])
+V6_MASK = bytes([0x01, 0x03, 0x07, 0x0f, 0x1f, 0x3f, 0x7f, 0xff])
+
+# Address prefixes (network, prefix length) of local networks, whose nodes
+# are exempt from the ID restriction
+EXEMPT_V4 = [
+    (bytes([10, 0, 0, 0]), 8),
+    (bytes([172, 16, 0, 0]), 12),
+    (bytes([192, 168, 0, 0]), 16),
+    (bytes([169, 254, 0, 0]), 16),
+    (bytes([127, 0, 0, 0]), 8)
+]
+
+def _crc32cTable():
+    table = []
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC32C_TABLE = _crc32cTable()
+
+def crc32c(data):
+    """
+    Calculate the CRC32C (Castagnoli) checksum of the given bytes.
+    """
+    crc = 0xffffffff
+    for byte in data:
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+def isExempt(address):
+    """
+    Check whether a node at the given address is exempt from the ID
+    restriction: nodes on local networks cannot have a secure ID.
+    """
+    if utils.isIPv6(address):
+        return False
+    ip = int.from_bytes(inet_pton(AF_INET, address), byteorder='big')
+    for (network, prefixLength) in EXEMPT_V4:
+        shift = 32 - prefixLength
+        if ip >> shift == int.from_bytes(network, byteorder='big') >> shift:
+            return True
+    return False
+
+def securePrefix(address, r):
+    """
+    Get the checksum the first 21 bits of a secure node ID for the given
+    address and random number r (0-7) are taken from.
+    """
+    if utils.isIPv6(address):
+        (ip, mask) = (inet_pton(AF_INET6, address)[:8], V6_MASK)
+    else:
+        (ip, mask) = (inet_pton(AF_INET, address), V4_MASK)
+    masked = bytearray(a & b for (a, b) in zip(ip, mask))
+    masked[0] |= (r & 0x07) << 5
+    return crc32c(masked)
+
+def generateID(address, seed):
+    """
+    Generate a secure node ID for the given (external) address. The bits
+    that are not determined by the address are taken from the 20-byte
+    seed, so the same seed gives the same ID for the same address.
+    """
+    seed = bytes(seed)
+    r = seed[19] & 0x07
+    crc = securePrefix(address, r)
+
+    id = bytearray(seed)
+    id[0] = (crc >> 24) & 0xff
+    id[1] = (crc >> 16) & 0xff
+    id[2] = ((crc >> 8) & 0xf8) | (seed[2] & 0x07)
+    id[19] = seed[19]
+    return Hash(bytes(id))
+
+def isSecureID(hash, address):
+    """
+    Check whether the given node ID is a secure ID for the given address.
+    """
+    id = bytes(hash)
+    crc = securePrefix(address, id[19])
+    return (id[0] == (crc >> 24) & 0xff
+        and id[1] == (crc >> 16) & 0xff
+        and (id[2] & 0xf8) == (crc >> 8) & 0xf8)
+
+class IDVerifier:
+    """
+    Class to verify the IDs of nodes against their IP addresses.
+
+    The expected 21-bit prefixes are cached per IP address (for each of the
+    eight values of r, as they are needed) in an LRU cache of at most
+    cacheSize addresses, so the checksum is not calculated for every packet.
+    """
+    def __init__(self, cacheSize=65536):
+        self.cacheSize = cacheSize
+
+        # {address: [prefix or None for each r]}, least recently used first
+        self._prefixes = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def isValid(self, node):
+        """
+        Check whether the given node has a secure ID for its address, or
+        is exempt from the ID restriction.
+        """
+        address = node.address()
+        prefixes = self._prefixes.get(address)
+        if prefixes is None:
+            if isExempt(address):
+                return True
+            prefixes = [None] * 8
+            self._prefixes[address] = prefixes
+            if len(self._prefixes) > self.cacheSize:
+                self._prefixes.popitem(last=False)
+        else:
+            self._prefixes.move_to_end(address)
+
+        id = bytes(node.hash)
+        r = id[19] & 0x07
+        prefix = prefixes[r]
+        if prefix is None:
+            self.misses += 1
+            crc = securePrefix(address, r)
+            prefix = prefixes[r] = crc >> 11
+        else:
+            self.hits += 1
+        return int.from_bytes(id[:3], byteorder='big') >> 3 == prefix
@@ -0,0 +1,96 @@
+"""
+@author Thomas Churchman
+
+Module that provides virtual nodes: node IDs hosted by this process.
+
+All virtual nodes share the socket, codec, peer storage and token secret;
+each has its own IPv4 and IPv6 routing table.
+"""
+
+import bisect
+
+import utils
+import dht.routing
+
+class VirtualNode:
+    """
+    Class to represent a node ID hosted by this process, with its routing tables.
+    """
+    def __init__(self, node, k=8, maxNodesPerBucket=8, maxFailedQueries=2, verifier=None, nodeCache=None):
+        self.node = node
+        self.routingTable = dht.routing.RoutingTable(node, None, k, maxNodesPerBucket, maxFailedQueries, verifier, nodeCache)
+        self.routingTable6 = dht.routing.RoutingTable(node, None, k, maxNodesPerBucket, maxFailedQueries, verifier, nodeCache, ipv6=True)
+
+    def routingTableFor(self, address):
+        """
+        Get the routing table for nodes of the address family of the given address.
+        """
+        if utils.isIPv6(address):
+            return self.routingTable6
+        return self.routingTable
+
+    def __repr__(self):
+        return "VirtualNode(node=%r)" % (self.node)
+
+class VirtualNodes:
+    """
+    Class to represent the virtual nodes hosted by this process.
+
+    The first virtual node is the primary node. KRPC queries do not say
+    which node they are addressed to, so queries are dispatched to the
+    virtual node closest to the query's target (see closestTo).
+    """
+    def __init__(self, virtualNodes):
+        self.primary = virtualNodes[0]
+
+        # {hash bytes: VirtualNode}
+        self._byID = dict((bytes(virtualNode.node.hash), virtualNode) for virtualNode in virtualNodes)
+
+        # Virtual nodes sorted by ID, to find the closest one to a target
+        self._sorted = sorted(virtualNodes, key=lambda virtualNode: int(virtualNode.node))
+        self._sortedIDs = [int(virtualNode.node) for virtualNode in self._sorted]
+
+    def find(self, node):
+        """
+        Get the virtual node with the ID of the given node, or the primary
+        node if the ID is not one of ours.
+        """
+        return self._byID.get(bytes(node.hash), self.primary)
+
+    def closestTo(self, target):
+        """
+        Get the virtual node with the ID closest (by XOR distance) to the target ID.
+
+        Walks down the implicit binary trie of the sorted IDs: at each bit,
+        the range of IDs sharing the prefix walked so far is split in IDs
+        with that bit unset and set, and the half matching the target's
+        bit is taken if it is not empty.
+        """
+        target = int(target)
+        ids = self._sortedIDs
+        (low, high) = (0, len(ids))
+        prefix = 0
+        bit = 159
+        while high - low > 1:
+            mask = 1 << bit
+            middle = bisect.bisect_left(ids, prefix | mask, low, high)
+            if target & mask:
+                if middle < high:
+                    low = middle
+                    prefix |= mask
+                else:
+                    high = middle
+            else:
+                if middle > low:
+                    high = middle
+                else:
+                    low = middle
+                    prefix |= mask
+            bit -= 1
+        return self._sorted[low]
+
+    def __iter__(self):
+        return iter(self._sorted)
+
+    def __len__(self):
+        return len(self._sorted)
@@ -0,0 +1,445 @@
+"""
+@author Thomas Churchman
+
+Module that restarts the node without dropping packets, by handing its
+bound UDP sockets and state over to a new process (e.g., to pick up a
+config change or new code).
+
+On SIGUSR2 the running (old) process:
+- closes its admin endpoint and local API listener, so the new process
+  can bind them;
+- listens on a Unix socket at HANDOFF_SOCKET and runs this script again,
+  telling the new process where to find the socket;
+- sends the new process its UDP sockets (as file descriptors, SCM_RIGHTS)
+  and its state: the routing tables, the token secrets, the buffered
+  announces and the transaction ID counter; and
+- keeps serving until the new process reports it is serving, then stops
+  reading from the sockets.
+
+The sockets stay bound throughout, so datagrams arriving during the
+restart queue up in the socket buffer rather than being dropped.
+If the handoff fails before the new process serves, the old process
+listens on its admin endpoint and local API socket again and keeps
+serving.
+
+The old process drains its outstanding queries before exiting: it sends
+no new queries of its own, and the new process forwards datagrams it
+cannot decode (responses to queries it did not send) to the old process
+over the Unix socket. The old process stops once it has no outstanding
+queries, or after twice the query timeout.
+
+Handoff is not supported with several workers (see supervisor.py).
+"""
+
+import os
+import sys
+import array
+import signal
+import struct
+import socket
+import threading
+import subprocess
+from socket import inet_pton
+from socket import inet_ntop
+from socket import AF_INET
+from socket import AF_INET6
+
+import bencodepy
+
+import utils
+import localapi
+from dht.node import Node
+from dht.peer import Peer
+from dht.peerstorage import FilePeerStorage
+from hash.hash import Hash
+
+# Environment variable telling a new process the path of the old process's
+# handoff socket
+HANDOFF_ENV = 'OTDHT_HANDOFF'
+
+# Seconds the old process waits for the new process to connect, and to
+# report it is serving
+CONNECT_TIMEOUT = 30.0
+
+# Interval in seconds at which the old process checks whether it is drained
+DRAIN_CHECK_INTERVAL = 0.1
+
+# Format >HBH: port, length of the packed address and length of a datagram
+# forwarded from the new process to the old process
+FORWARD_HEADER = struct.Struct('>HBH')
+
+# Format >I: length of the serialized state
+STATE_HEADER = struct.Struct('>I')
+
+def isHandoff():
+    """
+    Check whether this process was started to take over from another process.
+    """
+    return HANDOFF_ENV in os.environ
+
+def installSignalHandler(handoff, addSignalHandler=None):
+    """
+    Hand over to a new process on SIGUSR2.
+
+    addSignalHandler (e.g., loop.add_signal_handler) is used to install the
+    handler if given, and signal.signal otherwise.
+    """
+    if not hasattr(signal, 'SIGUSR2'):
+        return
+    if addSignalHandler is not None:
+        addSignalHandler(signal.SIGUSR2, handoff.start)
+    else:
+        signal.signal(signal.SIGUSR2, lambda signum, frame: handoff.start())
+
+def _packAddress(addressPort):
+    (address, port) = addressPort
+    return inet_pton(utils.addressFamily(address), address) + struct.pack('>H', port)
+
+def _unpackAddress(packed):
+    family = AF_INET6 if len(packed) == 18 else AF_INET
+    (port,) = struct.unpack('>H', packed[-2:])
+    return (inet_ntop(family, packed[:-2]), port)
+
+def _recvExactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+def _sendFds(sock, data, fds):
+    """
+    Send data along with the given file descriptors (SCM_RIGHTS).
+    """
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+def _recvFds(sock, size, maxFds):
+    """
+    Receive size bytes of data, and at most maxFds file descriptors sent
+    along with them. Returns (data, [file descriptor]).
+    """
+    fds = array.array('i')
+    (data, ancillary, flags, address) = sock.recvmsg(size, socket.CMSG_LEN(maxFds * fds.itemsize))
+    for (level, type, fdData) in ancillary:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(fdData[:len(fdData) - len(fdData) % fds.itemsize])
+    if not data:
+        raise EOFError()
+    return (data + _recvExactly(sock, size - len(data)), list(fds))
+
+def serializeState(context, protocols, announces):
+    """
+    Serialize the state of the node with the given context to hand it over.
+
+    announces are the announces taken out of the announce buffer
+    ([(hash, [Peer])]); the new process writes them.
+    """
+    tables = []
+    for virtualNode in context.virtualNodes:
+        for (ipv6, routingTable) in [(0, virtualNode.routingTable), (1, virtualNode.routingTable6)]:
+            nodes = [node for bucket in routingTable.buckets for node in bucket.nodes]
+            tables.append([bytes(virtualNode.node.hash), ipv6, b''.join(bytes(node.hash) + _packAddress(node.host) for node in nodes)])
+
+    compactAnnounces = []
+    for (hash, peers) in announces:
+        compactAnnounces.append([bytes(hash), [_packAddress(peer.host) + (b'\x01' if peer.seeder else b'\x00') for peer in peers]])
+
+    (rotatedAt, current, previous) = context.tokenSecrets.state()
+    return bencodepy.encode({
+        'transactionID': max(protocol._nextTransactionID for protocol in protocols.values()),
+        # Bencoding has no floats; milliseconds since the epoch
+        'tokenSecrets': [int(rotatedAt * 1000), current, previous],
+        'tables': tables,
+        'announces': compactAnnounces
+    })
+
+def restoreState(context, state):
+    """
+    Restore state serialized by serializeState into the context of this
+    process. Returns the transaction ID counter of the old process.
+
+    Routing tables are matched to the virtual nodes by ID; the nodes of
+    tables of virtual nodes that no longer exist go to the primary node.
+    """
+    state = bencodepy.decode(state)
+
+    (rotatedAt, current, previous) = state[b'tokenSecrets']
+    context.tokenSecrets.restore(rotatedAt / 1000, current, previous)
+
+    for (virtualID, ipv6, compactNodes) in state[b'tables']:
+        virtualNode = context.virtualNodeOf(Node(Hash(virtualID), context.thisNode.host))
+        routingTable = virtualNode.routingTable6 if ipv6 else virtualNode.routingTable
+        size = 38 if ipv6 else 26
+        for i in range(0, len(compactNodes), size):
+            compactNode = compactNodes[i:i + size]
+            routingTable.addNode(Node(Hash(compactNode[:20]), _unpackAddress(compactNode[20:])))
+
+    for (hash, compactPeers) in state[b'announces']:
+        peers = [Peer(_unpackAddress(compactPeer[:-1]), compactPeer[-1] == 1) for compactPeer in compactPeers]
+        context.peerStorage.addPeers(Hash(hash), peers)
+
+    return state[b'transactionID']
+
+class Handoff:
+    """
+    Class to hand the node over to a new process (the old process's side).
+
+    sockets are the bound UDP sockets ({family: file descriptor}) served by
+    the given KRPC handlers ({family: KRPCHandler}). callLater and
+    callFromThread are those of the event loop. release() is called before
+    the new process starts, to free the admin endpoint and local API
+    socket; stopReading() once the new process serves; and stop() once the
+    old process has drained, to stop the event loop.
+
+    If the handoff fails before the new process serves, reopen() is called
+    to listen on the admin endpoint and local API socket again, the taken
+    announces are put back in the announce buffer, and the old process
+    keeps serving.
+    """
+    def __init__(self, context, path, sockets, protocols, callLater, callFromThread, release, reopen, stopReading, stop):
+        self.context = context
+        self.path = path
+        self.sockets = sockets
+        self.protocols = protocols
+        self.callLater = callLater
+        self.callFromThread = callFromThread
+        self.release = release
+        self.reopen = reopen
+        self.stopReading = stopReading
+        self.stop = stop
+
+        self.process = None
+        self._deadline = None
+        self._thread = None
+        # [(hash, [Peer])]
+        self._announces = []
+
+    def start(self):
+        """
+        Start a new process and hand the node over to it.
+        """
+        if self._thread is not None:
+            print("handoff already in progress")
+            return
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            localapi._removeStaleSocket(self.path)
+            listener.bind(self.path)
+        except Exception as e:
+            listener.close()
+            print("handoff failed: %s" % e)
+            return
+        listener.listen(1)
+        listener.settimeout(CONNECT_TIMEOUT)
+
+        self.release()
+
+        env = dict(os.environ)
+        env[HANDOFF_ENV] = self.path
+        try:
+            self.process = subprocess.Popen([sys.executable] + sys.argv, env=env)
+        except OSError as e:
+            listener.close()
+            os.unlink(self.path)
+            self.__failed("could not start the new process: %s" % e)
+            return
+        print("handing over to process %d" % self.process.pid)
+
+        self._thread = threading.Thread(target=self.__run, args=(listener,), name='Handoff')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __run(self, listener):
+        """
+        Hand over the sockets and state, and receive forwarded datagrams
+        (runs on the handoff thread).
+        """
+        try:
+            (connection, address) = listener.accept()
+        except socket.timeout:
+            self.callFromThread(self.__failed, "the new process did not connect")
+            return
+        finally:
+            listener.close()
+            os.unlink(self.path)
+
+        with connection:
+            # The state is serialized on the event loop thread
+            serialized = []
+            done = threading.Event()
+            def serialize():
+                try:
+                    if hasattr(self.context.peerStorage, 'takeBuffered'):
+                        self._announces = self.context.peerStorage.takeBuffered()
+                    serialized.append(serializeState(self.context, self.protocols, self._announces))
+                finally:
+                    done.set()
+            self.callFromThread(serialize)
+            done.wait()
+            if not serialized:
+                self.callFromThread(self.__failed, "could not serialize the state")
+                return
+            state = serialized[0]
+
+            try:
+                connection.settimeout(CONNECT_TIMEOUT)
+                families = sorted(self.sockets)
+                _sendFds(connection, STATE_HEADER.pack(len(state)), [self.sockets[family] for family in families])
+                connection.sendall(state)
+                _recvExactly(connection, 1)
+            except (EOFError, OSError):
+                self.callFromThread(self.__failed, "the new process did not report serving")
+                return
+            connection.settimeout(None)
+            self.callFromThread(self.__takenOver)
+
+            while True:
+                try:
+                    (port, addressLength, length) = FORWARD_HEADER.unpack(_recvExactly(connection, FORWARD_HEADER.size))
+                    packed = _recvExactly(connection, addressLength)
+                    data = _recvExactly(connection, length)
+                except (EOFError, OSError):
+                    return
+                addressPort = (inet_ntop(AF_INET6 if addressLength == 16 else AF_INET, packed), port)
+                self.callFromThread(self.__forwarded, data, addressPort)
+
+    def __failed(self, reason):
+        """
+        Keep serving after a failed handoff.
+        """
+        print("handoff failed: %s" % reason)
+        self._thread = None
+        # Reaps the new process if it exited; it must not serve the sockets
+        # it may have received
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+        if self._announces:
+            self.context.peerStorage.restoreBuffered(self._announces)
+            self._announces = []
+        try:
+            self.reopen()
+        except Exception as e:
+            print("could not listen again: %s" % e)
+
+    def __takenOver(self):
+        """
+        Stop serving, and drain the outstanding queries.
+        """
+        print("process %d is serving; draining %d outstanding queries" % (self.process.pid, len(self.context.outstandingQueries)))
+        self._announces = []
+        self.stopReading()
+        if self.context.crawler is not None:
+            self.context.crawler.stop()
+        if self.context.announcer is not None:
+            self.context.announcer.stop()
+        self._deadline = self.protocols[AF_INET]._seconds() + 2 * self.context.queryTimeout
+        self.__checkDrained()
+
+    def __checkDrained(self):
+        if not self.context.outstandingQueries or self.protocols[AF_INET]._seconds() >= self._deadline:
+            print("drained; stopping")
+            self.stop()
+            return
+        self.callLater(DRAIN_CHECK_INTERVAL, self.__checkDrained)
+
+    def __forwarded(self, data, addressPort):
+        family = utils.addressFamily(addressPort[0])
+        if family in self.protocols:
+            self.protocols[family].datagramReceived(data, addressPort)
+
+class Takeover:
+    """
+    Class to take the node over from an old process (the new process's side).
+
+    Connects to the old process's handoff socket and receives its sockets
+    ({family: socket}) and state.
+
+    Datagrams are forwarded to the old process without blocking the event
+    loop; those that do not fit in the connection's buffer while the old
+    process does not keep up are dropped, and counted in dropped.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.pop(HANDOFF_ENV)
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(path)
+
+        (header, fds) = _recvFds(self.connection, STATE_HEADER.size, 2)
+        (length,) = STATE_HEADER.unpack(header)
+        self.state = _recvExactly(self.connection, length)
+
+        self.sockets = {}
+        for fd in fds:
+            sock = socket.socket(fileno=fd)
+            sock.setblocking(False)
+            self.sockets[sock.family] = sock
+
+        self.context = None
+        self._storage = None
+        # Part of a forwarded datagram that did not fit in the buffer
+        self._unsent = b''
+        self.dropped = 0
+
+    def restore(self, context, protocols):
+        """
+        Restore the old process's state into the given context. The KRPC
+        handlers continue the old process's transaction IDs half the ID
+        space further, so they do not collide with those the old process
+        sends while it drains.
+        """
+        self.context = context
+        transactionID = restoreState(context, self.state)
+        for protocol in protocols.values():
+            protocol._nextTransactionID = (transactionID + 2**15) % 2**16
+
+        # Torrents the old process creates while it drains are not in the
+        # index of a file storage built at start-up; look for those on the
+        # disk until forwarding stops
+        storage = getattr(context.peerStorage, 'storage', context.peerStorage)
+        if isinstance(storage, FilePeerStorage) and not storage.shared:
+            self._storage = storage
+            storage.shared = True
+
+    def ready(self, callLater):
+        """
+        Tell the old process this process is serving. Datagrams that cannot
+        be decoded are forwarded to the old process while it drains.
+        """
+        self.connection.sendall(b'R')
+        self.connection.setblocking(False)
+        self.context.handoffForward = self.__forward
+        callLater(2 * self.context.queryTimeout + 1, self.__stopForwarding)
+
+    def __forward(self, data, addressPort):
+        if self._unsent:
+            self.__send()
+        if self._unsent:
+            self.dropped += 1
+            return
+        packed = _packAddress(addressPort)[:-2]
+        self._unsent = FORWARD_HEADER.pack(addressPort[1], len(packed), len(data)) + packed + data
+        self.__send()
+
+    def __send(self):
+        try:
+            sent = self.connection.send(self._unsent)
+        except BlockingIOError:
+            return
+        except OSError:
+            # The old process has stopped
+            self.__stopForwarding()
+            return
+        self._unsent = self._unsent[sent:]
+
+    def __stopForwarding(self):
+        if self.context.handoffForward is not None:
+            self.context.handoffForward = None
+            self.connection.close()
+            if self.dropped:
+                print("dropped %d datagrams forwarded to the old process" % self.dropped)
+        if self._storage is not None:
+            self._storage.shared = False
+            self._storage = None
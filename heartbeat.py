@@ -2,11 +2,13 @@
 @author Thomas Churchman
 """
 
-from appstate import AppState
-
-def heartbeat(reactor):
+def heartbeat(callLater, context):
     """
     Heartbeat in which to perform periodic tasks, 
-    such as keeping the routing table fresh.
+    such as rotating the token secrets.
+    
+    callLater (e.g., reactor.callLater or loop.call_later) schedules the
+    next heartbeat of the node with the given context.
     """
-    reactor.callLater(AppState.heartbeat, heartbeat, reactor)
\ No newline at end of file
+    context.tokenSecrets.rotate()
+    callLater(context.heartbeat, heartbeat, callLater, context)
\ No newline at end of file
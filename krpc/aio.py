@@ -0,0 +1,90 @@
+"""
+@author Thomas Churchman
+
+Module that processes and sends KRPC messages using asyncio.
+
+This module does not depend on Twisted, which keeps the start-up time and
+memory footprint of short-lived nodes (e.g., crawlers) down. If uvloop is
+installed, run() uses it as the event loop.
+"""
+
+import asyncio
+
+from krpc.handler import KRPCHandler
+
+class AsyncKRPC(KRPCHandler, asyncio.DatagramProtocol):
+    """
+    Handles sending and receiving KRPC messages on an asyncio event loop.
+    
+    Outbound queries sent with sendQuery return a Future; query() is a
+    coroutine that sends a query and returns the response.
+    """
+    def __init__(self, loop=None, context=None):
+        KRPCHandler.__init__(self, context)
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+        
+    def connection_made(self, transport):
+        self.transport = transport
+        
+    def datagram_received(self, data, addressPort):
+        # IPv6 addresses come with flow info and scope ID; drop those
+        self.datagramReceived(data, addressPort[:2])
+        
+    def error_received(self, exc):
+        pass
+        
+    def _sendDatagram(self, data, addressPort):
+        self.transport.sendto(data, addressPort)
+        
+    def _callLater(self, delay, f, *args):
+        return self.loop.call_later(delay, f, *args)
+        
+    def _seconds(self):
+        return self.loop.time()
+        
+    def _createWaiter(self):
+        return self.loop.create_future()
+        
+    def _fireWaiter(self, waiter, result):
+        if not waiter.done():
+            waiter.set_result(result)
+            
+    def _failWaiter(self, waiter, exception):
+        if not waiter.done():
+            waiter.set_exception(exception)
+            
+    def whenAnswered(self, waiter, callback, errback):
+        def done(future):
+            if future.exception() is not None:
+                errback(future.exception())
+            else:
+                callback(future.result())
+        waiter.add_done_callback(done)
+    
+    async def query(self, krpcQuery, timeout=None):
+        """
+        Send a KRPC query and wait for the response.
+        """
+        return await self.sendQuery(krpcQuery, timeout)
+        
+def installUVLoop():
+    """
+    Use uvloop as the asyncio event loop if it is installed.
+    Returns whether uvloop is used.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+    
+def listen(loop, protocol, port=None, sock=None):
+    """
+    Start serving the given protocol on the given UDP port, or on the given
+    bound socket. Returns a coroutine yielding (transport, protocol).
+    """
+    if sock is not None:
+        return loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+    return loop.create_datagram_endpoint(lambda: protocol, local_addr=('0.0.0.0', port))
@@ -0,0 +1,462 @@
+"""
+@author Thomas Churchman
+
+Module that processes and sends KRPC messages, independent of the
+event loop that delivers the datagrams.
+"""
+
+import struct
+import time
+
+import utils
+import workerpool
+import krpc.krpccoder
+from dht.node import Node
+
+class KRPCTimeoutError(Exception):
+    """
+    Raised when an outbound query is not answered in time.
+    """
+    def __init__(self, krpcQuery):
+        Exception.__init__(self, 'Query timed out')
+        self.query = krpcQuery
+        
+class KRPCErrorReceived(Exception):
+    """
+    Raised when an outbound query is answered with a KRPC error.
+    """
+    def __init__(self, krpcError):
+        Exception.__init__(self, 'Received error %r: %r' % (krpcError.errorCode, krpcError.errorMessage))
+        self.error = krpcError
+
+class KRPCHandler:
+    """
+    Handles sending and receiving KRPC messages.
+    
+    Subclasses bind the handler to an event loop by implementing
+    _sendDatagram, _callLater, _createWaiter, _fireWaiter and _failWaiter,
+    and may override _seconds to use the event loop's clock.
+    
+    The handler serves the node with the given context (a NodeContext);
+    by default, the context of AppState.
+    
+    Example: https://github.com/gsko/mdht/blob/master/mdht/protocols/krpc_sender.py
+    """
+    def __init__(self, context=None):
+        if context is None:
+            import appstate
+            context = appstate.AppState.context
+        self.context = context
+        
+        # {transactionID: (waiter, delayedTimeoutCall, delayedSlowCall or None)}
+        self._waiters = {}
+        # Transaction IDs of queries that were sent again
+        self._retransmitted = set()
+        self._nextTransactionID = 0
+        
+    def _sendDatagram(self, data, addressPort):
+        """
+        Send a datagram to the given address.
+        """
+        raise NotImplementedError()
+        
+    def _callLater(self, delay, f, *args):
+        """
+        Schedule f(*args) to be called after delay seconds.
+        Returns an object with a cancel() method.
+        """
+        raise NotImplementedError()
+        
+    def _seconds(self):
+        """
+        Get the current time in seconds, used to measure round-trip times.
+        """
+        return time.time()
+        
+    def _createWaiter(self):
+        """
+        Create an object (e.g., a Deferred or Future) that fires
+        when an outbound query is answered.
+        """
+        raise NotImplementedError()
+        
+    def _fireWaiter(self, waiter, result):
+        raise NotImplementedError()
+        
+    def _failWaiter(self, waiter, exception):
+        raise NotImplementedError()
+        
+    def whenAnswered(self, waiter, callback, errback):
+        """
+        Call callback(response) when the query the waiter was returned for
+        is answered, or errback(exception) when the query fails.
+        """
+        raise NotImplementedError()
+        
+    def datagramReceived(self, data, addressPort):
+        """
+        Process a received datagram.
+        """
+        (address, port) = addressPort
+
+        if self.context.capture is not None:
+            self.context.capture.write(self._seconds(), data, addressPort)
+
+        if self.context.logPackets:
+            print("received %r from %s:%d" % (data, address, port))
+
+        try:
+            message = krpc.krpccoder.decode(data, (address, port), self.context)
+        except:
+            if self.context.logPackets:
+                print("received malformed packet")
+            if self.context.handoffForward is not None:
+                # Possibly a response to a query of the process this
+                # process took over from (see handoff.py)
+                self.context.handoffForward(data, addressPort)
+            return
+            
+        if self.context.logPackets:
+            print(message)
+            
+        self._krpcReceived(message)
+        
+    def datagramsReceived(self, datagrams):
+        """
+        Called by batching transports with a list of (data, (address, port)) tuples.
+        
+        Replies written while processing the batch are flushed by the
+        transport once the whole batch has been handled.
+        """
+        for (data, addressPort) in datagrams:
+            self.datagramReceived(data, addressPort)
+           
+    def _krpcReceived(self, krpcMessage):
+        """
+        Process a KRPC message.
+        
+        Nodes that send us a valid query or response are added to the
+        routing table.
+        """
+        if isinstance(krpcMessage, krpc.krpccoder.KRPCQuery):
+            self.__addNode(krpcMessage)
+            self.__krpcQueryReceived(krpcMessage)
+        elif isinstance(krpcMessage, krpc.krpccoder.KRPCResponse):
+            self.__addNode(krpcMessage)
+            self.__krpcResponseReceived(krpcMessage)
+        elif isinstance(krpcMessage, krpc.krpccoder.KRPCError):
+            self.__krpcErrorReceived(krpcMessage)
+            
+    def __addNode(self, krpcMessage):
+        """
+        Add the sender of a message to the routing table of the (virtual)
+        node the message was addressed to.
+        """
+        virtualNode = self.context.virtualNodeOf(krpcMessage.toNode)
+        virtualNode.routingTableFor(krpcMessage.fromNode.address()).addNode(krpcMessage.fromNode)
+            
+    def __krpcQueryReceived(self, krpcQuery):
+        """
+        Process a KRPC query.
+        """
+        if self.context.crawler is not None:
+            self.context.crawler.queryReceived(krpcQuery)
+            
+        if krpcQuery.type == b'ping':
+            self.__krpcQueryPingReceived(krpcQuery)
+        elif krpcQuery.type == b'find_node':
+            self.__krpcQueryFindNodeReceived(krpcQuery)
+        elif krpcQuery.type == b'get_peers':
+            self.__krpcQueryGetPeersReceived(krpcQuery)
+        elif krpcQuery.type == b'announce_peer':
+            self.__krpcQueryAnnouncePeerReceived(krpcQuery)
+        elif krpcQuery.type == b'sample_infohashes':
+            self.__krpcQuerySampleInfohashesReceived(krpcQuery)
+        else:
+            response = krpc.krpccoder.KRPCError.fromQuery(krpcQuery, errorCode=204, errorMessage=b"Method Unknown")
+            self._krpcSend(response)
+        
+    def __krpcResponseReceived(self, krpcResponse):
+        """
+        Process a KRPC response to one of our queries.
+        """
+        outstanding = self.context.outstandingQueries.pop(krpcResponse.transactionID, None)
+        if outstanding is not None:
+            (krpcQuery, toNode, timestamp) = outstanding
+            # The round-trip time of a query that was sent again is
+            # ambiguous (Karn's algorithm)
+            if krpcResponse.transactionID in self._retransmitted:
+                self._retransmitted.discard(krpcResponse.transactionID)
+            else:
+                self.__addRTTSample(toNode, krpcResponse.fromNode, self._seconds() - timestamp)
+        
+        if krpcResponse.transactionID in self._waiters:
+            (waiter, timeoutCall, slowCall) = self._waiters.pop(krpcResponse.transactionID)
+            self.__cancelCalls(timeoutCall, slowCall)
+            self._fireWaiter(waiter, krpcResponse)
+        
+    def __krpcErrorReceived(self, krpcError):
+        """
+        Process a KRPC error sent in reply to one of our queries.
+        """
+        self.context.outstandingQueries.pop(krpcError.transactionID, None)
+        self._retransmitted.discard(krpcError.transactionID)
+        
+        if krpcError.transactionID in self._waiters:
+            (waiter, timeoutCall, slowCall) = self._waiters.pop(krpcError.transactionID)
+            self.__cancelCalls(timeoutCall, slowCall)
+            self._failWaiter(waiter, KRPCErrorReceived(krpcError))
+            
+    def __krpcQueryTimedOut(self, transactionID):
+        """
+        Called when an outbound query has not been answered in time.
+        """
+        (krpcQuery, toNode, timestamp) = self.context.outstandingQueries.pop(transactionID)
+        self._retransmitted.discard(transactionID)
+        self.context.rttStats.addTimeout()
+        self.context.virtualNodeOf(krpcQuery.fromNode).routingTableFor(toNode.address()).nodeFailed(toNode)
+        (waiter, timeoutCall, slowCall) = self._waiters.pop(transactionID)
+        if slowCall is not None:
+            slowCall.cancel()
+        self._failWaiter(waiter, KRPCTimeoutError(krpcQuery))
+        
+    def __addRTTSample(self, toNode, fromNode, rtt):
+        """
+        Record the round-trip time of a query. The node the query was sent
+        to may be a copy (e.g., from a lookup) of the node in the routing
+        table, which is the node the response is attributed to.
+        """
+        self.context.rttStats.add(rtt)
+        toNode.addRTTSample(rtt)
+        if fromNode is not toNode:
+            fromNode.addRTTSample(rtt)
+            
+    def __cancelCalls(self, timeoutCall, slowCall):
+        timeoutCall.cancel()
+        if slowCall is not None:
+            slowCall.cancel()
+            
+    def __queryTimeouts(self, krpcQuery):
+        """
+        Get the timeouts of a query: the time after which the query is
+        slow and sent again, and the time after which it has failed.
+        
+        Both are derived from the round-trip times of the node the query is
+        sent to (or of the node with its ID in the routing table): as TCP
+        does, the query is sent again after the retransmission timeout,
+        and fails after twice that timeout more. Nodes that have not
+        answered before get the full query timeout; their query is slow
+        after the timeout estimated from the round-trip times of all nodes.
+        """
+        (minimum, maximum) = (self.context.minQueryTimeout, self.context.queryTimeout)
+        toNode = krpcQuery.toNode
+        if toNode.srtt is None:
+            known = self.context.virtualNodeOf(krpcQuery.fromNode).routingTableFor(toNode.address()).findNode(toNode.hash)
+            if known is not None and known.host == toNode.host:
+                toNode = known
+        if toNode.srtt is None:
+            return (self.context.rttStats.queryTimeout(minimum, maximum), maximum)
+        timeout = toNode.queryTimeout(minimum, maximum)
+        return (timeout, min(maximum, 3 * timeout))
+        
+    def __krpcQuerySlow(self, krpcQuery, onSlow):
+        """
+        Called when an outbound query has not been answered in the usual time.
+        """
+        self._retransmitted.add(krpcQuery.transactionID)
+        self.context.rttStats.addRetransmission()
+        self._krpcSend(krpcQuery)
+        if onSlow is not None:
+            onSlow()
+        
+    def _newTransactionID(self):
+        """
+        Generate a transaction ID that is not in use by an outstanding query.
+        """
+        while True:
+            self._nextTransactionID = (self._nextTransactionID + 1) % 2**16
+            transactionID = struct.pack('>H', self._nextTransactionID)
+            if transactionID not in self.context.outstandingQueries:
+                return transactionID
+        
+    def sendQuery(self, krpcQuery, timeout=None, onSlow=None):
+        """
+        Send a KRPC query to krpcQuery.toNode.
+        
+        A transaction ID is assigned to the query. Returns a waiter (a
+        Deferred or Future, depending on the event loop) that fires with the
+        KRPCResponse, or fails with KRPCErrorReceived or KRPCTimeoutError.
+        
+        By default, the timeouts are derived from the round-trip times of
+        the node (see Node.queryTimeout). A query that is not answered in
+        the usual time is sent once more. If onSlow is given, onSlow() is
+        then called as well, so the caller (e.g., a lookup) can query other
+        nodes while still waiting for the answer.
+        """
+        krpcQuery.transactionID = self._newTransactionID()
+        if krpcQuery.fromNode is None:
+            krpcQuery.fromNode = self.context.thisNode
+            
+        (slowTimeout, failTimeout) = self.__queryTimeouts(krpcQuery)
+        if timeout is None:
+            timeout = failTimeout
+        self.context.rttStats.querySent(timeout)
+            
+        waiter = self._createWaiter()
+        timeoutCall = self._callLater(timeout, self.__krpcQueryTimedOut, krpcQuery.transactionID)
+        slowCall = None
+        if slowTimeout < timeout:
+            slowCall = self._callLater(slowTimeout, self.__krpcQuerySlow, krpcQuery, onSlow)
+        self.context.outstandingQueries[krpcQuery.transactionID] = (krpcQuery, krpcQuery.toNode, self._seconds())
+        self._waiters[krpcQuery.transactionID] = (waiter, timeoutCall, slowCall)
+        
+        self._krpcSend(krpcQuery)
+        return waiter
+        
+    def __krpcQueryPingReceived(self, krpcQuery):
+        """
+        Process a KRPC ping query.
+        """
+        response = krpc.krpccoder.KRPCResponse.fromQuery(krpcQuery)
+        self._krpcSend(response)
+        
+    def __krpcQueryFindNodeReceived(self, krpcQuery):
+        """
+        Process a find_node query.
+        """
+        response = krpc.krpccoder.KRPCResponse.fromQuery(krpcQuery)
+        self.__addClosestNodes(response, krpcQuery)
+        self._krpcSend(response)
+        
+    def __addClosestNodes(self, response, krpcQuery):
+        """
+        Add the target node or the K closest nodes to the query target to the
+        response, from the IPv4 and/or IPv6 routing tables as wanted by the
+        querying node (BEP 32). The routing tables of the (virtual) node
+        the query was addressed to are used. If none of the wanted address
+        families is served, the nodes of the family the query arrived on
+        are returned.
+        """
+        target = krpcQuery.targetID
+        virtualNode = self.context.virtualNodeOf(response.fromNode)
+        
+        want = set(krpcQuery.want) & set([b'n4', b'n6'] if self.context.ipv6 else [b'n4'])
+        if not want:
+            want = set([b'n6'] if utils.isIPv6(krpcQuery.fromNode.address()) else [b'n4'])
+        
+        if b'n4' in want:
+            targetNode = virtualNode.routingTable.findNode(target)
+            if targetNode:
+                response.nodes = [targetNode]
+            else:
+                response.nodes = virtualNode.routingTable.findClosestNodes(target)
+            
+        if b'n6' in want:
+            targetNode = virtualNode.routingTable6.findNode(target)
+            if targetNode:
+                response.nodes6 = [targetNode]
+            else:
+                response.nodes6 = virtualNode.routingTable6.findClosestNodes(target)
+            
+        
+    def __krpcQueryGetPeersReceived(self, krpcQuery):
+        """
+        Process a KRPC get_peers query.
+        
+        The response is sent once the peer storage has looked up the peers.
+        """
+        family = utils.addressFamily(krpcQuery.fromNode.address())
+        d = self.context.peerStorage.getPeers(krpcQuery.targetID, family)
+        d.addCallback(self.__sendGetPeersResponse, krpcQuery)
+        d.addErrback(self.__storageFailed, krpcQuery)
+        
+    def __sendGetPeersResponse(self, peers, krpcQuery):
+        """
+        Send a get_peers response with the peers found for the torrent,
+        or with the closest nodes if we are not tracking the torrent.
+        
+        Only peers of the address family the query was received over are sent.
+        """
+        response = krpc.krpccoder.KRPCResponse.fromQuery(krpcQuery)
+        response.token = utils.getToken(krpcQuery.fromNode, self.context.tokenSecrets.current())
+        
+        if peers:
+            if krpcQuery.noSeeders:
+                peers = [peer for peer in peers if not peer.seeder]
+            response.peers = peers
+        else:
+            self.__addClosestNodes(response, krpcQuery)
+            
+        self._krpcSend(response)
+            
+    def __krpcQueryAnnouncePeerReceived(self, krpcQuery):
+        """
+        Process a KRPC announce peer query.
+        
+        The response is sent once the peer storage has stored the peer.
+        """
+        if utils.isTokenValid(krpcQuery.fromNode, krpcQuery.token, self.context.tokenSecrets):
+            d = self.context.peerStorage.addPeer(krpcQuery.targetID, krpcQuery.peer)
+            d.addCallback(lambda added: self._krpcSend(krpc.krpccoder.KRPCResponse.fromQuery(krpcQuery)))
+            d.addErrback(self.__storageFailed, krpcQuery)
+        else:
+            response = krpc.krpccoder.KRPCError.fromQuery(krpcQuery, errorCode=203, errorMessage=b"Invalid token")
+            self._krpcSend(response)
+            
+    def __krpcQuerySampleInfohashesReceived(self, krpcQuery):
+        """
+        Process a sample_infohashes query (BEP 51): respond with a sample of
+        the stored info-hashes and the closest nodes to the target.
+        """
+        response = krpc.krpccoder.KRPCResponse.fromQuery(krpcQuery)
+        (response.samples, response.num, response.interval) = self.context.peerStorage.sampleInfohashes()
+        self.__addClosestNodes(response, krpcQuery)
+        self._krpcSend(response)
+            
+    def __storageFailed(self, failure, krpcQuery):
+        """
+        Answer a query with a server error when the peer storage failed
+        or is too busy to handle the query.
+        """
+        if failure.check(workerpool.PoolSaturatedError):
+            errorMessage = b"Server busy"
+        else:
+            print("peer storage failed: %s" % failure.getErrorMessage())
+            errorMessage = b"Server error"
+            
+        response = krpc.krpccoder.KRPCError.fromQuery(krpcQuery, errorCode=202, errorMessage=errorMessage)
+        self._krpcSend(response)
+        
+    def _krpcSend(self, krpcMessage):
+        if isinstance(krpcMessage, krpc.krpccoder.KRPCQuery):
+            self.__krpcSendQuery(krpcMessage)
+        elif isinstance(krpcMessage, krpc.krpccoder.KRPCResponse):
+            self.__krpcSendResponse(krpcMessage)
+        elif isinstance(krpcMessage, krpc.krpccoder.KRPCError):
+            self.__krpcSendError(krpcMessage)
+        
+    def __krpcSendQuery(self, krpcQuery):
+        query = krpc.krpccoder.encode(krpcQuery)
+        self._sendDatagram(query, krpcQuery.toNode.host)
+        
+        
+    def __krpcSendResponse(self, krpcResponse):
+        """
+        Send a response, fit in the response budget of the address family
+        of the querying node.
+        """
+        if utils.isIPv6(krpcResponse.toNode.address()):
+            budget = self.context.responseBudget6
+        else:
+            budget = self.context.responseBudget
+        response = krpc.krpccoder.encode(krpcResponse, budget)
+        
+        self.context.responsesSent[krpcResponse.type] += 1
+        if krpcResponse.truncated:
+            self.context.responsesTruncated[krpcResponse.type] += 1
+        self._sendDatagram(response, krpcResponse.toNode.host)
+    
+    def __krpcSendError(self, krpcError):
+        error = krpc.krpccoder.encode(krpcError)
+        self._sendDatagram(error, krpcError.toNode.host)
+        
\ No newline at end of file
@@ -1,142 +1,41 @@
 """
 @author Thomas Churchman
 
-Module that processes and sends KRPC messages.
+Module that processes and sends KRPC messages using Twisted.
 """
 
 from twisted.internet.protocol import DatagramProtocol
+from twisted.internet import defer
 from twisted.internet import reactor
 
-from appstate import AppState
-import utils
-import krpc.krpccoder
-from dht.node import Node
+from krpc.handler import KRPCHandler
 
-class KRPC(DatagramProtocol):
+class KRPC(KRPCHandler, DatagramProtocol):
     """
-    Handles sending and receiving KRPC messages.
+    Handles sending and receiving KRPC messages on a Twisted reactor.
     
-    Example: https://github.com/gsko/mdht/blob/master/mdht/protocols/krpc_sender.py
+    Outbound queries sent with sendQuery return a Deferred.
     """
-    def datagramReceived(self, data, addressPort):
-        """
-        Called by Twisted.
-        """
-        (address, port) = addressPort
-
-        print("received %r from %s:%d" % (data, address, port))
-
-        try:
-            message = krpc.krpccoder.decode(data, (address, port))
-            print(message)
-        except:
-            print("received malformed packet")
-            return
-            
-        self._krpcReceived(message)
-           
-    def _krpcReceived(self, krpcMessage):
-        """
-        Process a KRPC message.
-        """
-        if isinstance(krpcMessage, krpc.krpccoder.KRPCQuery):
-            self.__krpcQueryReceived(krpcMessage)
-        elif isinstance(krpcMessage, krpc.krpccoder.KRPCResponse):
-            self.__krpcResponseReceived(krpcMessage)
-        elif isinstance(krpcMessage, krpc.krpccoder.KRPCError):
-            self.__krpcErrorReceived(krpcMessage)
-            
-    def __krpcQueryReceived(self, krpcQuery):
-        """
-        Process a KRPC query.
-        """
-        if krpcQuery.type == b'ping':
-            self.__krpcQueryPingReceived(krpcQuery)
-        elif krpcQuery.type == b'find_node':
-            self.__krpcQueryFindNodeReceived(krpcQuery)
-        elif krpcQuery.type == b'get_peers':
-            self.__krpcQueryGetPeersReceived(krpcQuery)
-        elif krpcQuery.type == b'announce_peer':
-            self.__krpcQueryAnnouncePeerReceived(krpcQuery)
-        
-    def __krpcResponseReceived(self, krpcResponse):
-        pass
-        
-    def __krpcErrorReceived(self, krpcError):
-        pass
-        
-    def __krpcQueryPingReceived(self, krpcQuery):
-        """
-        Process a KRPC ping query.
-        """
-        response = krpc.krpccoder.KRPCResponse.fromQuery(krpcQuery)
-        self._krpcSend(response)
+    def __init__(self, context=None):
+        KRPCHandler.__init__(self, context)
         
-    def __krpcQueryFindNodeReceived(self, krpcQuery):
-        """
-        Process a find_node query.
-        """
-        response = krpc.krpccoder.KRPCResponse.fromQuery(krpcQuery)
-
-        target = krpcQuery.targetID
-        targetNode = AppState.routingTable.findNode(target)
-
-        if targetNode:
-            response.nodes = [targetNode]
-        else:
-            kClosestTargets = AppState.routingTable.findClosestNodes(target)
-            response.nodes = kClosestTargets
-
-        self._krpcSend(response)
-            
+    def _sendDatagram(self, data, addressPort):
+        self.transport.write(data, addressPort)
         
-    def __krpcQueryGetPeersReceived(self, krpcQuery):
-        """
-        Process a KRPC get_peers query.
-        """
-        response = krpc.krpccoder.KRPCResponse.fromQuery(krpcQuery)
-        response.token = utils.getToken(krpcQuery.fromNode)
+    def _callLater(self, delay, f, *args):
+        return reactor.callLater(delay, f, *args)
         
-        if AppState.peerStorage.torrentExists(krpcQuery.targetID):
-            peers = AppState.peerStorage.getPeers(krpcQuery.targetID)
-            if krpcQuery.noSeeders:
-                peers = filter(lambda p: not p.seeder, peers)
-            response.peers = AppState.peerStorage.getPeers(krpcQuery.targetID)
-        else:
-            response.nodes = AppState.routingTable.findClosestNodes(krpcQuery.targetID)
-            
-        self._krpcSend(response)
-            
-    def __krpcQueryAnnouncePeerReceived(self, krpcQuery):
-        """
-        Process a KRPC announce peer query.
-        """
-        if utils.isTokenValid(krpcQuery.fromNode, krpcQuery.token):
-            AppState.peerStorage.addPeer(krpcQuery.targetID, krpcQuery.peer)
-            response = krpc.krpccoder.KRPCResponse.fromQuery(krpcQuery)
-        else:
-            response = krpc.krpccoder.KRPCError.fromQuery(krpcQuery, errorCode=203, errorMessage=b"Invalid token")
-
-        self._krpcSend(response)
+    def _seconds(self):
+        return reactor.seconds()
         
-    def _krpcSend(self, krpcMessage):
-        if isinstance(krpcMessage, krpc.krpccoder.KRPCQuery):
-            self.__krpcSendQuery(krpcMessage)
-        elif isinstance(krpcMessage, krpc.krpccoder.KRPCResponse):
-            self.__krpcSendResponse(krpcMessage)
-        elif isinstance(krpcMessage, krpc.krpccoder.KRPCError):
-            self.__krpcSendError(krpcMessage)
+    def _createWaiter(self):
+        return defer.Deferred()
         
-    def __krpcSendQuery(self, krpcQuery):
-        query = krpc.krpccoder.encode(krpcQuery)
-        self.transport.write(query, krpcQuery.toNode.host)
+    def _fireWaiter(self, waiter, result):
+        waiter.callback(result)
         
+    def _failWaiter(self, waiter, exception):
+        waiter.errback(exception)
         
-    def __krpcSendResponse(self, krpcResponse):
-        response = krpc.krpccoder.encode(krpcResponse)
-        self.transport.write(response, krpcResponse.toNode.host)
-    
-    def __krpcSendError(self, krpcError):
-        error = krpc.krpccoder.encode(krpcError)
-        self.transport.write(error, krpcError.toNode.host)
-        
\ No newline at end of file
+    def whenAnswered(self, waiter, callback, errback):
+        waiter.addCallbacks(callback, lambda failure: errback(failure.value))
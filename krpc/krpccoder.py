@@ -5,22 +5,24 @@ Module that provides methods for encoding and decoding
 KRCP messages.
 """
 
-import functools
+import random
 import struct
-from socket import inet_aton
-from socket import inet_ntoa
+from socket import inet_pton
+from socket import inet_ntop
+from socket import AF_INET
+from socket import AF_INET6
 
 import bencodepy
 
 import utils
-from appstate import AppState
 from dht.node import Node
 from dht.peer import Peer
 from hash.hash import Hash
 
-def decode(data, addressPort):
+def decode(data, addressPort, context):
     """
-    Decode a datagram into a KRPC message.
+    Decode a datagram into a KRPC message, received by the node with the
+    given context (a NodeContext).
     """
     msg = bencodepy.decode(data)
     (address, port) = addressPort
@@ -28,33 +30,37 @@ def decode(data, addressPort):
     type = msg[b'y']
     
     if type == b'q':
-        krpc = _decodeQuery(msg, (address, port))
+        krpc = _decodeQuery(msg, (address, port), context)
     elif type == b'r':
-        krpc = _decodeResponse(msg, (address, port))
+        krpc = _decodeResponse(msg, (address, port), context)
     elif type == b'e':
-        krpc = _decodeError(msg, (address, port))
+        krpc = _decodeError(msg, (address, port), context)
     else:
         raise Exception('Invalid RPC query type')
         
     return krpc
         
         
-def _decodeQuery(rawRPC, addressPort):
+def _decodeQuery(rawRPC, addressPort, context):
     """
     Decode a KRPC query into a KRPC query object.
     """
     rpc = KRPCQuery()
     rpc.type = rawRPC[b'q']
     rpc.transactionID = rawRPC[b't']
-    rpc.toNode = AppState.thisNode
     
     (address, port) = addressPort
 
     fromID = Hash(rawRPC[b'a'][b'id'])
-    node = AppState.routingTable.findNode(fromID)
-    if node == None:
-        node = Node(fromID, (address, port))
-    rpc.fromNode = node
+    
+    # Decode optional argument 'want' (BEP 32); by default the querying
+    # node wants nodes of the address family it sent the query over
+    if b'want' in rawRPC[b'a']:
+        rpc.want = set(rawRPC[b'a'][b'want'])
+    elif utils.isIPv6(address):
+        rpc.want = set([b'n6'])
+    else:
+        rpc.want = set([b'n4'])
     
     if rpc.type == b'ping':
         # Decode ping query
@@ -70,59 +76,82 @@ def _decodeQuery(rawRPC, addressPort):
         rpc.targetID = Hash(rawRPC[b'a'][b'info_hash'])
         
         # Decode optional argument 'noseed'
-        if 'noseed' in rawRPC[b'a'] and rawRPC[b'a'][b'noseed'] == 1:
+        if b'noseed' in rawRPC[b'a'] and rawRPC[b'a'][b'noseed'] == 1:
             rpc.noSeeders = True
             
         # Decode optional argument 'scrape'
-        if 'scrape' in rawRPC[b'a'] and rawRPC[b'a'][b'scrape'] == 1:
+        if b'scrape' in rawRPC[b'a'] and rawRPC[b'a'][b'scrape'] == 1:
             rpc.scrape = True    
     elif rpc.type == b'announce_peer':
         # Decode announce_peer query
         rpc.targetID = Hash(rawRPC[b'a'][b'info_hash'])
         
         # Decode optional argument 'implied_port'
-        if 'implied_port' in rawRPC[b'a'] and rawRPC[b'a'][b'implied_port'] == 1:
+        if b'implied_port' in rawRPC[b'a'] and rawRPC[b'a'][b'implied_port'] == 1:
             peerPort = port
             rpc.impliedPort = True
         else:
             peerPort = int(rawRPC[b'a'][b'port'])
         
         # Decode optional argument 'seed'
-        if 'seed' in rawRPC[b'a'] and rawRPC[b'a'][b'seed'] == 1:
+        if b'seed' in rawRPC[b'a'] and rawRPC[b'a'][b'seed'] == 1:
             seeder = True
         else:
             seeder = False
             
         rpc.peer = Peer((address, peerPort), seeder)
-        rpc.token = Hash(rawRPC[b'a'][b'token'])
+        rpc.token = _decodeToken(rawRPC[b'a'][b'token'])
+    elif rpc.type == b'sample_infohashes':
+        # Decode sample_infohashes query (BEP 51)
+        
+        rpc.targetID = Hash(rawRPC[b'a'][b'target'])
+        
+    # Queries do not name the node they are addressed to; dispatch them to
+    # the virtual node closest to the target, or to the querying node
+    if rpc.targetID is not None:
+        virtualNode = context.virtualNodes.closestTo(rpc.targetID)
+    else:
+        virtualNode = context.virtualNodes.closestTo(fromID)
+    rpc.toNode = virtualNode.node
+    
+    # Nodes not in the routing table, or that moved to another address, are
+    # taken from the cache of recent sources, so repeat queries do not
+    # create a new node each time
+    node = virtualNode.routingTableFor(address).findNode(fromID)
+    if node == None or node.host != (address, port):
+        node = context.nodeCache.seen(fromID, (address, port))
+    rpc.fromNode = node
                 
     return rpc
     
-def _decodeResponse(rawRPC, addressPort):
+def _decodeResponse(rawRPC, addressPort, context):
     """
     Decode a KRPC response into a KRPC response object.
     """
     rpc = KRPCResponse()
     rpc.transactionID = rawRPC[b't']
-    rpc.toNode = AppState.thisNode
     
     (address, port) = addressPort
 
     try:
-        (originalQuery, toNode, timestamp) = AppState.outstandingQueries[rpc.transactionID]
+        (originalQuery, toNode, timestamp) = context.outstandingQueries[rpc.transactionID]
     except:
         raise Exception('No matching outstanding query transaction ID could be found.')
     
     rpc.responseTo = originalQuery
     
-    if toNode.address != address or toNode.port != port:
+    # The response is addressed to the (virtual) node that sent the query
+    virtualNode = context.virtualNodeOf(originalQuery.fromNode)
+    rpc.toNode = originalQuery.fromNode
+    
+    if toNode.address() != address or toNode.port() != port:
         raise Exception('Matching query was sent to a different address or port than this response originated from.')
     
     
     rpc.type = originalQuery.type
     
     fromID = Hash(rawRPC[b'r'][b'id'])
-    node = AppState.routingTable.findNode(fromID)
+    node = virtualNode.routingTableFor(address).findNode(fromID)
     if node == None:
         node = Node(fromID, (address, port))
     rpc.fromNode = node
@@ -130,36 +159,63 @@ def _decodeResponse(rawRPC, addressPort):
     if rpc.type == b'ping':
         pass
     elif rpc.type == b'find_node':
-        rpc.nodes = _decodeNodesInfo(rawRPC[b'r'][b'nodes'])
+        _decodeResponseNodes(rpc, rawRPC)
+        if rpc.nodes is None and rpc.nodes6 is None:
+            raise Exception('Expected nodes or nodes6 in find_node response')
     elif rpc.type == b'get_peers':
-        rpc.token = Hash(rawRPC[b'r'][b'token'])
-        if b'nodes' in rawRPC[b'r']:
-            rpc.nodes = _decodeNodesInfo(rawRPC[b'r'][b'nodes'])
-        elif b'values' in rawRPC[b'r']:
+        rpc.token = _decodeToken(rawRPC[b'r'][b'token'])
+        _decodeResponseNodes(rpc, rawRPC)
+        if b'values' in rawRPC[b'r']:
             rpc.peers = _decodePeers(rawRPC[b'r'][b'values'])
-        else:
+        elif rpc.nodes is None and rpc.nodes6 is None:
             raise Exception('Expected either nodes or peers in get_peers response')
     elif rpc.type == b'announce_peer':
         pass
+    elif rpc.type == b'sample_infohashes':
+        _decodeResponseNodes(rpc, rawRPC)
+        rpc.interval = int(rawRPC[b'r'][b'interval'])
+        rpc.num = int(rawRPC[b'r'][b'num'])
+        samples = rawRPC[b'r'][b'samples']
+        rpc.samples = [Hash(sample) for sample in utils.chunks(samples, 20)]
     
     return rpc
     
-def _decodeError(rawRPC, addressPort):
+def _decodeToken(token):
+    """
+    Decode a token. Tokens are opaque and not necessarily 20 bytes (many
+    clients use 4 to 8 bytes); tokens not handed out by this node are
+    rejected when they are validated, not when they are decoded.
+    """
+    if not isinstance(token, bytes):
+        raise Exception('Expected a string token')
+    return token
+    
+def _decodeResponseNodes(rpc, rawRPC):
+    """
+    Decode the IPv4 (nodes) and IPv6 (nodes6) nodes in a response, if any.
+    """
+    if b'nodes' in rawRPC[b'r']:
+        rpc.nodes = _decodeNodesInfo(rawRPC[b'r'][b'nodes'])
+    if b'nodes6' in rawRPC[b'r']:
+        rpc.nodes6 = _decodeNodesInfo(rawRPC[b'r'][b'nodes6'], AF_INET6)
+    
+def _decodeError(rawRPC, addressPort, context):
     """
     Decode a KRPC error into a KRPC error object.
     """
     rpc = KRPCError()
     rpc.transactionID = rawRPC[b't']
-    rpc.toNode = AppState.thisNode
     
     (address, port) = addressPort
 
     try:
-        (originalQuery, toNode, timestamp) = AppState.outstandingQueries[rpc.transactionID]
+        (originalQuery, toNode, timestamp) = context.outstandingQueries[rpc.transactionID]
     except:
         raise Exception('No matching outstanding query transaction ID could be found.')
         
-    if toNode.address != address or toNode.port != port:
+    rpc.toNode = originalQuery.fromNode
+        
+    if toNode.address() != address or toNode.port() != port:
         raise Exception('Matching query was sent to a different address or port than this response originated from.')
     
     rpc.type = originalQuery.type
@@ -175,15 +231,20 @@ def _decodeAddressPortInfo(compactAddressPortString):
     compact IP-address/port info string.
     """
     
-    # Decode address represented as as a 6-byte string
+    # Decode address represented as as a 6-byte (IPv4) or 18-byte (IPv6) string
     # https://docs.python.org/2/library/struct.html
-    # Format >4sH: 
+    # Format >4sH or >16sH: 
     # >   - Format using big endian (network byte order)
-    # 4s  - ip address takes 4 bytes
+    # 4s  - IPv4 address takes 4 bytes
+    # 16s - IPv6 address takes 16 bytes
     # H   - ports are unsigned shorts (16 bits; max value of 65535)
+    if len(compactAddressPortString) == 18:
+        (ipBytes, port) = struct.unpack('>16sH', compactAddressPortString)
+        return (inet_ntop(AF_INET6, ipBytes), port)
+    
     (ipBytes, port) = struct.unpack('>4sH', compactAddressPortString)
     
-    return (inet_ntoa(ipBytes), port)
+    return (inet_ntop(AF_INET, ipBytes), port)
     
 def _decodePeer(compactPeerString):
     return Peer(_decodeAddressPortInfo(compactPeerString))
@@ -193,7 +254,7 @@ def _decodePeers(compactPeersStringList):
     Decode peers that are encoded as a list of
     compact IP-address/port info strings.
     """
-    return map(_decodePeer, compactPeersStringList)
+    return [_decodePeer(peer) for peer in compactPeersStringList]
     
 def _decodeNodeInfo(compactNodeString):
     """
@@ -201,26 +262,28 @@ def _decodeNodeInfo(compactNodeString):
     """
     nodeID = Hash(compactNodeString[0:20])
     
-    (host, port) = _decodeAddressPortInfo(compactNodeString[20:26])
+    (host, port) = _decodeAddressPortInfo(compactNodeString[20:])
     
     return Node(nodeID, (host, port))
     
-def _decodeNodesInfo(compactNodesString):
+def _decodeNodesInfo(compactNodesString, family=AF_INET):
     """
-    Decode nodes that are encoded as a compact nodes info string.
+    Decode nodes that are encoded as a compact nodes info string
+    of 26-byte (IPv4) or 38-byte (IPv6) node strings.
     """
-    nodeChunks = utils.chunks(compactNodesString, 26)
+    nodeChunks = utils.chunks(compactNodesString, 26 if family == AF_INET else 38)
     
-    return map(_decodeNodeInfo, nodeChunks)
+    return [_decodeNodeInfo(nodeChunk) for nodeChunk in nodeChunks]
    
-def encode(krpcMessage):
+def encode(krpcMessage, budget=None):
     """
-    Encode a KRPC message.
+    Encode a KRPC message. Responses are limited to budget bytes, if given
+    (see _encodeResponse).
     """
     if isinstance(krpcMessage, KRPCQuery):
         encoded = _encodeQuery(krpcMessage)
     elif isinstance(krpcMessage, KRPCResponse):
-        encoded = _encodeResponse(krpcMessage)
+        encoded = _encodeResponse(krpcMessage, budget)
     elif isinstance(krpcMessage, KRPCError):
         encoded = _encodeError(krpcMessage)
         
@@ -246,102 +309,166 @@ def _encodeQuery(krpcQuery):
             'q': 'find_node',
             'a': {
                 'id': bytes(krpcQuery.fromNode),
-                'target': krpcQuery.targetID
+                'target': bytes(krpcQuery.targetID)
             }
         }
+        if krpcQuery.want:
+            query['a']['want'] = sorted(krpcQuery.want)
     elif krpcQuery.type == b'get_peers':
         query = {
-            't': str(krpcQuery.transactionID),
+            't': krpcQuery.transactionID,
             'y': 'q',
             'q': 'get_peers',
             'a': {
                 'id': bytes(krpcQuery.fromNode),
-                'info_hash': krpcQuery.targetID
+                'info_hash': bytes(krpcQuery.targetID)
             }
         }
-    elif krpcQuery.type == b'announce_peer':
-        (address, port) = krpcQuery.peer
-        if rpc.impliedPort == True:
-            query = {
-                't': krpcQuery.transactionID,
-                'y': 'q',
-                'q': 'announce_peer',
-                'a': {
-                    'id': bytes(krpcQuery.fromNode),
-                    'implied_port': 1,
-                    'info_hash': krpcQuery.targetID,
-                    'port': port,
-                    'token': bytes(krpcQuery.token)
-                }
+        if krpcQuery.want:
+            query['a']['want'] = sorted(krpcQuery.want)
+    elif krpcQuery.type == b'sample_infohashes':
+        query = {
+            't': krpcQuery.transactionID,
+            'y': 'q',
+            'q': 'sample_infohashes',
+            'a': {
+                'id': bytes(krpcQuery.fromNode),
+                'target': bytes(krpcQuery.targetID)
             }
-        else:
-            query = {
-                't': str(krpcQuery.transactionID),
-                'y': 'q',
-                'q': 'announce_peer',
-                'a': {
-                    'id': bytes(krpcQuery.fromNode),
-                    'info_hash': krpcQuery.targetID,
-                    'port': port,
-                    'token': bytes(krpcQuery.token)
-                }
+        }
+        if krpcQuery.want:
+            query['a']['want'] = sorted(krpcQuery.want)
+    elif krpcQuery.type == b'announce_peer':
+        query = {
+            't': krpcQuery.transactionID,
+            'y': 'q',
+            'q': 'announce_peer',
+            'a': {
+                'id': bytes(krpcQuery.fromNode),
+                'info_hash': bytes(krpcQuery.targetID),
+                'port': krpcQuery.peer.port(),
+                'token': bytes(krpcQuery.token)
             }
+        }
+        if krpcQuery.impliedPort:
+            query['a']['implied_port'] = 1
+        if krpcQuery.peer.seeder:
+            query['a']['seed'] = 1
         
     return bencodepy.encode(query)
     
-def _encodeResponse(krpcResponse):
+def _encodeResponse(krpcResponse, budget=None):
     """
-    Encode a KRPC response.
+    Encode a KRPC response of at most budget bytes (if given).
+    
+    The fixed part of the response is built first; the peers (values) and
+    nodes are then added as far as they fit in the remaining budget, with
+    sizes known from the bencoding. Nodes are sent closest first (a nodes
+    or nodes6 field without room for a single node is left out); a random
+    selection of the peers is sent. If anything was left out, the response
+    is marked as truncated.
+    
+    The response only exceeds the budget if its fixed part does.
     """
-    if krpcResponse.type == b'ping':
-        response = {
-            't': krpcResponse.transactionID,
-            'y': 'r',
-            'r': {
-                'id': bytes(krpcResponse.fromNode)
-            }
+    response = {
+        't': krpcResponse.transactionID,
+        'y': 'r',
+        'r': {
+            'id': bytes(krpcResponse.fromNode)
         }
-    elif krpcResponse.type == b'find_node':
-        response = {
-            't': krpcResponse.transactionID,
-            'y': 'r',
-            'r': {
-                'id': bytes(krpcResponse.fromNode),
-                'nodes': _encodeNodes(krpcResponse.nodes)
-            }
-        }
-    elif krpcResponse.type == b'get_peers':
-        if krpcResponse.peers != None:
-            response = {
-                't': krpcResponse.transactionID,
-                'y': 'r',
-                'r': {
-                    'id': bytes(krpcResponse.fromNode),
-                    'token': bytes(krpcResponse.token),
-                    'values': _encodePeers(krpcResponse.peers)
-                }
-            }   
+    }
+    if krpcResponse.type == b'get_peers':
+        response['r']['token'] = bytes(krpcResponse.token)
+    elif krpcResponse.type == b'sample_infohashes':
+        response['r']['interval'] = krpcResponse.interval
+        response['r']['num'] = krpcResponse.num
+    
+    truncated = False
+    if krpcResponse.type in (b'find_node', b'get_peers', b'sample_infohashes'):
+        remaining = budget - _fixedResponseSize(krpcResponse) if budget is not None else None
+        
+        # Keep room for the samples field, which is sent even if it is empty
+        reserved = _bencodedStringSize(len('samples')) + _bencodedStringSize(0) if krpcResponse.type == b'sample_infohashes' else 0
+        if remaining is not None:
+            remaining -= reserved
+        
+        if krpcResponse.type == b'get_peers' and krpcResponse.peers != None:
+            (values, remaining) = _fitPeers(krpcResponse.peers, remaining)
+            response['r']['values'] = values
+            truncated = len(values) < len(krpcResponse.peers)
         else:
-            response = {
-                't': krpcResponse.transactionID,
-                'y': 'r',
-                'r': {
-                    'id': bytes(krpcResponse.fromNode),
-                    'token': bytes(krpcResponse.token),
-                    'nodes': _encodeNodes(krpcResponse.nodes)
-                }
-            }
-    elif krpcResponse.type == b'announce_peer':
-        response = {
-            't': krpcResponse.transactionID,
-            'y': 'r',
-            'r': {
-                'id': bytes(krpcResponse.fromNode)
-            }
-        }
+            for (key, nodes, nodeSize) in (('nodes', krpcResponse.nodes, 26), ('nodes6', krpcResponse.nodes6, 38)):
+                if nodes != None:
+                    data = _encodeNodes(nodes)
+                    (fitted, left) = _fitString(key, data, nodeSize, remaining)
+                    truncated = truncated or len(fitted) < len(data)
+                    if fitted or not data:
+                        (response['r'][key], remaining) = (fitted, left)
         
+        if krpcResponse.type == b'sample_infohashes':
+            # The samples are encoded by the peer storage already
+            if remaining is not None:
+                remaining += reserved
+            (response['r']['samples'], remaining) = _fitString('samples', krpcResponse.samples, 20, remaining)
+            truncated = truncated or len(response['r']['samples']) < len(krpcResponse.samples)
+    
+    krpcResponse.truncated = truncated
     return bencodepy.encode(response)
-   
+    
+def _bencodedStringSize(length):
+    """
+    Get the size of a bencoded string of the given length.
+    """
+    return len(str(length)) + 1 + length
+    
+def _bencodedIntSize(value):
+    return len(str(value)) + 2
+    
+# Size of a bencoded response holding only the responding node's ID, without
+# the transaction ID: d1:rd2:id20:<id>e1:t<transaction ID>1:y1:re
+RESPONSE_OVERHEAD = 43
+    
+def _fixedResponseSize(krpcResponse):
+    """
+    Get the size of the bencoded response without its peers, nodes and samples.
+    """
+    size = RESPONSE_OVERHEAD + _bencodedStringSize(len(krpcResponse.transactionID))
+    if krpcResponse.type == b'get_peers':
+        size += _bencodedStringSize(len('token')) + _bencodedStringSize(len(bytes(krpcResponse.token)))
+    elif krpcResponse.type == b'sample_infohashes':
+        size += _bencodedStringSize(len('interval')) + _bencodedIntSize(krpcResponse.interval)
+        size += _bencodedStringSize(len('num')) + _bencodedIntSize(krpcResponse.num)
+    return size
+    
+def _fitString(key, data, itemSize, remaining):
+    """
+    Cut the given string of items of itemSize bytes to the items that fit,
+    with the key, in the remaining budget (None for no budget).
+    Returns the string and the budget left.
+    """
+    if remaining is None:
+        return (data, None)
+    remaining -= _bencodedStringSize(len(key))
+    count = len(data) // itemSize
+    while count > 0 and _bencodedStringSize(count * itemSize) > remaining:
+        count -= 1
+    return (data[:count * itemSize], remaining - _bencodedStringSize(count * itemSize))
+    
+def _fitPeers(peers, remaining):
+    """
+    Encode the peers that fit in the remaining budget (None for no budget)
+    as a list of compact peers. Returns the list and the budget left.
+    """
+    if remaining is None:
+        return (_encodePeers(peers), None)
+    remaining -= _bencodedStringSize(len('values')) + 2
+    # All peers of a response are of one address family
+    itemSize = _bencodedStringSize(18 if utils.isIPv6(peers[0].address()) else 6) if peers else 1
+    count = max(0, min(len(peers), remaining // itemSize))
+    if count < len(peers):
+        peers = random.sample(peers, count)
+    return (_encodePeers(peers), remaining - count * itemSize)
+    
 def _encodeError(krpcError):
     """
     Encode a KRPC error message.
@@ -356,41 +483,45 @@ def _encodeError(krpcError):
     
 def _encodeAddressPortInfo(addressPort):
     """
-    Encode an IP and port as a 6-byte string.
+    Encode an IP and port as a 6-byte (IPv4) or 18-byte (IPv6) string.
     """
-    # Represent the host as a string of 6 bytes.
+    # Represent the host as a string of 6 or 18 bytes.
     # https://docs.python.org/2/library/struct.html
-    # Format >4sH: 
+    # Format >4sH or >16sH: 
     # >   - Format using big endian (network byte order)
-    # 4s  - inet_aton returns the ip as a string of 4 chars (1 byte per char)
+    # 4s  - inet_pton returns an IPv4 address as a string of 4 bytes
+    # 16s - inet_pton returns an IPv6 address as a string of 16 bytes
     # H   - ports are unsigned shorts (16 bits; max value of 65535)
     (address, port) = addressPort
 
-    return struct.pack('>4sH', inet_aton(address), port)
+    if utils.isIPv6(address):
+        return struct.pack('>16sH', inet_pton(AF_INET6, address), port)
+    return struct.pack('>4sH', inet_pton(AF_INET, address), port)
         
 def _encodePeer(peer):
     """
-    Encode a peer as a 6-byte string.
+    Encode a peer as a 6-byte (IPv4) or 18-byte (IPv6) string.
     """
     return _encodeAddressPortInfo(peer.host)
         
 def _encodePeers(peers):
     """
-    Encode a list of peers as a list of 6-byte strings.
+    Encode a list of peers as a list of 6-byte (IPv4) or 18-byte (IPv6) strings.
     """
-    return functools.reduce(lambda acc, peer: acc + _encodePeer(peer), peers, b"")
+    return [_encodePeer(peer) for peer in peers]
         
 def _encodeNode(node):
     """
-    Encode a node as a 26-byte string (20-byte ID and 6-byte address + port information).
+    Encode a node as a 26-byte (IPv4) or 38-byte (IPv6) string 
+    (20-byte ID and 6-byte or 18-byte address + port information).
     """
-    return str(node.id) + _encodeAddressPortInfo(node.host)
+    return bytes(node.hash) + _encodeAddressPortInfo(node.host)
 
 def _encodeNodes(nodes):
     """
     Encode a list of nodes as a string of concatenated encodings of the nodes.
     """
-    return functools.reduce(lambda acc, node: acc + _encodeNode(node), nodes, "")
+    return b''.join(_encodeNode(node) for node in nodes)
    
 class _KRPC():
     """
@@ -428,8 +559,15 @@ class KRPCQuery(_KRPC):
         - implied_port (optional): if set and equal to '1' the port argument should be
         ignored the source port of the UDP packet should be used as the peer's listening 
         port.  
+    
+    - sample_infohashes (BEP 51):
+        - target: the ID near which nodes are sought, as with find_node
+    
+    The find_node, get_peers and sample_infohashes queries take an optional
+    'want' argument (BEP 32): a list containing 'n4' and/or 'n6', requesting
+    IPv4 and/or IPv6 nodes.
     """
-    def __init__(self, transactionID=None, fromNode=None, toNode=None, type=None, targetID=None, token=None, peer=None, impliedPort=None, noSeeders=False, scrape=False):
+    def __init__(self, transactionID=None, fromNode=None, toNode=None, type=None, targetID=None, token=None, peer=None, impliedPort=None, noSeeders=False, scrape=False, want=None):
         _KRPC.__init__(self, transactionID, fromNode, toNode)
         
         self.type = type # ping, find_node, get_peers, announce_peer
@@ -439,9 +577,10 @@ class KRPCQuery(_KRPC):
         self.impliedPort = impliedPort
         self.noSeeders = noSeeders
         self.scrape = scrape
+        self.want = want
         
     def __repr__(self):
-        return "KRPCQuery(transactionID=%r,fromNode=%r,toNode=%r,type=%r,targetID=%r,token=%r,peer=%r,impliedPort=%r,noSeeders=%r,scrape=%r)" % (self.transactionID, self.fromNode, self.toNode, self.type, self.targetID, self.token, self.peer, self.impliedPort, self.noSeeders, self.scrape)
+        return "KRPCQuery(transactionID=%r,fromNode=%r,toNode=%r,type=%r,targetID=%r,token=%r,peer=%r,impliedPort=%r,noSeeders=%r,scrape=%r,want=%r)" % (self.transactionID, self.fromNode, self.toNode, self.type, self.targetID, self.token, self.peer, self.impliedPort, self.noSeeders, self.scrape, self.want)
            
         
 class KRPCResponse(_KRPC):
@@ -465,35 +604,54 @@ class KRPCResponse(_KRPC):
         - one of:
             - values: list of K peers
             - nodes: list of K closest good nodes
+    
+    - sample_infohashes (BEP 51):
+        - nodes: K closest good nodes
+        - interval: seconds to wait before asking for a new sample
+        - num: number of info-hashes stored
+        - samples: sample of the stored info-hashes (encoded as the 
+          concatenated info-hashes when sending, and a list of hashes 
+          when received)
+    
+    Responses to find_node, get_peers and sample_infohashes can contain IPv4
+    nodes (nodes), IPv6 nodes (nodes6) or both (BEP 32).
     """
-    def __init__(self, transactionID=None, fromNode=None, toNode=None, responseTo=None, type=None, nodes=None, token=None, peers=None):
+    def __init__(self, transactionID=None, fromNode=None, toNode=None, responseTo=None, type=None, nodes=None, token=None, peers=None, nodes6=None, interval=None, num=None, samples=None):
         _KRPC.__init__(self, transactionID, fromNode, toNode)
         
         self.responseTo = responseTo
-        self.type = type # ping, find_node, get_peers, announce_peer
+        self.type = type # ping, find_node, get_peers, announce_peer, sample_infohashes
         self.nodes = nodes
+        self.nodes6 = nodes6
         self.token = token
         self.peers = peers
+        self.interval = interval
+        self.num = num
+        self.samples = samples
+        
+        # Set when encoding: whether peers, nodes or samples were left out
+        # to fit the response in its byte budget
+        self.truncated = False
         
     @staticmethod
     def fromQuery(query):
         """
         Build a bare response from the given query:
         - transaction ID;
-        - from node (i.e., this node);
+        - from node (i.e., the node the query was sent to: this node);
         - to node (i.e., query from node); 
         - query this is a response to; and
         - response type.
         """
         return KRPCResponse(
             transactionID=query.transactionID, 
-            fromNode=AppState.thisNode, 
+            fromNode=query.toNode, 
             toNode=query.fromNode,
             responseTo=query,
             type=query.type)
         
     def __repr__(self):
-        return "KRPCResponse(transactionID=%r,fromNode=%r,toNode=%r,responseTo=%r,type=%r,nodes=%r,token=%r,peers=%r)" % (self.transactionID, self.fromNode, self.toNode, self.type, self.nodes, self.token, self.peers)
+        return "KRPCResponse(transactionID=%r,fromNode=%r,toNode=%r,responseTo=%r,type=%r,nodes=%r,nodes6=%r,token=%r,peers=%r,interval=%r,num=%r,samples=%r)" % (self.transactionID, self.fromNode, self.toNode, self.responseTo, self.type, self.nodes, self.nodes6, self.token, self.peers, self.interval, self.num, self.samples)
         
 class KRPCError(_KRPC):
     """
@@ -0,0 +1,298 @@
+"""
+@author Thomas Churchman
+
+Module that provides a batched UDP transport for Linux.
+
+Instead of one recvfrom/sendto system call per datagram, the socket is
+drained with recvmmsg in batches and the replies generated while processing
+a batch are flushed with a single sendmmsg call. Datagrams written at other
+times (e.g., replies completed by the storage worker pool) are queued and
+flushed together on the next reactor iteration.
+
+The system calls are not exposed by the socket module, so they are called
+through ctypes. Use isSupported() to check whether they are available.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import socket
+import struct
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.python import log
+
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = 0x20
+
+# Large enough to hold a sockaddr_in or sockaddr_in6
+SOCKADDR_SIZE = 128
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t)
+    ]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int)
+    ]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _MsgHdr),
+        ('msg_len', ctypes.c_uint)
+    ]
+
+def _loadLibc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.recvmmsg
+        libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    libc.recvmmsg.restype = ctypes.c_int
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    libc.sendmmsg.restype = ctypes.c_int
+    return libc
+
+_libc = _loadLibc()
+
+def isSupported():
+    """
+    Check whether recvmmsg and sendmmsg are available on this platform.
+    """
+    return _libc is not None
+
+def _decodeSockAddr(name):
+    """
+    Decode a raw sockaddr_in or sockaddr_in6 into an (address, port) tuple.
+    """
+    (family,) = struct.unpack_from('=H', name, 0)
+    (port,) = struct.unpack_from('>H', name, 2)
+    if family == socket.AF_INET:
+        return (socket.inet_ntop(socket.AF_INET, name[4:8]), port)
+    else:
+        return (socket.inet_ntop(socket.AF_INET6, name[8:24]), port)
+
+def _encodeSockAddr(family, addressPort):
+    """
+    Encode an (address, port) tuple as a raw sockaddr_in or sockaddr_in6.
+    """
+    (address, port) = addressPort
+    if family == socket.AF_INET:
+        return struct.pack('=H', family) + struct.pack('>H', port) + socket.inet_pton(family, address) + b'\x00' * 8
+    else:
+        return struct.pack('=H', family) + struct.pack('>HI', port, 0) + socket.inet_pton(family, address) + b'\x00' * 4
+
+class MMsgSocket:
+    """
+    Wraps a non-blocking UDP socket to receive and send datagrams in batches.
+    """
+    def __init__(self, sock, batchSize=64, maxPacketSize=2048):
+        self.socket = sock
+        self.family = sock.family
+        self.batchSize = batchSize
+        self.maxPacketSize = maxPacketSize
+
+        # Number of datagrams received by the last recv call, including
+        # truncated ones
+        self.received = 0
+        # Number of datagrams skipped because they did not fit the buffer
+        self.truncated = 0
+
+        # Receive buffers are allocated once and reused for every batch
+        self._buffers = [ctypes.create_string_buffer(maxPacketSize) for i in range(batchSize)]
+        self._names = [ctypes.create_string_buffer(SOCKADDR_SIZE) for i in range(batchSize)]
+        self._iovecs = (_IOVec * batchSize)()
+        self._msgs = (_MMsgHdr * batchSize)()
+        for i in range(batchSize):
+            self._iovecs[i].iov_base = ctypes.addressof(self._buffers[i])
+            self._iovecs[i].iov_len = maxPacketSize
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._names[i])
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def recv(self):
+        """
+        Receive up to batchSize datagrams without blocking.
+
+        Returns a list of (data, (address, port)) tuples, which is empty if
+        no datagrams were waiting. Datagrams larger than maxPacketSize are
+        skipped (and counted in truncated) rather than decoded truncated.
+        """
+        self.received = 0
+        for i in range(self.batchSize):
+            self._msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+
+        n = _libc.recvmmsg(self.socket.fileno(), self._msgs, self.batchSize, MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNREFUSED):
+                return []
+            raise OSError(err, 'recvmmsg failed')
+
+        self.received = n
+        datagrams = []
+        for i in range(n):
+            msg = self._msgs[i]
+            if msg.msg_hdr.msg_flags & MSG_TRUNC:
+                self.truncated += 1
+                continue
+            data = ctypes.string_at(self._buffers[i], msg.msg_len)
+            name = ctypes.string_at(self._names[i], msg.msg_hdr.msg_namelen)
+            datagrams.append((data, _decodeSockAddr(name)))
+        return datagrams
+
+    def send(self, datagrams):
+        """
+        Send a list of (data, (address, port)) tuples.
+
+        Returns the number of datagrams the kernel accepted. Datagrams that
+        cannot be sent because the socket buffer is full are dropped, as
+        they would be on any congested UDP path.
+        """
+        n = len(datagrams)
+        if n == 0:
+            return 0
+
+        # Keep references to the buffers alive for the duration of the call
+        datas = [ctypes.c_char_p(data) for (data, addressPort) in datagrams]
+        names = [ctypes.c_char_p(_encodeSockAddr(self.family, addressPort)) for (data, addressPort) in datagrams]
+        iovecs = (_IOVec * n)()
+        msgs = (_MMsgHdr * n)()
+        for i in range(n):
+            iovecs[i].iov_base = ctypes.cast(datas[i], ctypes.c_void_p)
+            iovecs[i].iov_len = len(datagrams[i][0])
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(names[i], ctypes.c_void_p)
+            hdr.msg_namelen = 16 if self.family == socket.AF_INET else 28
+            hdr.msg_iov = ctypes.pointer(iovecs[i])
+            hdr.msg_iovlen = 1
+
+        sent = 0
+        while sent < n:
+            r = _libc.sendmmsg(self.socket.fileno(), ctypes.byref(msgs[sent]), n - sent, MSG_DONTWAIT)
+            if r < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNREFUSED, errno.EMSGSIZE):
+                    # Skip the datagram the kernel refused and carry on
+                    sent += 1
+                    continue
+                raise OSError(err, 'sendmmsg failed')
+            sent += r
+        return sent
+
+@implementer(IReadDescriptor)
+class MMsgPort:
+    """
+    A Twisted datagram transport backed by an MMsgSocket.
+
+    Batches of received datagrams are handed to the protocol's
+    datagramsReceived method. Datagrams written by the protocol while it
+    processes a batch are queued and flushed with one sendmmsg call
+    afterwards; datagrams written at other times are queued and flushed
+    with one sendmmsg call on the next reactor iteration.
+    """
+    # Maximum number of batches to read per reactor iteration, so a
+    # flood of datagrams cannot starve other events
+    maxBatchesPerRead = 16
+
+    def __init__(self, reactor, sock, protocol, batchSize=64):
+        self.reactor = reactor
+        self.mmsgSocket = MMsgSocket(sock, batchSize)
+        self.socket = sock
+        self.protocol = protocol
+        # [(data, (address, port))] queued to be flushed, or None
+        self._outgoing = None
+        self._flushCall = None
+
+    def startListening(self):
+        self.protocol.makeConnection(self)
+        self.reactor.addReader(self)
+
+    def stopListening(self):
+        self.__flush()
+        self.reactor.removeReader(self)
+        self.protocol.doStop()
+        self.socket.close()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def logPrefix(self):
+        return 'MMsgPort'
+
+    def connectionLost(self, reason):
+        self.stopListening()
+
+    def getHost(self):
+        return self.socket.getsockname()
+
+    def doRead(self):
+        """
+        Called by the reactor when the socket is ready for reading.
+        """
+        for i in range(self.maxBatchesPerRead):
+            datagrams = self.mmsgSocket.recv()
+            if not self.mmsgSocket.received:
+                return
+
+            if self._outgoing is None:
+                self._outgoing = []
+            try:
+                self.protocol.datagramsReceived(datagrams)
+            except BaseException:
+                log.err()
+            finally:
+                self.__flush()
+
+            if self.mmsgSocket.received < self.mmsgSocket.batchSize:
+                return
+
+    def write(self, datagram, addr):
+        """
+        Write a datagram.
+        """
+        if self._outgoing is None:
+            self._outgoing = []
+            self._flushCall = self.reactor.callLater(0, self.__flush)
+        self._outgoing.append((datagram, addr))
+
+    def __flush(self):
+        """
+        Send the queued datagrams.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        outgoing = self._outgoing
+        self._outgoing = None
+        if outgoing:
+            self.mmsgSocket.send(outgoing)
+
+def listenMMsg(reactor, sock, protocol, batchSize=64):
+    """
+    Start serving the given protocol on the given bound, non-blocking
+    UDP socket using batched system calls.
+    """
+    port = MMsgPort(reactor, sock, protocol, batchSize)
+    port.startListening()
+    return port
@@ -0,0 +1,106 @@
+"""
+@author Thomas Churchman
+
+Module that provides metrics of the round-trip times of outbound queries.
+"""
+
+import bisect
+
+import dht.node
+
+# Upper bounds of the histogram buckets in seconds: 1 ms to ~8 s, doubling.
+# Round-trip times above the last bound are counted in an overflow bucket.
+BOUNDS = [0.001 * 2**i for i in range(14)]
+
+class RTTStats:
+    """
+    Class to hold a histogram of the round-trip times of answered queries,
+    and the number of queries that timed out.
+
+    The handler also records the timeout every query was sent with, so
+    the effect of adaptive timeouts can be seen. A smoothed round-trip time
+    over all nodes gives the timeout of queries to nodes that have not
+    answered before.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.answered = 0
+        self.timedOut = 0
+        self.retransmitted = 0
+        self.queries = 0
+        self.totalRTT = 0.0
+        self.totalTimeout = 0.0
+        self.srtt = None
+        self.rttvar = None
+
+    def querySent(self, timeout):
+        self.queries += 1
+        self.totalTimeout += timeout
+
+    def add(self, rtt):
+        """
+        Record the round-trip time of an answered query (that was not sent
+        again).
+        """
+        self.answered += 1
+        self.totalRTT += rtt
+        self.counts[bisect.bisect_left(BOUNDS, rtt)] += 1
+        (self.srtt, self.rttvar) = dht.node.smoothRTT(self.srtt, self.rttvar, rtt)
+
+    def queryTimeout(self, minimum, maximum):
+        """
+        Get the timeout of a query to a node without a round-trip time.
+        """
+        return dht.node.rttTimeout(self.srtt, self.rttvar, minimum, maximum)
+
+    def addTimeout(self):
+        self.timedOut += 1
+
+    def addRetransmission(self):
+        self.retransmitted += 1
+
+    def percentile(self, p):
+        """
+        Get the upper bound of the bucket holding the p-th percentile
+        (0-100) of the round-trip times, or None if no query was answered.
+        The overflow bucket has no bound: infinity is returned.
+        """
+        if self.answered == 0:
+            return None
+        rank = p / 100 * self.answered
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return BOUNDS[i] if i < len(BOUNDS) else float('inf')
+        return float('inf')
+
+    def dump(self):
+        """
+        Show the round-trip time distribution as text.
+        """
+        if self.queries == 0:
+            return 'No queries sent'
+
+        lines = [
+            'queries %d, answered %d, sent again %d, timed out %d, mean timeout %.3fs' % (
+                self.queries, self.answered, self.retransmitted, self.timedOut, self.totalTimeout / self.queries)
+        ]
+        if self.answered > 0:
+            lines.append('rtt mean %.1f ms, p50 <= %.0f ms, p90 <= %.0f ms, p99 <= %.0f ms' % (
+                self.totalRTT / self.answered * 1000,
+                self.percentile(50) * 1000,
+                self.percentile(90) * 1000,
+                self.percentile(99) * 1000))
+        low = 0.0
+        for (i, count) in enumerate(self.counts):
+            if count > 0:
+                if i < len(BOUNDS):
+                    lines.append('%8.0f - %5.0f ms %10d' % (low * 1000, BOUNDS[i] * 1000, count))
+                else:
+                    lines.append('%8.0f -   inf ms %10d' % (low * 1000, count))
+            low = BOUNDS[i] if i < len(BOUNDS) else low
+        return '\n'.join(lines)
@@ -0,0 +1,290 @@
+"""
+@author Thomas Churchman
+
+Module that provides a local API for torrent clients on the same host, over
+a Unix domain socket (see LOCAL_API_SOCKET in the config).
+
+Every request operates on a batch of info-hashes (or target IDs), and
+requests are pipelined: a client may send any number of requests without
+waiting for the results, which stream back as they become available.
+
+Frames (requests and results) consist of a 9-byte header followed by the
+payload:
+
+    payload length (uint32), type (uint8), request ID (uint32)
+
+all big-endian. The request ID is chosen by the client and copied into the
+frames sent back for that request. Request types and payloads:
+
+- ANNOUNCE: address length (uint8: 4 or 16), address, port (uint16),
+  seeder (uint8), followed by the 20-byte info-hashes. The peer is added to
+  each torrent in this node's peer storage and, if the announcer is
+  enabled, announced to the DHT periodically (only its port is sent; the
+  other nodes take the address of this node). One RESULT frame holds a
+  byte per info-hash: 1 if the peer was added, 0 otherwise.
+- GET_PEERS: 20-byte info-hashes. One RESULT frame per info-hash with the
+  peers in this node's peer storage: the info-hash, the numbers of IPv4 and
+  IPv6 peers (uint16 each) and the compact peers (6 or 18 bytes each).
+- CLOSEST_NODES: 20-byte target IDs. One RESULT frame per target with the
+  closest nodes in this node's routing tables: the target, the numbers of
+  IPv4 and IPv6 nodes (uint16 each) and the compact nodes (26 or 38 bytes
+  each).
+- LOOKUP: lookup type (uint8: 0 for find_node, 1 for get_peers), followed
+  by 20-byte target IDs. An iterative lookup is run on the network for every
+  target; one RESULT frame per target holds the target, the numbers of
+  nodes and peers found (uint16 each), the compact IPv4 nodes and the
+  compact peers.
+
+Failures are reported in ERROR frames with a UTF-8 message (for batched
+requests, the message starts with the hex info-hash it applies to). After
+all results of a request have been sent, a DONE frame with an empty
+payload ends the request.
+"""
+
+import os
+import stat
+import struct
+from socket import inet_pton
+from socket import inet_ntop
+from socket import AF_INET
+from socket import AF_INET6
+
+import utils
+import dht.lookup
+from dht.peer import Peer
+from hash.hash import Hash
+
+HEADER = struct.Struct('>IBI')
+COUNTS = struct.Struct('>HH')
+
+# Request types
+ANNOUNCE = 1
+GET_PEERS = 2
+CLOSEST_NODES = 3
+LOOKUP = 4
+
+# Result types
+RESULT = 0x80
+DONE = 0x81
+ERROR = 0x82
+
+LOOKUP_TYPES = [b'find_node', b'get_peers']
+
+# Maximum payload of a request frame; connections sending larger frames are closed
+MAX_PAYLOAD = 1 << 20
+
+def encodeFrame(type, requestID, payload=b''):
+    return HEADER.pack(len(payload), type, requestID) + payload
+
+def _encodeAddressPort(addressPort):
+    (address, port) = addressPort
+    if utils.isIPv6(address):
+        return inet_pton(AF_INET6, address) + struct.pack('>H', port)
+    return inet_pton(AF_INET, address) + struct.pack('>H', port)
+
+def _encodePeers(peers):
+    """
+    Encode peers as the numbers of IPv4 and IPv6 peers, followed by the
+    compact IPv4 peers and the compact IPv6 peers.
+    """
+    peers4 = [peer for peer in peers if not utils.isIPv6(peer.address())]
+    peers6 = [peer for peer in peers if utils.isIPv6(peer.address())]
+    return COUNTS.pack(len(peers4), len(peers6)) + b''.join(_encodeAddressPort(peer.host) for peer in peers4 + peers6)
+
+def _encodeNodes(nodes4, nodes6):
+    return COUNTS.pack(len(nodes4), len(nodes6)) + b''.join(bytes(node.hash) + _encodeAddressPort(node.host) for node in nodes4 + nodes6)
+
+def _hashes(payload):
+    """
+    Split a payload of concatenated 20-byte IDs into hashes.
+    """
+    return [Hash(chunk) for chunk in utils.chunks(payload, 20)]
+
+class LocalAPISession:
+    """
+    Class to represent a connection of a local client.
+
+    The event loop passes received bytes to dataReceived; frames are
+    written with the given write function. Lookups are sent through the
+    given (IPv4) KRPC handler.
+    """
+    def __init__(self, context, protocol, write, close):
+        self.context = context
+        self.protocol = protocol
+        self._write = write
+        self._close = close
+        self._buffer = bytearray()
+        self.closed = False
+
+    def connectionLost(self):
+        self.closed = True
+
+    def send(self, type, requestID, payload=b''):
+        if not self.closed:
+            self._write(encodeFrame(type, requestID, payload))
+
+    def dataReceived(self, data):
+        """
+        Buffer received bytes and handle every complete request frame.
+        """
+        self._buffer += data
+        while len(self._buffer) >= HEADER.size and not self.closed:
+            (length, type, requestID) = HEADER.unpack_from(self._buffer)
+            if length > MAX_PAYLOAD:
+                self.closed = True
+                self._close()
+                return
+            if len(self._buffer) < HEADER.size + length:
+                return
+            payload = bytes(self._buffer[HEADER.size:HEADER.size + length])
+            del self._buffer[:HEADER.size + length]
+            self.__request(type, requestID, payload)
+
+    def __request(self, type, requestID, payload):
+        try:
+            if type == ANNOUNCE:
+                self.__announce(requestID, payload)
+            elif type == GET_PEERS:
+                self.__getPeers(requestID, _hashes(payload))
+            elif type == CLOSEST_NODES:
+                self.__closestNodes(requestID, _hashes(payload))
+            elif type == LOOKUP:
+                self.__lookup(requestID, LOOKUP_TYPES[payload[0]], _hashes(payload[1:]))
+            else:
+                raise Exception('Unknown request type %d' % type)
+        except Exception as e:
+            self.send(ERROR, requestID, str(e).encode('utf-8'))
+            self.send(DONE, requestID)
+
+    def __countdown(self, count, f):
+        """
+        Get a function that calls f once it has been called count times
+        (f is called right away if count is 0).
+        """
+        remaining = [count]
+        def done(*args):
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                f()
+        if count == 0:
+            f()
+        return done
+
+    def __failed(self, failure, requestID, hash):
+        self.send(ERROR, requestID, ('%040x %s' % (int(hash), failure.getErrorMessage())).encode('utf-8'))
+
+    def __announce(self, requestID, payload):
+        addressLength = payload[0]
+        if addressLength == 4:
+            address = inet_ntop(AF_INET, payload[1:5])
+        elif addressLength == 16:
+            address = inet_ntop(AF_INET6, payload[1:17])
+        else:
+            raise Exception('Invalid address length %d' % addressLength)
+        (port, seeder) = struct.unpack_from('>HB', payload, 1 + addressLength)
+        peer = Peer((address, port), bool(seeder))
+        hashes = _hashes(payload[1 + addressLength + 3:])
+
+        added = bytearray(len(hashes))
+        def peerAdded(wasAdded, i):
+            added[i] = 1 if wasAdded else 0
+        def allWritten():
+            self.send(RESULT, requestID, bytes(added))
+            self.send(DONE, requestID)
+        written = self.__countdown(len(hashes), allWritten)
+
+        for (i, hash) in enumerate(hashes):
+            if self.context.announcer is not None:
+                self.context.announcer.add(hash, peer)
+            d = self.context.peerStorage.addPeer(hash, peer)
+            d.addCallback(peerAdded, i)
+            d.addErrback(self.__failed, requestID, hash)
+            d.addBoth(written)
+
+    def __getPeers(self, requestID, hashes):
+        resultSent = self.__countdown(len(hashes), lambda: self.send(DONE, requestID))
+        for hash in hashes:
+            d = self.context.peerStorage.getPeers(hash)
+            d.addCallback(self.__sendPeers, requestID, hash)
+            d.addErrback(self.__failed, requestID, hash)
+            d.addBoth(resultSent)
+
+    def __sendPeers(self, peers, requestID, hash):
+        self.send(RESULT, requestID, bytes(hash) + _encodePeers(peers))
+
+    def __closestNodes(self, requestID, targets):
+        for target in targets:
+            nodes4 = self.context.routingTable.findClosestNodes(target)
+            nodes6 = self.context.routingTable6.findClosestNodes(target)
+            self.send(RESULT, requestID, bytes(target) + _encodeNodes(nodes4, nodes6))
+        self.send(DONE, requestID)
+
+    def __lookup(self, requestID, type, targets):
+        if self.protocol is None:
+            raise Exception('Lookups are not available')
+
+        resultSent = self.__countdown(len(targets), lambda: self.send(DONE, requestID))
+        def lookupDone(lookup):
+            nodes = lookup.closestNodes()
+            payload = bytes(lookup.target) + COUNTS.pack(len(nodes), len(lookup.peers))
+            payload += b''.join(bytes(node.hash) + _encodeAddressPort(node.host) for node in nodes)
+            payload += b''.join(_encodeAddressPort(peer.host) for peer in lookup.peers)
+            self.send(RESULT, requestID, payload)
+            resultSent()
+
+        for target in targets:
+            lookup = dht.lookup.Lookup(self.protocol, target, type)
+            lookup.start(self.context.routingTable.findClosestNodes(target), lookupDone)
+
+def _removeStaleSocket(path):
+    """
+    Remove the socket left at path by a previous run. Anything else at path
+    (e.g., a file, if LOCAL_API_SOCKET is misconfigured) is left alone.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise Exception('%s exists and is not a socket' % path)
+    os.unlink(path)
+
+def listenTwisted(reactor, context, protocol, path):
+    """
+    Serve the local API on the Unix socket at the given path on the Twisted reactor.
+    """
+    from twisted.internet.protocol import Protocol
+    from twisted.internet.protocol import Factory
+
+    class LocalAPIProtocol(Protocol):
+        def connectionMade(self):
+            self.session = LocalAPISession(context, protocol, self.transport.write, self.transport.loseConnection)
+
+        def dataReceived(self, data):
+            self.session.dataReceived(data)
+
+        def connectionLost(self, reason):
+            self.session.connectionLost()
+
+    _removeStaleSocket(path)
+    return reactor.listenUNIX(path, Factory.forProtocol(LocalAPIProtocol))
+
+def listenAsyncio(loop, context, protocol, path):
+    """
+    Serve the local API on the Unix socket at the given path on an asyncio
+    event loop. Returns a coroutine yielding the server.
+    """
+    import asyncio
+
+    class AsyncLocalAPIProtocol(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.session = LocalAPISession(context, protocol, transport.write, transport.close)
+
+        def data_received(self, data):
+            self.session.dataReceived(data)
+
+        def connection_lost(self, exc):
+            self.session.connectionLost()
+
+    _removeStaleSocket(path)
+    return loop.create_unix_server(AsyncLocalAPIProtocol, path)
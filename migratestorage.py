@@ -0,0 +1,25 @@
+"""
+@author Thomas Churchman
+
+Script that moves a file peer storage from the old flat layout (all
+torrents in one directory) to the fanned-out directory layout.
+
+Usage: python migratestorage.py [storageDir]
+
+The storage directory defaults to PEER_STORAGE_DIR from the config.
+Stop the node before migrating.
+"""
+
+import sys
+
+from dht.peerstorage import FilePeerStorage
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        storageDir = sys.argv[1]
+    else:
+        import config
+        storageDir = config.PEER_STORAGE_DIR
+        
+    migrated = FilePeerStorage.migrateFlatLayout(storageDir)
+    print("Migrated %d torrents in %s" % (migrated, storageDir))
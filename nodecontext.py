@@ -0,0 +1,250 @@
+"""
+@author Thomas Churchman
+
+Module that provides the node context: the state of a DHT node.
+
+A context is passed to the KRPC handler, which hands it (or the parts of it
+they need) to the codec, the routing tables and the peer storage. Several
+nodes, each with its own context, can therefore run in one process, as in
+the simulator.
+"""
+
+import collections
+from hashlib import sha1
+
+import utils
+import tokensecret
+import dht.virtualnode
+import dht.secureid
+import dht.nodecache
+import krpc.rttstats
+from dht.node import Node
+from hash.hash import Hash
+
+class NodeContext:
+    """
+    Class to hold the state of a node.
+
+    The settings default to those of config.example.py; fromConfig builds
+    the context of the node described by config.py.
+    """
+    def __init__(self, thisNode, virtualNodeIDs=(), peerStorage=None, tokenSecrets=None,
+                 k=8, maxNodesPerBucket=8, maxFailedQueries=2, maxPeersPerTorrent=6000,
+                 queryTimeout=5.0, minQueryTimeout=0.5, ipv6=False, idVerifier=None,
+                 responseBudget=1400, responseBudget6=1232, nodeCacheSize=65536):
+        self.thisNode = thisNode
+
+        self.k = k
+        self.maxNodesPerBucket = maxNodesPerBucket
+        self.maxFailedQueries = maxFailedQueries
+        self.maxPeersPerTorrent = maxPeersPerTorrent
+        # Query timeouts are derived from round-trip times (see
+        # KRPCHandler.sendQuery), between minQueryTimeout and queryTimeout
+        self.queryTimeout = queryTimeout
+        self.minQueryTimeout = minQueryTimeout
+        self.rttStats = krpc.rttstats.RTTStats()
+
+        # Dual-stack (BEP 32): IPv6 nodes are kept in a separate routing table
+        # and served on a separate socket
+        self.ipv6 = ipv6
+
+        # Maximum size of encoded responses to IPv4 and IPv6 nodes; peers and
+        # nodes that do not fit are left out. The numbers of responses sent
+        # and truncated are counted per response type
+        self.responseBudget = responseBudget
+        self.responseBudget6 = responseBudget6
+        self.responsesSent = collections.Counter()
+        self.responsesTruncated = collections.Counter()
+
+        # Secure node IDs (BEP 42): if set, the routing tables only accept
+        # nodes whose ID the verifier accepts for their address
+        self.idVerifier = idVerifier
+
+        # Recently seen sources of queries, shared by the virtual nodes; the
+        # routing tables refill their buckets from it
+        self.nodeCache = dht.nodecache.NodeCache(nodeCacheSize)
+
+        # This node is the primary virtual node
+        virtualNodes = [self.__virtualNode(thisNode)]
+        for hash in virtualNodeIDs:
+            virtualNodes.append(self.__virtualNode(Node(hash, thisNode.host)))
+        self.virtualNodes = dht.virtualnode.VirtualNodes(virtualNodes)
+        self.routingTable = self.virtualNodes.primary.routingTable
+        self.routingTable6 = self.virtualNodes.primary.routingTable6
+
+        if peerStorage is None:
+            from dht.peerstorage import MemoryPeerStorage
+            peerStorage = MemoryPeerStorage(maxPeersPerTorrent)
+        self.peerStorage = peerStorage
+        self.storagePool = None
+
+        # Secrets get_peers tokens are derived from (see tokensecret.py)
+        self.tokenSecrets = tokenSecrets if tokenSecrets is not None else tokensecret.TokenSecrets()
+
+        # {transactionID: (RPCQuery, Node, timestamp)}
+        self.outstandingQueries = {}
+
+        self.crawler = None
+        self.announcer = None
+        self.logPackets = False
+        # Capture of received datagrams (a capture.CaptureWriter), if one is
+        # being recorded (see the "capture" admin commands)
+        self.capture = None
+        # While the process this process took over from drains, datagrams
+        # that cannot be decoded are forwarded to it with handoffForward
+        self.handoffForward = None
+
+        # Process settings, used by otdht.py
+        self.heartbeat = 3.0
+        self.bootstrap = []
+        self.workers = 1
+        self.reactor = 'twisted'
+        self.transport = 'default'
+        self.mmsgBatchSize = 64
+        self.adminPort = 0
+        self.profileDir = None
+        self.localAPISocket = None
+        self.handoffSocket = None
+
+    def __virtualNode(self, node):
+        return dht.virtualnode.VirtualNode(node, self.k, self.maxNodesPerBucket, self.maxFailedQueries, self.idVerifier, self.nodeCache)
+
+    @staticmethod
+    def fromConfig(config=None):
+        """
+        Build the context of the node described by the given config module
+        (config.py by default).
+
+        The peer storage, storage worker pool, crawler and announcer are
+        imported here, so importing this module does not load Twisted.
+        """
+        if config is None:
+            import config
+        import supervisor
+        import dht.peerstorage
+
+        thisNodeHash = Hash(sha1(config.NODE_ID_NAME).digest())
+        idVerifier = None
+        if config.SECURE_NODE_IDS:
+            if config.NODE_EXTERNAL_IP is None:
+                raise Exception('NODE_EXTERNAL_IP must be set to use secure node IDs')
+            # The bits of the ID not determined by the external IP are taken
+            # from the name, so the ID does not change between restarts
+            thisNodeHash = dht.secureid.generateID(config.NODE_EXTERNAL_IP, thisNodeHash)
+            idVerifier = dht.secureid.IDVerifier(config.SECURE_ID_CACHE_SIZE)
+        thisNode = Node(thisNodeHash, (config.NODE_IP, config.NODE_PORT))
+
+        # The IDs of the other virtual nodes are derived from the same name
+        virtualNodeIDs = [Hash(sha1(config.NODE_ID_NAME + b'/%d' % i).digest()) for i in range(1, config.VIRTUAL_NODES)]
+
+        if config.PEER_STORAGE == 'file':
+            peerStorage = dht.peerstorage.FilePeerStorage(
+                config.PEER_STORAGE_DIR,
+                config.PEER_STORAGE_MAX_OPEN_FILES,
+                shared=supervisor.isWorker(),
+                maxPeersPerTorrent=config.MAX_PEERS_PER_TORRENT)
+        elif config.PEER_STORAGE == 'memory':
+            peerStorage = dht.peerstorage.MemoryPeerStorage(config.MAX_PEERS_PER_TORRENT)
+        elif config.PEER_STORAGE == 'mysql':
+            peerStorage = dht.peerstorage.MySQLPeerStorage()
+        else:
+            raise Exception('Unknown peer storage: %s' % config.PEER_STORAGE)
+
+        # Workers spawned by a supervisor share the token secrets through
+        # the secret file; the first worker rotates them. The supervisor
+        # creates the file before spawning the workers
+        if config.TOKEN_SECRET_FILE is None and config.WORKERS > 1:
+            raise Exception('TOKEN_SECRET_FILE must be set to run several workers')
+        tokenSecrets = tokensecret.TokenSecrets(
+            config.TOKEN_SECRET_FILE,
+            config.TOKEN_ROTATION_INTERVAL,
+            readOnly=supervisor.isWorker() and supervisor.workerIndex() > 0)
+
+        # Buffer announces in memory and write them in bulk
+        if config.ANNOUNCE_BUFFER_INTERVAL > 0:
+            peerStorage = dht.peerstorage.BufferedPeerStorage(
+                peerStorage,
+                config.ANNOUNCE_BUFFER_INTERVAL,
+                config.ANNOUNCE_BUFFER_SIZE)
+
+        context = NodeContext(
+            thisNode,
+            virtualNodeIDs,
+            peerStorage,
+            tokenSecrets=tokenSecrets,
+            k=config.K,
+            maxNodesPerBucket=config.MAX_NODES_PER_BUCKET,
+            maxFailedQueries=config.MAX_FAILED_QUERIES,
+            maxPeersPerTorrent=config.MAX_PEERS_PER_TORRENT,
+            queryTimeout=config.QUERY_TIMEOUT,
+            minQueryTimeout=config.MIN_QUERY_TIMEOUT,
+            ipv6=config.IPV6,
+            idVerifier=idVerifier,
+            responseBudget=config.MAX_RESPONSE_SIZE,
+            responseBudget6=config.MAX_RESPONSE_SIZE6,
+            nodeCacheSize=config.NODE_CACHE_SIZE)
+
+        # Blocking storage operations run on a worker pool, which is
+        # started once the event loop is known
+        if config.STORAGE_THREADS > 0:
+            import workerpool
+            context.storagePool = workerpool.WorkerPool(config.STORAGE_THREADS, config.STORAGE_QUEUE_DEPTH)
+            context.peerStorage.setPool(context.storagePool)
+
+        if config.CRAWLER:
+            import crawler
+            # Records appended by several processes would interleave, so
+            # each worker keeps its own log
+            crawlerLog = config.CRAWLER_LOG
+            if supervisor.isWorker():
+                crawlerLog += '.%d' % supervisor.workerIndex()
+            context.crawler = crawler.Crawler(
+                context,
+                crawler.InfohashLog(crawlerLog, config.CRAWLER_CAPACITY),
+                config.CRAWLER_QUERY_RATE)
+
+        if config.ANNOUNCER:
+            import announcer
+            context.announcer = announcer.Announcer(
+                context,
+                config.ANNOUNCER_INTERVAL,
+                config.ANNOUNCER_JITTER,
+                config.MAX_QUERIES_IN_FLIGHT,
+                config.ANNOUNCER_NEIGHBORHOOD_TTL)
+
+        context.logPackets = config.LOG_PACKETS
+        context.heartbeat = config.HEARTBEAT
+        context.bootstrap = config.BOOTSTRAP
+        context.workers = config.WORKERS
+        context.reactor = config.REACTOR
+        context.transport = config.TRANSPORT
+        context.mmsgBatchSize = config.MMSG_BATCH_SIZE
+
+        context.adminPort = config.ADMIN_PORT
+        if context.adminPort and supervisor.isWorker():
+            context.adminPort += 1 + supervisor.workerIndex()
+        context.profileDir = config.PROFILE_DIR
+
+        context.localAPISocket = config.LOCAL_API_SOCKET
+        if context.localAPISocket and supervisor.isWorker():
+            context.localAPISocket += '.%d' % supervisor.workerIndex()
+
+        context.handoffSocket = config.HANDOFF_SOCKET
+
+        return context
+
+    def routingTableFor(self, address):
+        """
+        Get the primary node's routing table for nodes of the address family
+        of the given address.
+        """
+        if utils.isIPv6(address):
+            return self.routingTable6
+        return self.routingTable
+
+    def virtualNodeOf(self, node):
+        """
+        Get the virtual node with the ID of the given node (e.g., the node a
+        query was addressed to), or the primary node if it is not one of ours.
+        """
+        return self.virtualNodes.find(node)
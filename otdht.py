@@ -1,18 +1,211 @@
+import socket
+
 from appstate import AppState
 import bloom
-
-from krpc.krpc import KRPC
-from twisted.internet.protocol import DatagramProtocol
-from twisted.internet import reactor
+import supervisor
+import heartbeat
+import handoff
+import profiling
+import localapi
+import dht.peerstorage
 
 # h1 = Hash(hashlib.sha1("test").digest())
 # h2 = Hash(hashlib.sha1("test").digest())
 # h3 = Hash(hashlib.sha1("test2").digest())
 # print h2.distance(h3)
 
-AppState.prepare()
-reactor.listenUDP(AppState.thisNode.port(), KRPC())
-#reactor.callLater(3, AppState.routingTable.refresh)
-reactor.callLater(3, AppState.routingTable.refresh, (reactor))
-reactor.run()
-print('test')
\ No newline at end of file
+def families():
+    """
+    Get the address families the node serves.
+    """
+    if AppState.ipv6 and socket.has_ipv6:
+        return [socket.AF_INET, socket.AF_INET6]
+    return [socket.AF_INET]
+
+def bindSocket(family, takeover=None):
+    """
+    Create a non-blocking UDP socket of the given address family, 
+    bound to the node's port, or take it from the process this process
+    takes over from (see handoff.py).
+    """
+    if takeover is not None and family in takeover.sockets:
+        return takeover.sockets.pop(family)
+    address = '::' if family == socket.AF_INET6 else ''
+    if supervisor.isWorker():
+        return supervisor.reusePortSocket(address, AppState.thisNode.port(), family)
+        
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if family == socket.AF_INET6:
+        # Leave IPv4 to the IPv4 socket bound to the same port
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+    sock.setblocking(False)
+    sock.bind((address, AppState.thisNode.port()))
+    return sock
+
+def runTwisted():
+    """
+    Serve the node on the Twisted reactor.
+    """
+    from twisted.internet import reactor
+    from twisted.internet import defer
+    from krpc.krpc import KRPC
+    import krpc.mmsg
+
+    if AppState.transport == 'mmsg' and not krpc.mmsg.isSupported():
+        raise Exception('The mmsg transport requires recvmmsg/sendmmsg (Linux)')
+        
+    takeover = handoff.Takeover() if handoff.isHandoff() else None
+
+    # One protocol instance per address family; replies leave through
+    # the socket the query arrived on
+    protocols = {}
+    ports = {}
+    for family in families():
+        sock = bindSocket(family, takeover)
+        protocols[family] = KRPC(AppState.context)
+        if AppState.transport == 'mmsg':
+            ports[family] = krpc.mmsg.listenMMsg(reactor, sock, protocols[family], AppState.mmsgBatchSize)
+        else:
+            # The reactor duplicates the file descriptor; close our copy
+            ports[family] = reactor.adoptDatagramPort(sock.fileno(), family, protocols[family])
+            sock.close()
+    if takeover is not None:
+        takeover.restore(AppState.context, protocols)
+
+    if AppState.storagePool is not None:
+        AppState.storagePool.start(reactor.callFromThread)
+        reactor.addSystemEventTrigger('after', 'shutdown', AppState.storagePool.stop)
+        
+    if isinstance(AppState.peerStorage, dht.peerstorage.BufferedPeerStorage):
+        AppState.peerStorage.start(reactor.callLater)
+        def stopPeerStorage():
+            # Shutdown waits for a Deferred returned by the trigger
+            d = defer.Deferred()
+            AppState.peerStorage.stop().addBoth(d.callback)
+            return d
+        reactor.addSystemEventTrigger('before', 'shutdown', stopPeerStorage)
+
+    if AppState.crawler is not None:
+        AppState.crawler.start(protocols[socket.AF_INET], reactor.callLater, AppState.bootstrap)
+        reactor.addSystemEventTrigger('before', 'shutdown', AppState.crawler.stop)
+
+    if AppState.announcer is not None:
+        AppState.announcer.start(protocols[socket.AF_INET], reactor.callLater, reactor.seconds)
+        reactor.addSystemEventTrigger('before', 'shutdown', AppState.announcer.stop)
+        
+    listeners = []
+    profiler = profiling.Profiler(reactor.callLater, AppState.profileDir, AppState.context)
+    profiling.installSignalHandler(profiler)
+    def listen():
+        if AppState.adminPort:
+            listeners.append(profiling.listenTwisted(reactor, profiler, AppState.adminPort))
+        if AppState.localAPISocket:
+            listeners.append(localapi.listenTwisted(reactor, AppState.context, protocols[socket.AF_INET], AppState.localAPISocket))
+    def release():
+        while listeners:
+            listeners.pop().stopListening()
+    listen()
+
+    if AppState.handoffSocket and not supervisor.isWorker():
+        handoff.installSignalHandler(handoff.Handoff(
+            AppState.context, AppState.handoffSocket,
+            dict((family, port.fileno()) for (family, port) in ports.items()),
+            protocols, reactor.callLater, reactor.callFromThread,
+            release=release, reopen=listen,
+            stopReading=lambda: [reactor.removeReader(port) for port in ports.values()],
+            stop=reactor.stop))
+    if takeover is not None:
+        reactor.callWhenRunning(takeover.ready, reactor.callLater)
+
+    heartbeat.heartbeat(reactor.callLater, AppState.context)
+    reactor.callLater(3, AppState.routingTable.refresh)
+    reactor.run()
+
+def runAsyncio():
+    """
+    Serve the node on an asyncio event loop (uvloop if it is installed).
+    """
+    import asyncio
+    import krpc.aio
+
+    krpc.aio.installUVLoop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    if AppState.storagePool is not None:
+        AppState.storagePool.start(loop.call_soon_threadsafe)
+
+    if isinstance(AppState.peerStorage, dht.peerstorage.BufferedPeerStorage):
+        AppState.peerStorage.start(loop.call_later)
+
+    takeover = handoff.Takeover() if handoff.isHandoff() else None
+
+    protocols = {}
+    transports = {}
+    for family in families():
+        protocols[family] = krpc.aio.AsyncKRPC(loop, AppState.context)
+        (transports[family], protocol) = loop.run_until_complete(krpc.aio.listen(loop, protocols[family], sock=bindSocket(family, takeover)))
+    if takeover is not None:
+        takeover.restore(AppState.context, protocols)
+
+    if AppState.crawler is not None:
+        AppState.crawler.start(protocols[socket.AF_INET], loop.call_later, AppState.bootstrap)
+
+    if AppState.announcer is not None:
+        AppState.announcer.start(protocols[socket.AF_INET], loop.call_later, loop.time)
+        
+    listeners = []
+    profiler = profiling.Profiler(loop.call_later, AppState.profileDir, AppState.context)
+    profiling.installSignalHandler(profiler, loop.add_signal_handler)
+    async def listen():
+        if AppState.adminPort:
+            (transport, protocol) = await profiling.listenAsyncio(loop, profiler, AppState.adminPort)
+            listeners.append(transport)
+        if AppState.localAPISocket:
+            listeners.append(await localapi.listenAsyncio(loop, AppState.context, protocols[socket.AF_INET], AppState.localAPISocket))
+    def release():
+        while listeners:
+            listeners.pop().close()
+    loop.run_until_complete(listen())
+
+    if AppState.handoffSocket and not supervisor.isWorker():
+        handoff.installSignalHandler(handoff.Handoff(
+            AppState.context, AppState.handoffSocket,
+            dict((family, transport.get_extra_info('socket').fileno()) for (family, transport) in transports.items()),
+            protocols, loop.call_later, loop.call_soon_threadsafe,
+            release=release, reopen=lambda: loop.create_task(listen()),
+            stopReading=lambda: [transport.pause_reading() for transport in transports.values()],
+            stop=loop.stop), loop.add_signal_handler)
+    if takeover is not None:
+        loop.call_soon(takeover.ready, loop.call_later)
+
+    heartbeat.heartbeat(loop.call_later, AppState.context)
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if AppState.crawler is not None:
+            AppState.crawler.stop()
+        if AppState.announcer is not None:
+            AppState.announcer.stop()
+        if isinstance(AppState.peerStorage, dht.peerstorage.BufferedPeerStorage):
+            flushed = loop.create_future()
+            AppState.peerStorage.stop().addBoth(flushed.set_result)
+            loop.run_until_complete(flushed)
+        if AppState.storagePool is not None:
+            AppState.storagePool.stop()
+        loop.close()
+
+config = AppState.loadConfig()
+
+if config.WORKERS > 1 and not supervisor.isWorker():
+    # Run as supervisor; the workers run this script as well
+    supervisor.supervise(config.WORKERS, config.TOKEN_SECRET_FILE, config.TOKEN_ROTATION_INTERVAL)
+else:
+    AppState.prepare()
+    if AppState.reactor == 'asyncio':
+        runAsyncio()
+    else:
+        runTwisted()
@@ -0,0 +1,411 @@
+"""
+@author Thomas Churchman
+
+Module that provides profiling hooks that can be toggled while the node runs.
+
+Three tools are available, next to the round-trip time metrics of the
+node's outbound queries (see krpc/rttstats.py) and packet captures of the
+datagrams it receives (see capture.py):
+- cProfile, dumped as a pstats file and a summary of the functions with
+  the highest cumulative time;
+- a stack sampler that periodically records the stack of the event loop
+  thread from a background thread, dumped in the collapsed format used by
+  flame graph tools; and
+- wall-clock spans around each of the KRPC handler's methods, reporting the
+  number of calls and the mean and maximum time per call.
+
+The tools are controlled through a local-only UDP admin endpoint (see
+ADMIN_PORT in the config), which takes one text command per datagram and
+replies with text, e.g.:
+
+    echo "profile start 30" | nc -u -w1 127.0.0.1 8044
+
+Send "help" for the list of commands. SIGUSR1 toggles cProfile as well.
+
+When a tool is off it adds no overhead: spans are enabled by replacing the
+handler's methods with timed wrappers and disabled by restoring them.
+"""
+
+import os
+import sys
+import time
+import signal
+import io
+import pstats
+import cProfile
+import threading
+import collections
+
+from krpc.handler import KRPCHandler
+import krpc.krpccoder
+import capture
+
+# Replies larger than this are truncated to fit in a datagram
+MAX_REPLY_SIZE = 60000
+
+# KRPCHandler methods timed by spans. Times are inclusive: the span of
+# datagramReceived includes decoding and the query handler's span.
+SPAN_METHODS = [
+    'datagramReceived',
+    '_KRPCHandler__krpcQueryPingReceived',
+    '_KRPCHandler__krpcQueryFindNodeReceived',
+    '_KRPCHandler__krpcQueryGetPeersReceived',
+    '_KRPCHandler__sendGetPeersResponse',
+    '_KRPCHandler__krpcQueryAnnouncePeerReceived',
+    '_KRPCHandler__krpcQuerySampleInfohashesReceived',
+    '_KRPCHandler__krpcResponseReceived',
+    '_KRPCHandler__krpcErrorReceived',
+    '_krpcSend'
+]
+
+# Codec functions timed by spans
+SPAN_FUNCTIONS = [
+    (krpc.krpccoder, 'decode'),
+    (krpc.krpccoder, 'encode')
+]
+
+class Profiler:
+    """
+    Class to hold the state of the profiling tools and execute admin commands.
+
+    Commands are executed on the event loop thread; callLater (e.g.,
+    reactor.callLater or loop.call_later) is used to end time windows.
+    Metrics are read from the given node context.
+    """
+    def __init__(self, callLater, profileDir, context=None):
+        self.callLater = callLater
+        self.profileDir = profileDir
+        self.context = context
+
+        self.profile = None
+        self._profileStopCall = None
+
+        self.sampler = None
+        self._samplerStopCall = None
+
+        self._captureStopCall = None
+
+        # {name: [calls, total seconds, max seconds]}
+        self.spans = collections.OrderedDict()
+        self._originals = None
+
+    def command(self, line):
+        """
+        Execute an admin command and return the reply text.
+        """
+        args = line.split()
+        if len(args) < 2:
+            return self.help()
+
+        (tool, action) = (args[0], args[1])
+        try:
+            if tool == 'profile' and action == 'start':
+                return self.startProfile(float(args[2]) if len(args) > 2 else None)
+            elif tool == 'profile' and action == 'stop':
+                return self.stopProfile()
+            elif tool == 'sample' and action == 'start':
+                return self.startSampler(
+                    float(args[2]) if len(args) > 2 else None,
+                    float(args[3]) / 1000 if len(args) > 3 else 0.005)
+            elif tool == 'sample' and action == 'stop':
+                return self.stopSampler()
+            elif tool == 'spans' and action == 'start':
+                return self.startSpans()
+            elif tool == 'spans' and action == 'stop':
+                return self.stopSpans()
+            elif tool == 'spans' and action == 'dump':
+                return self.dumpSpans()
+            elif tool == 'spans' and action == 'reset':
+                self.spans.clear()
+                return 'Spans reset'
+            elif tool == 'rtt' and action == 'dump' and self.context is not None:
+                return self.context.rttStats.dump()
+            elif tool == 'rtt' and action == 'reset' and self.context is not None:
+                self.context.rttStats.reset()
+                return 'Round-trip times reset'
+            elif tool == 'responses' and action == 'dump' and self.context is not None:
+                return self.dumpResponses()
+            elif tool == 'nodecache' and action == 'dump' and self.context is not None:
+                return self.context.nodeCache.dump()
+            elif tool == 'capture' and action == 'start' and self.context is not None:
+                return self.startCapture(float(args[2]) if len(args) > 2 else None)
+            elif tool == 'capture' and action == 'stop' and self.context is not None:
+                return self.stopCapture()
+        except ValueError:
+            pass
+        return self.help()
+
+    def help(self):
+        return '\n'.join([
+            'profile start [seconds]   start cProfile, optionally for a time window',
+            'profile stop              stop cProfile and dump the statistics',
+            'sample start [seconds] [intervalMs]',
+            '                          start sampling the event loop stack (default every 5 ms)',
+            'sample stop               stop sampling and dump the collapsed stacks',
+            'spans start               start timing the KRPC handler methods',
+            'spans stop                stop timing the KRPC handler methods',
+            'spans dump                show the handler timings',
+            'spans reset               clear the handler timings',
+            'rtt dump                  show the round-trip times of outbound queries',
+            'rtt reset                 clear the round-trip times',
+            'responses dump            show the numbers of responses sent and truncated',
+            'nodecache dump            show the node cache and the busiest sources of queries',
+            'capture start [seconds]   record received datagrams, optionally for a time window',
+            'capture stop              stop recording received datagrams'
+        ])
+
+    def dumpResponses(self):
+        """
+        Show the numbers of responses sent and truncated to fit the
+        response budget, per response type.
+        """
+        sent = self.context.responsesSent
+        if not sent:
+            return 'No responses sent'
+        lines = ['%-20s %10s %10s' % ('response', 'sent', 'truncated')]
+        for type in sorted(sent):
+            truncated = self.context.responsesTruncated[type]
+            lines.append('%-20s %10d %10d (%.1f%%)' % (type.decode(), sent[type], truncated, 100 * truncated / sent[type]))
+        return '\n'.join(lines)
+
+    def _dumpPath(self, kind, extension):
+        os.makedirs(self.profileDir, exist_ok=True)
+        name = '%s-%d-%s.%s' % (kind, os.getpid(), time.strftime('%Y%m%d-%H%M%S'), extension)
+        return os.path.join(self.profileDir, name)
+
+    def toggleProfile(self):
+        if self.profile is None:
+            return self.startProfile()
+        return self.stopProfile()
+
+    def startProfile(self, duration=None):
+        if self.profile is not None:
+            return 'Profiler is already running'
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        if duration:
+            self._profileStopCall = self.callLater(duration, self.__endProfileWindow)
+            return 'Profiler started for %.1f seconds' % duration
+        return 'Profiler started'
+
+    def __endProfileWindow(self):
+        self._profileStopCall = None
+        self.stopProfile()
+
+    def stopProfile(self):
+        """
+        Stop cProfile, write the statistics to a pstats file and return
+        the functions with the highest cumulative time.
+        """
+        if self.profile is None:
+            return 'Profiler is not running'
+
+        self.profile.disable()
+        if self._profileStopCall is not None:
+            self._profileStopCall.cancel()
+            self._profileStopCall = None
+
+        path = self._dumpPath('profile', 'pstats')
+        self.profile.dump_stats(path)
+        self.profile = None
+
+        stream = io.StringIO()
+        stats = pstats.Stats(path, stream=stream)
+        stats.sort_stats('cumulative').print_stats(30)
+        summary = 'Profile written to %s\n%s' % (path, stream.getvalue())
+        print(summary)
+        return summary
+
+    def startSampler(self, duration=None, interval=0.005):
+        if self.sampler is not None:
+            return 'Sampler is already running'
+
+        self.sampler = _StackSampler(threading.get_ident(), interval)
+        self.sampler.start()
+        if duration:
+            self._samplerStopCall = self.callLater(duration, self.__endSamplerWindow)
+            return 'Sampler started for %.1f seconds' % duration
+        return 'Sampler started'
+
+    def __endSamplerWindow(self):
+        self._samplerStopCall = None
+        self.stopSampler()
+
+    def stopSampler(self):
+        """
+        Stop the sampler, write the collapsed stacks to a file and return
+        the most sampled stacks.
+        """
+        if self.sampler is None:
+            return 'Sampler is not running'
+
+        self.sampler.stop()
+        if self._samplerStopCall is not None:
+            self._samplerStopCall.cancel()
+            self._samplerStopCall = None
+
+        path = self._dumpPath('stacks', 'txt')
+        with open(path, 'w') as f:
+            for (stack, count) in self.sampler.counts.items():
+                f.write('%s %d\n' % (stack, count))
+
+        total = max(1, sum(self.sampler.counts.values()))
+        lines = ['Stacks written to %s (%d samples)' % (path, total)]
+        for (stack, count) in self.sampler.counts.most_common(10):
+            lines.append('%5.1f%% %s' % (count * 100.0 / total, stack.split(';')[-1]))
+        self.sampler = None
+        return '\n'.join(lines)
+
+    def startCapture(self, duration=None):
+        if self.context.capture is not None:
+            return 'Capture is already running'
+
+        self.context.capture = capture.CaptureWriter(self._dumpPath('capture', 'bin'))
+        if duration:
+            self._captureStopCall = self.callLater(duration, self.__endCaptureWindow)
+            return 'Capture to %s started for %.1f seconds' % (self.context.capture.path, duration)
+        return 'Capture to %s started' % self.context.capture.path
+
+    def __endCaptureWindow(self):
+        self._captureStopCall = None
+        print(self.stopCapture())
+
+    def stopCapture(self):
+        if self.context.capture is None:
+            return 'Capture is not running'
+
+        writer = self.context.capture
+        self.context.capture = None
+        writer.close()
+        if self._captureStopCall is not None:
+            self._captureStopCall.cancel()
+            self._captureStopCall = None
+        return 'Capture written to %s (%d datagrams, %d bytes)' % (writer.path, writer.records, writer.bytes)
+
+    def startSpans(self):
+        if self._originals is not None:
+            return 'Spans are already enabled'
+
+        self._originals = []
+        for name in SPAN_METHODS:
+            original = getattr(KRPCHandler, name)
+            self._originals.append((KRPCHandler, name, original))
+            setattr(KRPCHandler, name, self._timed(name.replace('_KRPCHandler__', ''), original))
+        for (module, name) in SPAN_FUNCTIONS:
+            original = getattr(module, name)
+            self._originals.append((module, name, original))
+            setattr(module, name, self._timed('%s.%s' % (module.__name__, name), original))
+        return 'Spans enabled'
+
+    def stopSpans(self):
+        if self._originals is None:
+            return 'Spans are not enabled'
+
+        for (owner, name, original) in self._originals:
+            setattr(owner, name, original)
+        self._originals = None
+        return 'Spans disabled'
+
+    def _timed(self, spanName, f):
+        span = self.spans.setdefault(spanName, [0, 0.0, 0.0])
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                span[0] += 1
+                span[1] += elapsed
+                if elapsed > span[2]:
+                    span[2] = elapsed
+        return timed
+
+    def dumpSpans(self):
+        lines = ['%-40s %10s %12s %12s %12s' % ('span', 'calls', 'total ms', 'mean us', 'max us')]
+        for (name, (calls, total, maximum)) in self.spans.items():
+            mean = total / calls if calls else 0.0
+            lines.append('%-40s %10d %12.1f %12.1f %12.1f' % (name, calls, total * 1e3, mean * 1e6, maximum * 1e6))
+        return '\n'.join(lines)
+
+class _StackSampler:
+    """
+    Samples the stack of a thread from a background thread.
+    """
+    def __init__(self, threadID, interval):
+        self.threadID = threadID
+        self.interval = interval
+
+        # {collapsed stack: number of samples}
+        self.counts = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name='StackSampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadID)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            self.counts[';'.join(reversed(stack))] += 1
+
+def reply(profiler, data):
+    """
+    Execute the command in a datagram and encode the reply.
+    """
+    text = profiler.command(data.decode('utf-8', 'replace'))
+    return text.encode('utf-8')[:MAX_REPLY_SIZE] + b'\n'
+
+def installSignalHandler(profiler, addSignalHandler=None):
+    """
+    Toggle cProfile on SIGUSR1. The statistics are dumped when it is
+    toggled off.
+
+    addSignalHandler (e.g., loop.add_signal_handler) is used to install the
+    handler if given, and signal.signal otherwise.
+    """
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    if addSignalHandler is not None:
+        addSignalHandler(signal.SIGUSR1, profiler.toggleProfile)
+    else:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggleProfile())
+
+def listenTwisted(reactor, profiler, port):
+    """
+    Serve the admin endpoint on 127.0.0.1 on the Twisted reactor.
+    """
+    from twisted.internet.protocol import DatagramProtocol
+
+    class AdminProtocol(DatagramProtocol):
+        def datagramReceived(self, data, addressPort):
+            self.transport.write(reply(profiler, data), addressPort)
+
+    return reactor.listenUDP(port, AdminProtocol(), interface='127.0.0.1')
+
+def listenAsyncio(loop, profiler, port):
+    """
+    Serve the admin endpoint on 127.0.0.1 on an asyncio event loop.
+    Returns a coroutine yielding (transport, protocol).
+    """
+    import asyncio
+
+    class AsyncAdminProtocol(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addressPort):
+            self.transport.sendto(reply(profiler, data), addressPort)
+
+    return loop.create_datagram_endpoint(AsyncAdminProtocol, local_addr=('127.0.0.1', port))
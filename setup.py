@@ -8,5 +8,9 @@ setup(
     install_requires=[
         "twisted",
 		"bencode"
-    ]
+    ],
+    extras_require={
+        # Vectorised ranking of large node pools (dht/nodepool.py)
+        "numpy": ["numpy"]
+    }
 )
\ No newline at end of file
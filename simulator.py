@@ -0,0 +1,388 @@
+"""
+@author Thomas Churchman
+
+Module that simulates a DHT network of many nodes in a single process.
+
+Every simulated node runs the regular KRPC handler, routing table and peer
+storage. Datagrams are carried by an in-memory bus with configurable latency
+and packet loss, and all timers run on a virtual clock, so a run is fast and,
+for a given seed, deterministic.
+
+The simulation reports:
+- routing table convergence: how many of the K nodes closest to a node's own
+  ID, as found in its routing table, are among the K truly closest nodes;
+- lookups: hop counts, queries per lookup, virtual time per lookup, and the fraction of find_node
+  lookups that find the node closest to the target and of get_peers lookups
+  that find the torrent's peers;
+- packets per second per node, in virtual time; and
+- the announcer: queries sent per torrent announced, and the fraction of
+  the K nodes closest to each torrent that store the announced peer.
+
+A fraction of the nodes can be made slow: datagrams to and from a slow node
+take ten times the latency longer.
+
+Usage: python simulator.py [numNodes] [numLookups] [latency] [loss] [seed] [slow]
+"""
+
+import sys
+import time
+import heapq
+import random
+import itertools
+import statistics
+
+import config
+from announcer import Announcer
+from nodecontext import NodeContext
+from tokensecret import TokenSecrets
+from krpc.krpc import KRPC
+from dht.node import Node
+from dht.peer import Peer
+from dht.lookup import Lookup
+import dht.nodepool
+from hash.hash import Hash
+
+class _DelayedCall:
+    """
+    A call scheduled on the virtual clock.
+    """
+    def __init__(self, time, f, args):
+        self.time = time
+        self.f = f
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualClock:
+    """
+    Class to represent a virtual clock with a queue of scheduled calls.
+    """
+    def __init__(self):
+        self.now = 0.0
+        self._queue = []
+        self._sequence = itertools.count()
+
+    def callLater(self, delay, f, *args):
+        """
+        Schedule f(*args) to be called after delay virtual seconds.
+        Returns an object with a cancel() method.
+        """
+        call = _DelayedCall(self.now + delay, f, args)
+        heapq.heappush(self._queue, (call.time, next(self._sequence), call))
+        return call
+
+    def advance(self, duration):
+        """
+        Run all calls scheduled in the next duration virtual seconds.
+        """
+        self.runUntil(self.now + duration)
+
+    def runUntil(self, until):
+        """
+        Run all calls scheduled up to the given virtual time.
+        """
+        while self._queue and self._queue[0][0] <= until:
+            (t, sequence, call) = heapq.heappop(self._queue)
+            self.now = t
+            if not call.cancelled:
+                call.f(*call.args)
+        self.now = until
+
+    def run(self):
+        """
+        Run scheduled calls until none are left.
+        """
+        while self._queue:
+            self.runUntil(self._queue[0][0])
+
+class DatagramBus:
+    """
+    Class to represent an in-memory network that carries datagrams
+    between simulated nodes.
+
+    Each datagram is delivered after latency plus a uniformly random
+    jitter (plus the extra delays of the sending and receiving node), or
+    dropped with probability loss.
+    """
+    def __init__(self, clock, random, latency=0.05, jitter=0.02, loss=0.0):
+        self.clock = clock
+        self.random = random
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+
+        # {(address, port): SimNode}
+        self.endpoints = {}
+        self.sent = 0
+        self.dropped = 0
+
+    def attach(self, simNode):
+        self.endpoints[simNode.node.host] = simNode
+
+    def send(self, fromSimNode, data, addressPort):
+        self.sent += 1
+        fromSimNode.packetsSent += 1
+
+        toSimNode = self.endpoints.get(addressPort)
+        if toSimNode == None or self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        delay = self.latency + self.random.uniform(0, self.jitter) + fromSimNode.extraDelay + toSimNode.extraDelay
+        self.clock.callLater(delay, toSimNode.deliver, data, fromSimNode.node.host)
+
+class SimKRPC(KRPC):
+    """
+    KRPC handler that sends datagrams over a DatagramBus and schedules
+    its timers on a VirtualClock.
+    """
+    def __init__(self, simNode, bus, context):
+        KRPC.__init__(self, context)
+        self.simNode = simNode
+        self.bus = bus
+
+    def _sendDatagram(self, data, addressPort):
+        self.bus.send(self.simNode, data, addressPort)
+
+    def _callLater(self, delay, f, *args):
+        return self.bus.clock.callLater(delay, f, *args)
+
+    def _seconds(self):
+        return self.bus.clock.now
+
+class SimNode:
+    """
+    Class to represent a simulated node, with its own node context.
+    """
+    def __init__(self, hash, addressPort, bus, tokenSecret):
+        self.node = Node(hash, addressPort)
+        self.context = NodeContext(
+            self.node,
+            tokenSecrets=TokenSecrets(secret=tokenSecret),
+            k=config.K,
+            maxNodesPerBucket=config.MAX_NODES_PER_BUCKET,
+            maxFailedQueries=config.MAX_FAILED_QUERIES,
+            maxPeersPerTorrent=config.MAX_PEERS_PER_TORRENT,
+            queryTimeout=config.QUERY_TIMEOUT,
+            minQueryTimeout=config.MIN_QUERY_TIMEOUT,
+            nodeCacheSize=config.NODE_CACHE_SIZE)
+        self.context.nodeCache.seconds = lambda: bus.clock.now
+        self.routingTable = self.context.routingTable
+        self.peerStorage = self.context.peerStorage
+        self.protocol = SimKRPC(self, bus, self.context)
+
+        self.packetsSent = 0
+        self.packetsReceived = 0
+
+        # Extra one-way delay of datagrams to and from this node
+        self.extraDelay = 0.0
+
+    def deliver(self, data, addressPort):
+        self.packetsReceived += 1
+        self.protocol.datagramReceived(data, addressPort)
+
+    def lookup(self, target, type, onDone):
+        """
+        Start a lookup from this node, starting at the closest nodes in its routing table.
+        """
+        lookup = Lookup(self.protocol, target, type)
+        lookup.start(self.routingTable.findClosestNodes(target), onDone)
+        return lookup
+
+class Network:
+    """
+    Class to represent a simulated network of nodes.
+    """
+    def __init__(self, numNodes, latency=0.05, jitter=0.02, loss=0.0, seed=0, slow=0.0):
+        self.random = random.Random(seed)
+        self.clock = VirtualClock()
+        self.bus = DatagramBus(self.clock, self.random, latency, jitter, loss)
+
+        self.nodes = []
+        for i in range(numNodes):
+            hash = Hash(self.randomID())
+            address = '10.%d.%d.%d' % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            simNode = SimNode(hash, (address, 6881), self.bus, self.random.getrandbits(160).to_bytes(20, byteorder='big'))
+            self.bus.attach(simNode)
+            self.nodes.append(simNode)
+
+        # Slow nodes are picked with a separate generator, so the rest of
+        # the run is the same as without slow nodes
+        if slow > 0:
+            slowRandom = random.Random(seed + 1)
+            for simNode in slowRandom.sample(self.nodes, int(slow * numNodes)):
+                simNode.extraDelay = 10 * latency
+
+        # All nodes, to rank against targets
+        self.pool = dht.nodepool.createNodePool(simNode.node for simNode in self.nodes)
+
+    def randomID(self):
+        return self.random.getrandbits(160).to_bytes(20, byteorder='big')
+
+    def trueClosest(self, target, k=None, exclude=None):
+        """
+        Get the K nodes in the network closest to the target.
+        """
+        if k == None:
+            k = config.K
+        nodes = self.pool.findClosestNodes(target, k + 1)
+        return [node for node in nodes if node is not exclude][:k]
+
+    def bootstrap(self, joinInterval):
+        """
+        Join the nodes to the network one by one, every joinInterval virtual
+        seconds. Each node learns about the first node and looks up its own ID.
+        """
+        bootstrapNode = self.nodes[0].node
+        for (i, simNode) in enumerate(self.nodes[1:]):
+            self.clock.callLater(i * joinInterval, self.__join, simNode, bootstrapNode)
+        self.clock.run()
+
+    def __join(self, simNode, bootstrapNode):
+        simNode.routingTable.addNode(Node(bootstrapNode.hash, bootstrapNode.host))
+        simNode.lookup(simNode.node.hash, b'find_node', lambda lookup: None)
+
+    def convergence(self, sample):
+        """
+        Get the mean fraction of the K nodes closest to their own ID in the
+        routing tables of the sampled nodes that are among the K truly
+        closest nodes.
+        """
+        fractions = []
+        for simNode in self.random.sample(self.nodes, min(sample, len(self.nodes))):
+            target = simNode.node.hash
+            trueClosest = set(bytes(node.hash) for node in self.trueClosest(target, exclude=simNode.node))
+            found = [node for node in simNode.routingTable.findClosestNodes(target) if bytes(node.hash) in trueClosest]
+            fractions.append(len(found) / len(trueClosest))
+        return statistics.mean(fractions)
+
+    def seedTorrents(self, numTorrents, peersPerTorrent=5):
+        """
+        Store peers for random torrents on the nodes closest to each
+        torrent, as announces would. Returns the torrent hashes.
+        """
+        torrents = []
+        for i in range(numTorrents):
+            hash = Hash(self.randomID())
+            peers = [Peer(('192.168.%d.%d' % (i & 0xff, j), 6881)) for j in range(peersPerTorrent)]
+            for node in self.trueClosest(hash):
+                simNode = self.bus.endpoints[node.host]
+                simNode.peerStorage.addPeers(hash, peers)
+            torrents.append(hash)
+        return torrents
+
+    def runLookups(self, targets, type):
+        """
+        Run a lookup for each target from a random node, all lookups at once.
+        Returns the finished lookups; the virtual time each lookup took is
+        set as its duration.
+        """
+        done = []
+        started = self.clock.now
+        def lookupDone(lookup):
+            lookup.duration = self.clock.now - started
+            done.append(lookup)
+        for target in targets:
+            simNode = self.random.choice(self.nodes)
+            simNode.lookup(target, type, lookupDone)
+        self.clock.run()
+        return done
+
+    def runAnnouncer(self, numTorrents, interval, duration):
+        """
+        Announce random torrents from a random node for duration virtual
+        seconds, re-announcing every interval seconds. Returns the announcer
+        and the torrent hashes.
+        """
+        simNode = self.random.choice(self.nodes)
+        announcer = Announcer(simNode.context, interval)
+        announcer.random = random.Random(self.random.getrandbits(32))
+        announcer.start(simNode.protocol, self.clock.callLater, lambda: self.clock.now)
+
+        peer = Peer((simNode.node.address(), 6881))
+        torrents = [Hash(self.randomID()) for i in range(numTorrents)]
+        for hash in torrents:
+            announcer.add(hash, peer)
+
+        self.clock.advance(duration)
+        announcer.stop()
+        self.clock.run()
+        return (announcer, torrents)
+
+    def storedFraction(self, torrents):
+        """
+        Get the fraction of the K nodes closest to the given torrents that
+        store peers for them.
+        """
+        stored = 0
+        total = 0
+        for hash in torrents:
+            for node in self.trueClosest(hash):
+                peers = []
+                self.bus.endpoints[node.host].peerStorage.getPeers(hash).addCallback(peers.append)
+                if peers and peers[0]:
+                    stored += 1
+                total += 1
+        return stored / total
+
+def summarize(name, values, maxFormat="%d"):
+    if not values:
+        return "%s: -" % name
+    values = sorted(values)
+    return ("%s: mean %.2f, median %.1f, max " + maxFormat) % (name, statistics.mean(values), values[len(values) // 2], values[-1])
+
+if __name__ == '__main__':
+    numNodes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    numLookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    loss = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    seed = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+    slow = float(sys.argv[6]) if len(sys.argv) > 6 else 0.0
+
+    start = time.time()
+    network = Network(numNodes, latency=latency, jitter=latency / 2, loss=loss, seed=seed, slow=slow)
+    network.bootstrap(joinInterval=0.05)
+    bootstrapTime = network.clock.now
+    bootstrapPackets = network.bus.sent
+
+    print("%d nodes, latency %.3fs, loss %.1f%%, seed %d, %.1f%% slow" % (numNodes, latency, loss * 100, seed, slow * 100))
+    print("bootstrap: %.1fs virtual, %.1fs real, %d packets (%d dropped)" % (bootstrapTime, time.time() - start, bootstrapPackets, network.bus.dropped))
+    print("routing table size: %s" % summarize("nodes", [len(simNode.routingTable) for simNode in network.nodes]))
+    print("convergence: %.1f%% of the K closest nodes known" % (network.convergence(100) * 100))
+
+    # find_node lookups of random targets
+    targets = [Hash(network.randomID()) for i in range(numLookups)]
+    lookups = network.runLookups(targets, b'find_node')
+    found = 0
+    for lookup in lookups:
+        closest = lookup.closestNodes()
+        if closest and closest[0].hash == network.trueClosest(lookup.target)[0].hash:
+            found += 1
+    print("find_node: %d/%d lookups found the closest node" % (found, numLookups))
+    print("  %s" % summarize("hops", [lookup.hops() for lookup in lookups if lookup.hops() != None]))
+    print("  %s" % summarize("queries", [lookup.queries for lookup in lookups]))
+    print("  %s" % summarize("time", [lookup.duration for lookup in lookups], "%.2fs"))
+
+    # get_peers lookups of torrents stored on the nodes closest to them
+    torrents = network.seedTorrents(numLookups)
+    lookups = network.runLookups(torrents, b'get_peers')
+    found = len([lookup for lookup in lookups if lookup.peers])
+    print("get_peers: %d/%d lookups found peers" % (found, numLookups))
+    print("  %s" % summarize("hops", [lookup.hops() for lookup in lookups if lookup.hops() != None]))
+    print("  %s" % summarize("queries", [lookup.queries for lookup in lookups]))
+    print("  %s" % summarize("time", [lookup.duration for lookup in lookups], "%.2fs"))
+
+    duration = network.clock.now
+    print("packets per node per second: %.2f sent, %.2f received (%.1fs virtual)" % (
+        network.bus.sent / numNodes / duration,
+        sum(simNode.packetsReceived for simNode in network.nodes) / numNodes / duration,
+        duration))
+
+    # Announces of torrents from a single node, re-announced every 10 minutes
+    (announcer, torrents) = network.runAnnouncer(numLookups, 600, 1800)
+    print("announcer: %d torrents announced %d times, %.1f queries per announce (%d lookup queries, %d announce_peer)" % (
+        len(torrents), announcer.announced, announcer.packetsPerAnnounce() or 0, announcer.queries, announcer.announces))
+    print("  %.1f%% of the K closest nodes store the peer" % (network.storedFraction(torrents) * 100))
+    print("real time: %.1fs" % (time.time() - start))
@@ -0,0 +1,112 @@
+"""
+@author Thomas Churchman
+
+Module that runs several node worker processes sharing one UDP port.
+
+The supervisor spawns worker processes that each bind the node's port with
+SO_REUSEPORT, so the kernel spreads incoming datagrams across the workers
+(and thereby across cores). The kernel picks a worker based on the source
+address and port, so a given remote node is normally served by the same
+worker every time.
+
+Each worker has its own routing table. The token secrets are shared through
+a memory-mapped file (see tokensecret.py), created by the supervisor and
+rotated by the first worker, so that a token returned by a get_peers on one
+worker is accepted by an announce_peer on another. Peer storage is shared:
+all workers use the same storage backend.
+"""
+
+import os
+import sys
+import signal
+import socket
+import subprocess
+
+import tokensecret
+
+# Environment variable used to pass the worker index to the workers
+WORKER_ENV = 'OTDHT_WORKER'
+
+def isWorker():
+    """
+    Check whether this process is a worker spawned by a supervisor.
+    """
+    return WORKER_ENV in os.environ
+    
+def workerIndex():
+    """
+    Get the index of this worker, or None if this process is not a worker.
+    """
+    if not isWorker():
+        return None
+    return int(os.environ[WORKER_ENV])
+    
+def reusePortSocket(address, port, family=socket.AF_INET):
+    """
+    Create a non-blocking UDP socket bound to the given address and port
+    with SO_REUSEPORT set, such that several processes can bind the same port.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise Exception('SO_REUSEPORT is not supported on this platform')
+        
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            # Leave IPv4 to the IPv4 socket bound to the same port
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(False)
+        sock.bind((address, port))
+    except:
+        sock.close()
+        raise
+    return sock
+
+def supervise(numWorkers, tokenSecretFile, tokenRotationInterval=300):
+    """
+    Spawn numWorkers workers running the current script and wait for them to exit.
+    
+    The token secret file the workers share is created before they are
+    spawned. A worker that dies is restarted. SIGINT and SIGTERM are
+    forwarded to the workers, after which the supervisor exits once all
+    workers have stopped.
+    """
+    if tokenSecretFile is None:
+        raise Exception('TOKEN_SECRET_FILE must be set to run several workers')
+    tokensecret.TokenSecrets(tokenSecretFile, tokenRotationInterval).close()
+
+    workers = {}
+    stopping = []
+    
+    def spawn(idx):
+        env = dict(os.environ)
+        env[WORKER_ENV] = str(idx)
+        process = subprocess.Popen([sys.executable] + sys.argv, env=env)
+        workers[process.pid] = (idx, process)
+        
+    def stop(signum, frame):
+        stopping.append(signum)
+        for (idx, process) in workers.values():
+            process.send_signal(signum)
+            
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    
+    for idx in range(numWorkers):
+        spawn(idx)
+        
+    while workers:
+        try:
+            (pid, status) = os.wait()
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            break
+            
+        if pid not in workers:
+            continue
+        (idx, process) = workers.pop(pid)
+        
+        if not stopping:
+            print("worker %d (pid %d) exited with status %d; restarting" % (idx, pid, status))
+            spawn(idx)
@@ -0,0 +1,70 @@
+"""
+@author Thomas Churchman
+
+Tests that the asyncio event loop and the peer storage run without Twisted.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import os
+import sys
+import unittest
+import subprocess
+
+import workerpool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class TestAsyncioWithoutTwisted(unittest.TestCase):
+    def assertDoesNotLoadTwisted(self, statement):
+        # A fresh interpreter, as this one may have loaded Twisted already
+        code = "import sys; %s; print('twisted' in sys.modules)" % statement
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+        self.assertEqual(output.strip(), b'False')
+
+    def testAio(self):
+        self.assertDoesNotLoadTwisted('import krpc.aio')
+
+    def testPeerStorage(self):
+        self.assertDoesNotLoadTwisted('import dht.peerstorage, workerpool')
+
+class TestCompletion(unittest.TestCase):
+    def testCallbacksChain(self):
+        results = []
+        completion = workerpool.Completion()
+        completion.addCallback(lambda result: result + 1)
+        completion.addCallback(results.append)
+        completion.callback(1)
+        self.assertEqual(results, [2])
+
+        # Added after completion: runs right away
+        completion.addBoth(results.append)
+        self.assertEqual(results, [2, None])
+
+    def testErrbacks(self):
+        failures = []
+        completion = workerpool.Completion()
+        completion.addCallback(lambda result: 1 / 0)
+        completion.addCallback(failures.append)
+        completion.addErrback(failures.append)
+        completion.callback(None)
+        self.assertEqual(len(failures), 1)
+        self.assertIs(failures[0].check(KeyError, ZeroDivisionError), ZeroDivisionError)
+
+    def testGather(self):
+        results = []
+        completions = [workerpool.Completion(), workerpool.Completion()]
+        workerpool.gather(completions).addCallback(results.append)
+        completions[1].callback('b')
+        self.assertEqual(results, [])
+        completions[0].callback('a')
+        self.assertEqual(results, [['a', 'b']])
+
+    def testGatherFails(self):
+        failures = []
+        gathered = workerpool.gather([workerpool.fail(workerpool.PoolSaturatedError()), workerpool.succeed(1)])
+        gathered.addErrback(failures.append)
+        self.assertTrue(failures[0].check(workerpool.PoolSaturatedError))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+@author Thomas Churchman
+
+Tests of the crawler's info-hash log.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import importlib.util
+
+import crawler
+import supervisor
+from crawler import InfohashLog
+from hash.hash import Hash
+from nodecontext import NodeContext
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def loadConfig(**settings):
+    """
+    Load the example configuration with the given settings changed.
+    """
+    spec = importlib.util.spec_from_file_location('config', os.path.join(ROOT, 'config.example.py'))
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    for (name, value) in settings.items():
+        setattr(config, name, value)
+    return config
+
+def key(i):
+    return i.to_bytes(20, byteorder='big')
+
+def readLog(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return [crawler.RECORD.unpack_from(data, offset) for offset in range(0, len(data), crawler.RECORD.size)], len(data)
+
+class TestInfohashLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'infohashes.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testUnique(self):
+        log = InfohashLog(self.path, 1000)
+        self.assertTrue(log.add(Hash(key(1)), 0))
+        self.assertFalse(log.add(Hash(key(1)), 1))
+        self.assertTrue(log.add(Hash(key(2)), 1))
+        log.close()
+        self.assertEqual((log.seen, log.unique), (3, 2))
+
+        # Logged info-hashes are loaded into the filter
+        log = InfohashLog(self.path, 1000)
+        self.assertEqual(log.unique, 2)
+        self.assertFalse(log.add(Hash(key(2)), 0))
+        log.close()
+
+    def testTornRecordIsCutOff(self):
+        log = InfohashLog(self.path, 1000)
+        log.add(Hash(key(1)), 0)
+        log.close()
+        with open(self.path, 'ab') as f:
+            f.write(key(2)[:7])
+        log = InfohashLog(self.path, 1000)
+        log.close()
+        self.assertEqual(os.path.getsize(self.path), crawler.RECORD.size)
+
+    def testWorkersConfiguredWithTheSameLog(self):
+        config = loadConfig(CRAWLER=True, CRAWLER_LOG=self.path, CRAWLER_CAPACITY=1000000,
+                            TOKEN_SECRET_FILE=os.path.join(self.dir, 'token_secret'),
+                            PEER_STORAGE='memory', WORKERS=2)
+        logs = []
+        try:
+            for index in range(2):
+                os.environ[supervisor.WORKER_ENV] = str(index)
+                logs.append(NodeContext.fromConfig(config).crawler.log)
+        finally:
+            del os.environ[supervisor.WORKER_ENV]
+
+        # Both workers log the same info-hashes, interleaved
+        for i in range(1000):
+            for (index, log) in enumerate(logs):
+                log.add(Hash(key(i)), index)
+                log.add(Hash(key(i)), index)
+        for log in logs:
+            log.close()
+
+        self.assertFalse(os.path.exists(self.path))
+        for (index, log) in enumerate(logs):
+            self.assertEqual(log.path, self.path + '.%d' % index)
+            self.assertEqual((log.seen, log.unique), (2000, 1000))
+            (records, size) = readLog(log.path)
+            self.assertEqual(size, 1000 * crawler.RECORD.size)
+            self.assertEqual([(hash, source) for (hash, timestamp, source) in records],
+                             [(key(i), index) for i in range(1000)])
+
+if __name__ == '__main__':
+    unittest.main()
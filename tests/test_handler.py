@@ -0,0 +1,121 @@
+"""
+@author Thomas Churchman
+
+Tests of the KRPC handler, independent of the event loop.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import unittest
+
+import bencodepy
+
+import utils
+from krpc.handler import KRPCHandler
+from nodecontext import NodeContext
+from dht.node import Node
+from hash.hash import Hash
+
+class Delayed:
+    def cancel(self):
+        pass
+
+class RecordingHandler(KRPCHandler):
+    """
+    Handler that records the datagrams it sends.
+    """
+    def __init__(self, context):
+        KRPCHandler.__init__(self, context)
+        # [(data, (address, port))]
+        self.sent = []
+
+    def _sendDatagram(self, data, addressPort):
+        self.sent.append((data, addressPort))
+
+    def _callLater(self, delay, f, *args):
+        return Delayed()
+
+class TestAnnouncePeer(unittest.TestCase):
+    def setUp(self):
+        self.context = NodeContext(Node(Hash(b'\x01' * 20), ('127.0.0.1', 8043)))
+        self.handler = RecordingHandler(self.context)
+        self.source = ('192.0.2.1', 6881)
+        self.token = bytes(utils.getToken(Node(None, self.source), self.context.tokenSecrets.current()))
+
+    def announce(self, token):
+        self.handler.datagramReceived(bencodepy.encode({
+            't': b'aa', 'y': 'q', 'q': 'announce_peer',
+            'a': {'id': b'\x02' * 20, 'info_hash': b'\x03' * 20, 'port': 6882, 'token': token}
+        }), self.source)
+        self.assertEqual(len(self.handler.sent), 1)
+        (data, addressPort) = self.handler.sent.pop()
+        self.assertEqual(addressPort, self.source)
+        return bencodepy.decode(data)
+
+    def testValidToken(self):
+        self.assertEqual(self.announce(self.token)[b'y'], b'r')
+
+    def testShortTokenIsRejected(self):
+        for token in [b'\x00' * 4, b'\x00' * 8, self.token[:8]]:
+            reply = self.announce(token)
+            self.assertEqual(reply[b'y'], b'e')
+            self.assertEqual(reply[b'e'][0], 203)
+
+class TestWant(unittest.TestCase):
+    """
+    Tests of the nodes returned to find_node queries by address family (BEP 32).
+    """
+    def setUp(self):
+        self.context = NodeContext(Node(Hash(b'\x01' * 20), ('127.0.0.1', 8043)), ipv6=True)
+        self.handler = RecordingHandler(self.context)
+        for i in range(4):
+            self.context.routingTable.addNode(Node(Hash(bytes([0x80 + i]) * 20), ('192.0.2.%d' % (i + 10), 6881)))
+            self.context.routingTable6.addNode(Node(Hash(bytes([0x90 + i]) * 20), ('2001:db8::%d' % (i + 10), 6881)))
+
+    def findNode(self, source, want=None):
+        """
+        Send a find_node query and get the IDs of the IPv4 and IPv6 nodes
+        returned, or None for a field that was left out.
+        """
+        arguments = {'id': b'\x02' * 20, 'target': b'\x03' * 20}
+        if want is not None:
+            arguments['want'] = want
+        self.handler.datagramReceived(bencodepy.encode({'t': b'aa', 'y': 'q', 'q': 'find_node', 'a': arguments}), source)
+        (data, addressPort) = self.handler.sent.pop()
+        response = bencodepy.decode(data)[b'r']
+        ids = []
+        for (key, size) in [(b'nodes', 26), (b'nodes6', 38)]:
+            if key in response:
+                ids.append(set(response[key][i:i + 20] for i in range(0, len(response[key]), size)))
+            else:
+                ids.append(None)
+        return ids
+
+    def testQueryFamily(self):
+        # The querying node is added to the routing table of its family first
+        (ids, ids6) = self.findNode(('192.0.2.1', 6881))
+        self.assertEqual(ids, set(bytes([0x80 + i]) * 20 for i in range(4)) | set([b'\x02' * 20]))
+        self.assertIsNone(ids6)
+
+        (ids, ids6) = self.findNode(('2001:db8::1', 6881))
+        self.assertIsNone(ids)
+        self.assertEqual(ids6, set(bytes([0x90 + i]) * 20 for i in range(4)) | set([b'\x02' * 20]))
+
+    def testWantBoth(self):
+        (ids, ids6) = self.findNode(('192.0.2.1', 6881), [b'n4', b'n6'])
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(ids6, set(bytes([0x90 + i]) * 20 for i in range(4)))
+
+    def testWantWithoutIPv6(self):
+        self.context.ipv6 = False
+        (ids, ids6) = self.findNode(('192.0.2.1', 6881), [b'n4', b'n6'])
+        self.assertEqual(len(ids), 5)
+        self.assertIsNone(ids6)
+
+        # Only IPv6 nodes wanted: the nodes of the query's family instead
+        (ids, ids6) = self.findNode(('192.0.2.1', 6881), [b'n6'])
+        self.assertEqual(len(ids), 5)
+        self.assertIsNone(ids6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+"""
+@author Thomas Churchman
+
+Tests of handing the node over to a new process.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import os
+import time
+import queue
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+
+import bencodepy
+
+import handoff
+from handoff import Handoff
+from handoff import Takeover
+from dht.peerstorage import BufferedPeerStorage
+from dht.peerstorage import FilePeerStorage
+from dht.peerstorage import MemoryPeerStorage
+from dht.peer import Peer
+from dht.node import Node
+from hash.hash import Hash
+from nodecontext import NodeContext
+
+class OldProcess:
+    """
+    The old process's side of a handoff: sends a UDP socket and an empty
+    state to the process connecting to the handoff socket.
+    """
+    def __init__(self, path):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(1)
+        self.connection = None
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.start()
+
+    def __run(self):
+        (self.connection, address) = self.listener.accept()
+        state = bencodepy.encode({
+            'transactionID': 1,
+            'tokenSecrets': [int(time.time() * 1000), b'\x01' * 20, b'\x02' * 20],
+            'tables': [],
+            'announces': []
+        })
+        handoff._sendFds(self.connection, handoff.STATE_HEADER.pack(len(state)), [self.udp.fileno()])
+        self.connection.sendall(state)
+
+    def close(self):
+        self.thread.join()
+        self.connection.close()
+        self.listener.close()
+        self.udp.close()
+
+class TestTakeover(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'handoff.sock')
+        self.old = OldProcess(self.path)
+        self.storage = FilePeerStorage(os.path.join(self.dir, 'peers'))
+        self.context = NodeContext(Node(Hash(b'\x01' * 20), ('127.0.0.1', 8043)),
+                                   peerStorage=BufferedPeerStorage(self.storage, 5, 1000))
+        self.takeover = Takeover(self.path)
+        # [(delay, f)]
+        self.calls = []
+
+    def tearDown(self):
+        self.old.close()
+        for sock in self.takeover.sockets.values():
+            sock.close()
+        self.takeover.connection.close()
+        shutil.rmtree(self.dir)
+
+    def callLater(self, delay, f, *args):
+        self.calls.append((delay, f))
+
+    def testSharedUntilForwardingStops(self):
+        self.takeover.restore(self.context, {})
+        self.assertTrue(self.storage.shared)
+
+        self.takeover.ready(self.callLater)
+        self.assertEqual(self.old.connection.recv(1), b'R')
+        self.assertIsNotNone(self.context.handoffForward)
+
+        # A torrent the old process creates while it drains
+        name = '%040x' % 7
+        os.makedirs(os.path.join(self.dir, 'peers', name[0:2], name[2:4]))
+        open(os.path.join(self.dir, 'peers', name[0:2], name[2:4], name), 'wb').close()
+        self.assertTrue(self.storage._torrentExists(Hash((7).to_bytes(20, byteorder='big'))))
+
+        [(delay, stopForwarding)] = self.calls
+        stopForwarding()
+        self.assertIsNone(self.context.handoffForward)
+        self.assertFalse(self.storage.shared)
+
+    def testForwardDoesNotBlock(self):
+        self.takeover.restore(self.context, {})
+        self.takeover.ready(self.callLater)
+        self.assertEqual(self.old.connection.recv(1), b'R')
+
+        # The old process does not read while the buffer fills up
+        count = 2000
+        for i in range(count):
+            self.context.handoffForward(i.to_bytes(2, byteorder='big') * 500, ('192.0.2.1', 6881))
+        self.assertGreater(self.takeover.dropped, 0)
+
+        # The datagrams that were not dropped arrive whole, once the rest of
+        # a partly sent one is sent with the next
+        self.old.connection.setblocking(False)
+        data = readAll(self.old.connection)
+        self.context.handoffForward(b'last', ('192.0.2.1', 6881))
+        data += readAll(self.old.connection)
+
+        forwarded = []
+        while data:
+            (port, addressLength, length) = handoff.FORWARD_HEADER.unpack_from(data)
+            offset = handoff.FORWARD_HEADER.size + addressLength
+            self.assertEqual((port, data[handoff.FORWARD_HEADER.size:offset]), (6881, socket.inet_aton('192.0.2.1')))
+            forwarded.append(data[offset:offset + length])
+            data = data[offset + length:]
+        self.assertEqual(len(forwarded), count + 1 - self.takeover.dropped)
+        self.assertEqual(forwarded[-1], b'last')
+        for datagram in forwarded[:-1]:
+            self.assertEqual(datagram, datagram[:2] * 500)
+
+def readAll(sock):
+    data = b''
+    while True:
+        try:
+            chunk = sock.recv(65536)
+        except BlockingIOError:
+            return data
+        data += chunk
+
+class Protocol:
+    _nextTransactionID = 1
+
+class TestFailedHandoff(unittest.TestCase):
+    """
+    Tests of the old process's side of a handoff to a new process that
+    exits before it serves.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'handoff.sock')
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.storage = BufferedPeerStorage(MemoryPeerStorage(), 5, 1000)
+        self.context = NodeContext(Node(Hash(b'\x01' * 20), ('127.0.0.1', 8043)), peerStorage=self.storage)
+        # Functions called on the event loop thread
+        self.calls = queue.Queue()
+        self.listening = True
+        self.handoff = Handoff(self.context, self.path, {socket.AF_INET: self.udp.fileno()}, {socket.AF_INET: Protocol()},
+                               None, lambda f, *args: self.calls.put((f, args)),
+                               release=None, reopen=self.reopen, stopReading=None, stop=None)
+
+    def tearDown(self):
+        self.udp.close()
+        shutil.rmtree(self.dir)
+
+    def reopen(self):
+        self.listening = True
+
+    def testFailureKeepsServing(self):
+        hash = Hash(b'\x03' * 20)
+        peers = [Peer(('192.0.2.1', 6881)), Peer(('192.0.2.2', 6881), True)]
+        self.storage.addPeers(hash, peers)
+
+        # As Handoff.start, without starting a process
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(1)
+        self.listening = False
+        self.handoff._thread = threading.Thread(target=self.handoff._Handoff__run, args=(listener,))
+        self.handoff._thread.start()
+        thread = self.handoff._thread
+
+        # The new process takes the state over, then exits
+        def newProcess():
+            takeover = Takeover(self.path)
+            for sock in takeover.sockets.values():
+                sock.close()
+            takeover.connection.close()
+        newThread = threading.Thread(target=newProcess)
+        newThread.start()
+
+        while not self.listening:
+            (f, args) = self.calls.get(timeout=5)
+            f(*args)
+            if f.__name__ == 'serialize':
+                self.assertEqual(self.storage.buffer, {})
+        thread.join()
+        newThread.join()
+
+        self.assertIsNone(self.handoff._thread)
+        self.assertEqual(self.storage.takeBuffered(), [(hash, peers)])
+
+    def testPathIsNotASocket(self):
+        with open(self.path, 'w') as f:
+            f.write('not a socket')
+        self.handoff.release = self.fail
+        self.handoff.start()
+        self.assertIsNone(self.handoff._thread)
+        self.assertTrue(os.path.isfile(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
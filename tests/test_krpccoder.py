@@ -0,0 +1,124 @@
+"""
+@author Thomas Churchman
+
+Tests of the KRPC codec.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import unittest
+
+import bencodepy
+
+import krpc.krpccoder
+from krpc.krpccoder import KRPCQuery
+from krpc.krpccoder import KRPCResponse
+from nodecontext import NodeContext
+from dht.node import Node
+from dht.peer import Peer
+from hash.hash import Hash
+
+# Default response budgets (MAX_RESPONSE_SIZE and MAX_RESPONSE_SIZE6)
+BUDGET = 1400
+BUDGET6 = 1232
+
+def address(i, ipv6):
+    if ipv6:
+        return '2001:db8::%x' % i
+    return '10.0.%d.%d' % (i // 256, i % 256)
+
+def nodes(count, ipv6):
+    return [Node(Hash(i.to_bytes(20, byteorder='big')), (address(i, ipv6), 6881)) for i in range(1, count + 1)]
+
+class TestResponseBudget(unittest.TestCase):
+    def setUp(self):
+        self.fromNode = Node(Hash(b'\x01' * 20), ('127.0.0.1', 8043))
+
+    def encode(self, budget, **arguments):
+        response = KRPCResponse(transactionID=b'aa', fromNode=self.fromNode, **arguments)
+        encoded = krpc.krpccoder.encode(response, budget)
+        self.assertLessEqual(len(encoded), budget)
+        self.assertTrue(response.truncated)
+        return bencodepy.decode(encoded)[b'r']
+
+    def testGetPeers(self):
+        for (ipv6, budget, count) in [(False, BUDGET, 164), (True, BUDGET6, 54)]:
+            peers = [Peer((address(i, ipv6), 6881)) for i in range(2000)]
+            decoded = self.encode(budget, type=b'get_peers', token=b'\x00' * 20, peers=peers)
+            self.assertEqual(len(decoded[b'values']), count)
+            self.assertEqual(len(set(decoded[b'values'])), count)
+
+    def testFindNode(self):
+        for (ipv6, budget, count) in [(False, BUDGET, 51), (True, BUDGET6, 30)]:
+            key = b'nodes6' if ipv6 else b'nodes'
+            arguments = {'nodes6' if ipv6 else 'nodes': nodes(100, ipv6)}
+            decoded = self.encode(budget, type=b'find_node', **arguments)
+            self.assertEqual(len(decoded[key]), count * (38 if ipv6 else 26))
+            # The closest nodes are kept
+            self.assertEqual(decoded[key][:20], (1).to_bytes(20, byteorder='big'))
+
+    def testFindNodeBothFamilies(self):
+        decoded = self.encode(BUDGET, type=b'find_node', nodes=nodes(100, False), nodes6=nodes(100, True))
+        self.assertEqual(len(decoded[b'nodes']), 51 * 26)
+        # No room is left for a single IPv6 node
+        self.assertNotIn(b'nodes6', decoded)
+
+class TestDualStack(unittest.TestCase):
+    """
+    Tests of the IPv6 extensions (BEP 32).
+    """
+    def setUp(self):
+        self.context = NodeContext(Node(Hash(b'\x01' * 20), ('127.0.0.1', 8043)), ipv6=True)
+
+    def decodeQuery(self, arguments, addressPort):
+        arguments = dict(arguments, id=b'\x02' * 20, target=b'\x03' * 20)
+        data = bencodepy.encode({'t': b'aa', 'y': 'q', 'q': 'find_node', 'a': arguments})
+        return krpc.krpccoder.decode(data, addressPort, self.context)
+
+    def testWantDefaultsToQueryFamily(self):
+        self.assertEqual(self.decodeQuery({}, ('192.0.2.1', 6881)).want, set([b'n4']))
+        self.assertEqual(self.decodeQuery({}, ('2001:db8::1', 6881)).want, set([b'n6']))
+
+    def testWant(self):
+        query = self.decodeQuery({'want': [b'n4', b'n6']}, ('192.0.2.1', 6881))
+        self.assertEqual(query.want, set([b'n4', b'n6']))
+
+    def testEncodeWant(self):
+        query = KRPCQuery(transactionID=b'aa', fromNode=self.context.thisNode, type=b'get_peers',
+                          targetID=Hash(b'\x03' * 20), want=set([b'n6', b'n4']))
+        encoded = bencodepy.decode(krpc.krpccoder.encode(query))
+        self.assertEqual(encoded[b'a'][b'want'], [b'n4', b'n6'])
+
+    def decodeResponse(self, response, toNode):
+        """
+        Decode a response from toNode to a find_node query of this node.
+        """
+        query = KRPCQuery(transactionID=b'aa', fromNode=self.context.thisNode, toNode=toNode, type=b'find_node')
+        self.context.outstandingQueries[b'aa'] = (query, toNode, 0)
+        data = bencodepy.encode({'t': b'aa', 'y': 'r', 'r': response})
+        return krpc.krpccoder.decode(data, toNode.host, self.context)
+
+    def testNodes6(self):
+        toNode = Node(Hash(b'\x02' * 20), ('2001:db8::1', 6881))
+        # 2001:db8::2 port 6882
+        nodes6 = b'\x04' * 20 + bytes.fromhex('20010db8000000000000000000000002') + b'\x1a\xe2'
+        nodes = b'\x05' * 20 + bytes([192, 0, 2, 5]) + b'\x1a\xe3'
+        decoded = self.decodeResponse({'id': bytes(toNode.hash), 'nodes6': nodes6 * 2, 'nodes': nodes}, toNode)
+        self.assertEqual([(bytes(node.hash), node.host) for node in decoded.nodes6], [(b'\x04' * 20, ('2001:db8::2', 6882))] * 2)
+        self.assertEqual([(bytes(node.hash), node.host) for node in decoded.nodes], [(b'\x05' * 20, ('192.0.2.5', 6883))])
+
+    def testEncodeNodes6(self):
+        response = KRPCResponse(transactionID=b'aa', fromNode=self.context.thisNode, type=b'find_node',
+                                nodes6=[Node(Hash(b'\x04' * 20), ('2001:db8::2', 6882))])
+        encoded = bencodepy.decode(krpc.krpccoder.encode(response))
+        self.assertEqual(encoded[b'r'][b'nodes6'], b'\x04' * 20 + bytes.fromhex('20010db8000000000000000000000002') + b'\x1a\xe2')
+        self.assertNotIn(b'nodes', encoded[b'r'])
+
+    def testValues6(self):
+        response = KRPCResponse(transactionID=b'aa', fromNode=self.context.thisNode, type=b'get_peers',
+                                token=b'\x00' * 4, peers=[Peer(('2001:db8::2', 6882))])
+        encoded = bencodepy.decode(krpc.krpccoder.encode(response))
+        self.assertEqual(encoded[b'r'][b'values'], [bytes.fromhex('20010db8000000000000000000000002') + b'\x1a\xe2'])
+
+if __name__ == '__main__':
+    unittest.main()
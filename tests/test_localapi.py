@@ -0,0 +1,44 @@
+"""
+@author Thomas Churchman
+
+Tests of the local API's socket handling.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import os
+import socket
+import shutil
+import tempfile
+import unittest
+
+import localapi
+
+class TestRemoveStaleSocket(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'otdht.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testMissing(self):
+        localapi._removeStaleSocket(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def testStaleSocket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+        localapi._removeStaleSocket(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def testRegularFileIsKept(self):
+        with open(self.path, 'w') as f:
+            f.write('not a socket')
+        with self.assertRaises(Exception):
+            localapi._removeStaleSocket(self.path)
+        self.assertTrue(os.path.isfile(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+@author Thomas Churchman
+
+Tests of iterative lookups.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import socket
+import unittest
+
+from dht.lookup import Lookup
+from dht.node import Node
+from hash.hash import Hash
+from krpc.krpccoder import KRPCResponse
+from nodecontext import NodeContext
+
+class QueryingProtocol:
+    """
+    Stands in for a KRPCHandler: records the queries sent, which are
+    answered by hand.
+    """
+    def __init__(self, context):
+        self.context = context
+        # [(KRPCQuery, callback, errback)]
+        self.queries = []
+
+    def sendQuery(self, krpcQuery, timeout=None, onSlow=None):
+        return krpcQuery
+
+    def whenAnswered(self, waiter, callback, errback):
+        self.queries.append((waiter, callback, errback))
+
+def node(i, address):
+    return Node(Hash(bytes([i]) * 20), (address, 6881))
+
+class TestLookup(unittest.TestCase):
+    def setUp(self):
+        self.context = NodeContext(Node(Hash(b'\x01' * 20), ('127.0.0.1', 8043)), ipv6=True)
+
+    def lookup(self, family):
+        """
+        Start a lookup from one node, which answers with two IPv4 and two
+        IPv6 nodes. Returns the addresses of the nodes queried next.
+        """
+        protocol = QueryingProtocol(self.context)
+        start = node(0x10, '192.0.2.1') if family == socket.AF_INET else node(0x10, '2001:db8::1')
+        lookup = Lookup(protocol, Hash(b'\x20' * 20), family=family)
+        lookup.start([start], lambda lookup: None)
+        [(query, callback, errback)] = protocol.queries
+
+        response = KRPCResponse(fromNode=start, type=b'find_node',
+                                nodes=[node(0x21, '192.0.2.2'), node(0x22, '192.0.2.3')],
+                                nodes6=[node(0x23, '2001:db8::2'), node(0x24, '2001:db8::3')])
+        callback(response)
+        return set(query.toNode.address() for (query, callback, errback) in protocol.queries[1:])
+
+    def testIPv4LookupSkipsIPv6Nodes(self):
+        self.assertEqual(self.lookup(socket.AF_INET), set(['192.0.2.2', '192.0.2.3']))
+
+    def testIPv6LookupSkipsIPv4Nodes(self):
+        self.assertEqual(self.lookup(socket.AF_INET6), set(['2001:db8::2', '2001:db8::3']))
+
+if __name__ == '__main__':
+    unittest.main()
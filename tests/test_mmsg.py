@@ -0,0 +1,147 @@
+"""
+@author Thomas Churchman
+
+Tests of the batched UDP transport (Linux only).
+
+Run from the repository root: python -m pytest tests
+"""
+
+import time
+import socket
+import unittest
+
+import krpc.mmsg
+
+@unittest.skipUnless(krpc.mmsg.isSupported(), 'recvmmsg/sendmmsg are not available')
+class TestMMsgSocket(unittest.TestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.setblocking(False)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender.bind(('127.0.0.1', 0))
+        self.mmsgSocket = krpc.mmsg.MMsgSocket(self.receiver, batchSize=4, maxPacketSize=64)
+
+    def tearDown(self):
+        self.receiver.close()
+        self.sender.close()
+
+    def testTruncatedDatagramsAreSkipped(self):
+        address = self.receiver.getsockname()
+        for data in [b'a' * 10, b'b' * 100, b'c' * 64]:
+            self.sender.sendto(data, address)
+
+        datagrams = self.mmsgSocket.recv()
+        self.assertEqual([data for (data, addressPort) in datagrams], [b'a' * 10, b'c' * 64])
+        self.assertEqual(datagrams[0][1], self.sender.getsockname())
+        self.assertEqual(self.mmsgSocket.received, 3)
+        self.assertEqual(self.mmsgSocket.truncated, 1)
+
+        self.assertEqual(self.mmsgSocket.recv(), [])
+        self.assertEqual(self.mmsgSocket.received, 0)
+
+class DelayedCall:
+    def __init__(self, f):
+        self.f = f
+        self.called = False
+        self.cancelled = False
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+
+class Reactor:
+    """
+    Reactor that runs delayed calls when asked to.
+    """
+    def __init__(self):
+        # [DelayedCall]
+        self.calls = []
+
+    def addReader(self, reader):
+        pass
+
+    def removeReader(self, reader):
+        pass
+
+    def callLater(self, delay, f, *args):
+        call = DelayedCall(lambda: f(*args))
+        self.calls.append(call)
+        return call
+
+    def runCalls(self):
+        (calls, self.calls) = (self.calls, [])
+        for call in calls:
+            if call.active():
+                call.called = True
+                call.f()
+
+class EchoProtocol:
+    """
+    Protocol that echoes the datagrams it receives, and records the
+    transport it is served by.
+    """
+    def makeConnection(self, transport):
+        self.transport = transport
+
+    def doStop(self):
+        pass
+
+    def datagramsReceived(self, datagrams):
+        for (data, addressPort) in datagrams:
+            self.transport.write(data, addressPort)
+
+@unittest.skipUnless(krpc.mmsg.isSupported(), 'recvmmsg/sendmmsg are not available')
+class TestMMsgPort(unittest.TestCase):
+    def setUp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.setblocking(False)
+        self.address = sock.getsockname()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1', 0))
+        self.client.settimeout(1)
+
+        self.reactor = Reactor()
+        self.protocol = EchoProtocol()
+        self.port = krpc.mmsg.listenMMsg(self.reactor, sock, self.protocol, batchSize=4)
+
+        # [[(data, (address, port))]] passed to sendmmsg
+        self.sends = []
+        send = self.port.mmsgSocket.send
+        def recordingSend(datagrams):
+            self.sends.append(list(datagrams))
+            return send(datagrams)
+        self.port.mmsgSocket.send = recordingSend
+
+    def tearDown(self):
+        self.port.stopListening()
+        self.client.close()
+
+    def testWritesOutsideABatchAreBatched(self):
+        # Replies completed by the storage worker pool
+        client = self.client.getsockname()
+        for data in [b'a', b'b', b'c']:
+            self.port.write(data, client)
+        self.assertEqual(self.sends, [])
+
+        self.reactor.runCalls()
+        self.assertEqual(self.sends, [[(b'a', client), (b'b', client), (b'c', client)]])
+        self.assertEqual([self.client.recv(64) for i in range(3)], [b'a', b'b', b'c'])
+
+    def testWritesOutsideABatchJoinTheNextBatch(self):
+        client = self.client.getsockname()
+        self.port.write(b'a', client)
+        self.client.sendto(b'b', self.address)
+        time.sleep(0.01)
+        self.port.doRead()
+        self.assertEqual(self.sends, [[(b'a', client), (b'b', client)]])
+
+        # The flush that was scheduled has nothing left to send
+        self.reactor.runCalls()
+        self.assertEqual(len(self.sends), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""
+@author Thomas Churchman
+
+Tests of the peer storages.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import shutil
+import tempfile
+import unittest
+from socket import AF_INET
+from socket import AF_INET6
+
+import workerpool
+from dht.peer import Peer
+from dht.peerstorage import MemoryPeerStorage
+from dht.peerstorage import FilePeerStorage
+from dht.peerstorage import BufferedPeerStorage
+from hash.hash import Hash
+
+class ManualPool:
+    """
+    Worker pool whose jobs run when the test says so.
+    """
+    def __init__(self):
+        # [(Completion, f, args)]
+        self.jobs = []
+
+    def isSaturated(self):
+        return False
+
+    def submit(self, f, *args):
+        completion = workerpool.Completion()
+        self.jobs.append((completion, f, args))
+        return completion
+
+    def run(self, index=0):
+        """
+        Run the job at the given index and deliver its result.
+        """
+        (completion, f, args) = self.jobs.pop(index)
+        completion.callback(f(*args))
+
+def results(completion):
+    collected = []
+    completion.addCallback(collected.append)
+    return collected
+
+class PeerStorageTests:
+    """
+    Tests shared by the peer storage backends; createStorage(maxPeersPerTorrent)
+    creates the storage under test.
+    """
+    def setUp(self):
+        self.storage = self.createStorage(2)
+        self.hash = Hash(b'\x01' * 20)
+
+    def testAddPeers(self):
+        peers = [Peer(('192.0.2.1', 6881)), Peer(('2001:db8::1', 6881)), Peer(('192.0.2.1', 6881)), Peer(('192.0.2.2', 6881))]
+        self.assertEqual(results(self.storage.addPeers(self.hash, peers)), [[True, True, False, True]])
+        self.assertEqual(results(self.storage.getPeers(self.hash)), [[peers[0], peers[3], peers[1]]])
+        self.assertEqual(results(self.storage.getPeers(self.hash, AF_INET6)), [[peers[1]]])
+
+    def testPeersPerTorrentLimitedPerFamily(self):
+        peers = [Peer(('192.0.2.%d' % i, 6881)) for i in range(3)] + [Peer(('2001:db8::1', 6881))]
+        self.assertEqual(results(self.storage.addPeers(self.hash, peers)), [[True, True, False, True]])
+        self.assertEqual(len(results(self.storage.getPeers(self.hash, AF_INET))[0]), 2)
+
+    def testSeederStatusUpdated(self):
+        self.storage.addPeer(self.hash, Peer(('192.0.2.1', 6881)))
+        self.assertEqual(results(self.storage.addPeer(self.hash, Peer(('192.0.2.1', 6881), True))), [False])
+        self.assertEqual(results(self.storage.getPeers(self.hash)), [[Peer(('192.0.2.1', 6881), True)]])
+
+    def testSeederStatusUpdatedInOneWrite(self):
+        peers = [Peer(('192.0.2.1', 6881)), Peer(('192.0.2.2', 6881)), Peer(('192.0.2.1', 6881), True)]
+        self.assertEqual(results(self.storage.addPeers(self.hash, peers)), [[True, True, False]])
+        self.assertEqual(results(self.storage.getPeers(self.hash)), [[peers[2], peers[1]]])
+
+class TestMemoryPeerStorage(PeerStorageTests, unittest.TestCase):
+    def createStorage(self, maxPeersPerTorrent):
+        return MemoryPeerStorage(maxPeersPerTorrent)
+
+class TestFilePeerStorage(PeerStorageTests, unittest.TestCase):
+    def createStorage(self, maxPeersPerTorrent):
+        self.dir = tempfile.mkdtemp()
+        return FilePeerStorage(self.dir, maxPeersPerTorrent=maxPeersPerTorrent)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.dir)
+
+    def testSeederStatusIsPersisted(self):
+        self.storage.addPeers(self.hash, [Peer(('192.0.2.1', 6881)), Peer(('192.0.2.2', 6881))])
+        self.storage.addPeer(self.hash, Peer(('192.0.2.1', 6881), True))
+        self.storage.close()
+        storage = FilePeerStorage(self.dir)
+        self.assertEqual(results(storage.getPeers(self.hash)), [[Peer(('192.0.2.1', 6881), True), Peer(('192.0.2.2', 6881))]])
+        storage.close()
+
+class TestBufferedPeerStorage(unittest.TestCase):
+    def setUp(self):
+        self.pool = ManualPool()
+        self.storage = BufferedPeerStorage(MemoryPeerStorage(), 60, 1000)
+        self.storage.setPool(self.pool)
+        self.hash = Hash(b'\x01' * 20)
+        self.peer = Peer(('192.0.2.1', 6881))
+
+    def testBufferedPeersAreRead(self):
+        self.storage.addPeer(self.hash, self.peer)
+        peers = results(self.storage.getPeers(self.hash))
+        self.pool.run()
+        self.assertEqual(peers, [[self.peer]])
+
+    def testPeersBeingWrittenAreRead(self):
+        self.storage.addPeer(self.hash, self.peer)
+        self.storage.flush()
+        self.assertEqual(self.storage.buffer, {})
+
+        # Read before the write has run
+        peers = results(self.storage.getPeers(self.hash))
+        self.pool.run(1)
+        self.assertEqual(peers, [[self.peer]])
+
+        self.pool.run()
+        self.assertEqual(self.storage.writing, {})
+        peers = results(self.storage.getPeers(self.hash))
+        self.pool.run()
+        self.assertEqual(peers, [[self.peer]])
+
+    def testWriteReportedBeforeEarlierRead(self):
+        self.storage.addPeer(self.hash, self.peer)
+        self.storage.flush()
+        # The read is submitted after the write but runs first, and its
+        # result is delivered after the write's
+        peers = results(self.storage.getPeers(self.hash))
+        (completion, read, readArgs) = self.pool.jobs.pop(1)
+        stale = read(*readArgs)
+        self.pool.run()
+        completion.callback(stale)
+        self.assertEqual(peers, [[self.peer]])
+
+    def testFailedWritesAreBufferedAgain(self):
+        self.storage.addPeer(self.hash, self.peer)
+        self.storage.flush()
+        (completion, f, args) = self.pool.jobs.pop()
+        completion.errback(IOError('disk full'))
+        self.assertEqual(self.storage.writing, {})
+        self.assertEqual(self.storage.bufferedPeers, 1)
+        peers = results(self.storage.getPeers(self.hash))
+        self.pool.run()
+        self.assertEqual(peers, [[self.peer]])
+
+    def testSeederStatusUpdated(self):
+        seeder = Peer(self.peer.host, True)
+        self.storage.addPeer(self.hash, self.peer)
+        self.storage.flush()
+        self.pool.run()
+
+        # Buffered once, over the stored peer
+        self.storage.addPeer(self.hash, self.peer)
+        self.storage.addPeer(self.hash, seeder)
+        self.assertEqual(self.storage.bufferedPeers, 1)
+        peers = results(self.storage.getPeers(self.hash))
+        self.pool.run()
+        self.assertEqual(peers, [[seeder]])
+
+if __name__ == '__main__':
+    unittest.main()
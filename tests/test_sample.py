@@ -0,0 +1,155 @@
+"""
+@author Thomas Churchman
+
+Tests of sample_infohashes (BEP 51): the reservoir of info-hashes, and the
+encoding and decoding of queries and responses.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import random
+import unittest
+
+import bencodepy
+
+import krpc.krpccoder
+from krpc.krpccoder import KRPCQuery
+from krpc.krpccoder import KRPCResponse
+from dht.peerstorage import InfohashSample
+from dht.peerstorage import MemoryPeerStorage
+from dht.peerstorage import MIN_SAMPLE_INTERVAL
+from dht.peerstorage import MAX_SAMPLE_INTERVAL
+from dht.peer import Peer
+from dht.node import Node
+from hash.hash import Hash
+from nodecontext import NodeContext
+
+from test_handler import RecordingHandler
+
+def key(i):
+    return i.to_bytes(20, byteorder='big')
+
+class TestInfohashSample(unittest.TestCase):
+    def testFewerTorrentsThanSampleSize(self):
+        sample = InfohashSample(size=4)
+        sample.load([key(1), key(2)])
+        sample.add(key(3))
+        self.assertEqual(sample.samples(), key(1) + key(2) + key(3))
+        self.assertEqual(sample.num(), 3)
+
+    def testSampleSizeIsBounded(self):
+        sample = InfohashSample(size=4)
+        sample.load(key(i) for i in range(100))
+        for i in range(100, 200):
+            sample.add(key(i))
+        samples = sample.samples()
+        self.assertEqual(len(samples), 4 * 20)
+        self.assertEqual(len(set(samples[i:i + 20] for i in range(0, len(samples), 20))), 4)
+        self.assertEqual(sample.num(), 200)
+
+    def testSampleIsUniform(self):
+        # Each of 50 torrents is in a sample of 10 with probability 1/5
+        counts = [0] * 50
+        trials = 2000
+        for trial in range(trials):
+            sample = InfohashSample(size=10)
+            sample._random = random.Random(trial)
+            for i in range(50):
+                sample.add(key(i))
+            samples = sample.samples()
+            for j in range(0, len(samples), 20):
+                counts[int.from_bytes(samples[j:j + 20], byteorder='big')] += 1
+        for count in counts:
+            # Expected 400; the standard deviation is about 18
+            self.assertTrue(300 < count < 500, counts)
+
+    def testInterval(self):
+        sample = InfohashSample(size=20)
+        sample.load(key(i) for i in range(1000))
+        self.assertEqual(sample.interval(), MAX_SAMPLE_INTERVAL)
+
+        # 1000 torrents, created at 1 per second: half of the sample is
+        # replaced in 500 seconds
+        sample.started -= 1000
+        sample.created = 1000
+        sample.loaded = 0
+        self.assertAlmostEqual(sample.interval(), 500, delta=1)
+
+        # 1000 torrents, of which 100 created at 10 per second: 50 seconds
+        sample.started += 990
+        sample.created = 100
+        sample.loaded = 900
+        self.assertEqual(sample.interval(), MIN_SAMPLE_INTERVAL)
+
+    def testStorageSamplesCreatedTorrents(self):
+        storage = MemoryPeerStorage()
+        storage.addPeer(Hash(key(1)), Peer(('192.0.2.1', 6881)))
+        storage.addPeer(Hash(key(1)), Peer(('192.0.2.2', 6881)))
+        storage.addPeer(Hash(key(2)), Peer(('192.0.2.1', 6881)))
+        (samples, num, interval) = storage.sampleInfohashes()
+        self.assertEqual(samples, key(1) + key(2))
+        self.assertEqual(num, 2)
+
+class TestSampleInfohashesCodec(unittest.TestCase):
+    def setUp(self):
+        self.context = NodeContext(Node(Hash(b'\x01' * 20), ('127.0.0.1', 8043)))
+
+    def testEncodeQuery(self):
+        query = KRPCQuery(transactionID=b'aa', fromNode=self.context.thisNode, type=b'sample_infohashes', targetID=Hash(key(7)))
+        self.assertEqual(bencodepy.decode(krpc.krpccoder.encode(query)), {
+            b't': b'aa', b'y': b'q', b'q': b'sample_infohashes',
+            b'a': {b'id': b'\x01' * 20, b'target': key(7)}
+        })
+
+    def testEncodeResponse(self):
+        response = KRPCResponse(transactionID=b'aa', fromNode=self.context.thisNode, type=b'sample_infohashes',
+                                nodes=[], samples=key(1) + key(2), num=2, interval=60)
+        self.assertEqual(krpc.krpccoder.encode(response),
+            b'd1:rd2:id20:' + b'\x01' * 20 + b'8:intervali60e5:nodes0:3:numi2e7:samples40:' + key(1) + key(2) + b'e1:t2:aa1:y1:re')
+
+    def testEncodeResponseWithinBudget(self):
+        response = KRPCResponse(transactionID=b'aa', fromNode=self.context.thisNode, type=b'sample_infohashes',
+                                nodes=[], samples=b''.join(key(i) for i in range(100)), num=100, interval=60)
+        encoded = krpc.krpccoder.encode(response, 1400)
+        self.assertLessEqual(len(encoded), 1400)
+        self.assertTrue(response.truncated)
+        samples = bencodepy.decode(encoded)[b'r'][b'samples']
+        self.assertEqual(len(samples) % 20, 0)
+        self.assertEqual(samples, b''.join(key(i) for i in range(len(samples) // 20)))
+
+    def testDecodeResponse(self):
+        toNode = Node(Hash(b'\x02' * 20), ('192.0.2.1', 6881))
+        query = KRPCQuery(transactionID=b'aa', fromNode=self.context.thisNode, toNode=toNode, type=b'sample_infohashes', targetID=Hash(key(7)))
+        self.context.outstandingQueries[b'aa'] = (query, toNode, 0)
+        data = bencodepy.encode({'t': b'aa', 'y': 'r', 'r': {
+            'id': b'\x02' * 20, 'interval': 300, 'num': 1234, 'nodes': b'', 'samples': key(1) + key(2)
+        }})
+        response = krpc.krpccoder.decode(data, toNode.host, self.context)
+        self.assertEqual((response.interval, response.num), (300, 1234))
+        self.assertEqual(response.samples, [Hash(key(1)), Hash(key(2))])
+
+class TestSampleInfohashesHandler(unittest.TestCase):
+    def setUp(self):
+        self.context = NodeContext(Node(Hash(b'\x01' * 20), ('127.0.0.1', 8043)))
+        self.handler = RecordingHandler(self.context)
+
+    def query(self, method, arguments):
+        self.handler.datagramReceived(bencodepy.encode({'t': b'aa', 'y': 'q', 'q': method, 'a': dict(arguments, id=b'\x02' * 20)}), ('192.0.2.1', 6881))
+        (data, addressPort) = self.handler.sent.pop()
+        return bencodepy.decode(data)
+
+    def testSampleInfohashes(self):
+        self.context.peerStorage.addPeer(Hash(key(1)), Peer(('192.0.2.9', 6881)))
+        response = self.query('sample_infohashes', {'target': key(7)})[b'r']
+        self.assertEqual(response[b'samples'], key(1))
+        self.assertEqual(response[b'num'], 1)
+        self.assertTrue(MIN_SAMPLE_INTERVAL <= response[b'interval'] <= MAX_SAMPLE_INTERVAL)
+        self.assertIn(b'nodes', response)
+
+    def testUnknownMethod(self):
+        reply = self.query('vote', {'target': key(7)})
+        self.assertEqual(reply[b'y'], b'e')
+        self.assertEqual(reply[b'e'][0], 204)
+
+if __name__ == '__main__':
+    unittest.main()
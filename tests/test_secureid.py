@@ -0,0 +1,97 @@
+"""
+@author Thomas Churchman
+
+Tests of secure node IDs (BEP 42).
+
+Run from the repository root: python -m pytest tests
+"""
+
+import unittest
+
+import dht.secureid
+from dht.node import Node
+from hash.hash import Hash
+
+# Test vectors of BEP 42: (IP address, random number, example node ID)
+VECTORS = [
+    ('124.31.75.21', 1, '5fbfbff10c5d6a4ec8a88e4c6ab4c28b95eee401'),
+    ('21.75.31.124', 86, '5a3ce9c14e7a08645677bbd1cfe7d8f956d53256'),
+    ('65.23.51.170', 22, 'a5d43220bc8f112a3d426c84764f8c2a1150e616'),
+    ('84.124.73.14', 65, '1b0321dd1bb1fe518101ceef99462b947a01ff41'),
+    ('43.213.53.83', 90, 'e56f6cbf5b7c4be0237986d5243b87aa6d51305a')
+]
+
+class TestSecureID(unittest.TestCase):
+    def testCRC32C(self):
+        # Check value of CRC-32C
+        self.assertEqual(dht.secureid.crc32c(b'123456789'), 0xe3069283)
+
+    def testVectorsAreSecure(self):
+        for (address, r, id) in VECTORS:
+            self.assertTrue(dht.secureid.isSecureID(Hash(bytes.fromhex(id)), address), address)
+
+    def testVectorsAreNotSecureForOtherAddresses(self):
+        for (i, (address, r, id)) in enumerate(VECTORS):
+            otherAddress = VECTORS[(i + 1) % len(VECTORS)][0]
+            self.assertFalse(dht.secureid.isSecureID(Hash(bytes.fromhex(id)), otherAddress), address)
+
+    def testChangedPrefixIsNotSecure(self):
+        for (address, r, id) in VECTORS:
+            for bit in [0, 8, 20]:
+                changed = bytearray(bytes.fromhex(id))
+                changed[bit // 8] ^= 0x80 >> (bit % 8)
+                self.assertFalse(dht.secureid.isSecureID(Hash(bytes(changed)), address))
+
+    def testGenerateID(self):
+        for (address, r, id) in VECTORS:
+            seed = bytes(19) + bytes([r])
+            generated = bytes(dht.secureid.generateID(address, seed))
+            expected = bytes.fromhex(id)
+            # The first 21 bits are determined by the address and r
+            self.assertEqual(generated[:2], expected[:2], address)
+            self.assertEqual(generated[2] & 0xf8, expected[2] & 0xf8, address)
+            self.assertEqual(generated[19], r)
+            # The other bits come from the seed
+            self.assertEqual(generated[3:19], bytes(16))
+
+    def testGenerateIPv6ID(self):
+        seed = bytes(range(20))
+        id = dht.secureid.generateID('2001:db8::1', seed)
+        self.assertTrue(dht.secureid.isSecureID(id, '2001:db8::1'))
+        # Only the first 64 bits of the address are used
+        self.assertTrue(dht.secureid.isSecureID(id, '2001:db8::2'))
+        self.assertFalse(dht.secureid.isSecureID(id, '2001:db9::1'))
+
+    def testExempt(self):
+        for address in ['10.1.2.3', '172.16.0.1', '172.31.255.255', '192.168.1.1', '169.254.0.1', '127.0.0.1']:
+            self.assertTrue(dht.secureid.isExempt(address), address)
+        for address in ['172.32.0.1', '192.169.0.1', '124.31.75.21', '2001:db8::1']:
+            self.assertFalse(dht.secureid.isExempt(address), address)
+
+class TestIDVerifier(unittest.TestCase):
+    def testVectors(self):
+        verifier = dht.secureid.IDVerifier()
+        for (address, r, id) in VECTORS:
+            self.assertTrue(verifier.isValid(Node(Hash(bytes.fromhex(id)), (address, 6881))))
+            self.assertFalse(verifier.isValid(Node(Hash(bytes(20)), (address, 6881))))
+
+    def testExemptAddressesAreValid(self):
+        verifier = dht.secureid.IDVerifier()
+        self.assertTrue(verifier.isValid(Node(Hash(bytes(20)), ('192.168.1.1', 6881))))
+
+    def testPrefixesAreCached(self):
+        verifier = dht.secureid.IDVerifier(cacheSize=2)
+        (address, r, id) = VECTORS[0]
+        node = Node(Hash(bytes.fromhex(id)), (address, 6881))
+        verifier.isValid(node)
+        verifier.isValid(node)
+        self.assertEqual((verifier.misses, verifier.hits), (1, 1))
+
+        # Evicted once more addresses than the cache holds have been seen
+        for (otherAddress, r, otherID) in VECTORS[1:3]:
+            verifier.isValid(Node(Hash(bytes.fromhex(otherID)), (otherAddress, 6881)))
+        self.assertTrue(verifier.isValid(node))
+        self.assertEqual((verifier.misses, verifier.hits), (4, 1))
+
+if __name__ == '__main__':
+    unittest.main()
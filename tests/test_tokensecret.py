@@ -0,0 +1,175 @@
+"""
+@author Thomas Churchman
+
+Tests of the rotating token secrets.
+
+Run from the repository root: python -m pytest tests
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import utils
+import tokensecret
+from tokensecret import TokenSecrets
+from dht.node import Node
+
+class TestTokenSecrets(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'token_secret')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRotation(self):
+        secrets = TokenSecrets(interval=300)
+        (current, previous) = secrets.secrets()
+        rotatedAt = secrets.rotatedAt()
+
+        # Not due yet
+        secrets.rotate(rotatedAt + 299)
+        self.assertEqual(secrets.secrets(), (current, previous))
+
+        # The current secret becomes the previous secret
+        secrets.rotate(rotatedAt + 300)
+        (newCurrent, newPrevious) = secrets.secrets()
+        self.assertEqual(newPrevious, current)
+        self.assertNotEqual(newCurrent, current)
+        self.assertEqual(secrets.rotatedAt(), rotatedAt + 300)
+
+    def testRotationAfterPause(self):
+        secrets = TokenSecrets(interval=300)
+        (current, previous) = secrets.secrets()
+        secrets.rotate(secrets.rotatedAt() + 600)
+        (newCurrent, newPrevious) = secrets.secrets()
+        self.assertNotIn(newCurrent, (current, previous))
+        self.assertNotIn(newPrevious, (current, previous))
+
+    def testTokens(self):
+        secrets = TokenSecrets(interval=300)
+        node = Node(None, ('192.0.2.1', 6881))
+        token = utils.getToken(node, secrets.current())
+        self.assertTrue(utils.isTokenValid(node, token, secrets))
+        self.assertFalse(utils.isTokenValid(Node(None, ('192.0.2.1', 6882)), token, secrets))
+
+        secrets.rotate(secrets.rotatedAt() + 300)
+        self.assertTrue(utils.isTokenValid(node, token, secrets))
+        secrets.rotate(secrets.rotatedAt() + 300)
+        self.assertFalse(utils.isTokenValid(node, token, secrets))
+
+    def testFirstSecret(self):
+        secrets = TokenSecrets(secret=b'\x01' * 20)
+        self.assertEqual(secrets.current(), b'\x01' * 20)
+
+    def testPersisted(self):
+        secrets = TokenSecrets(self.path)
+        state = secrets.state()
+        secrets.close()
+        self.assertEqual(os.path.getsize(self.path), tokensecret.SIZE)
+
+        secrets = TokenSecrets(self.path)
+        self.assertEqual(secrets.state(), state)
+        secrets.close()
+
+    def testReadOnlySeesRotations(self):
+        writer = TokenSecrets(self.path, interval=300)
+        reader = TokenSecrets(self.path, interval=300, readOnly=True)
+        self.assertEqual(reader.secrets(), writer.secrets())
+
+        writer.rotate(writer.rotatedAt() + 300)
+        self.assertEqual(reader.secrets(), writer.secrets())
+
+        # A read-only store does not rotate
+        (current, previous) = reader.secrets()
+        reader.rotate(reader.rotatedAt() + 300)
+        self.assertEqual(writer.secrets(), (current, previous))
+
+        with self.assertRaises(Exception):
+            reader.restore(0, b'\x00' * 20, b'\x00' * 20)
+        reader.close()
+        writer.close()
+
+    def testReadRetriesWhileWriting(self):
+        writer = TokenSecrets(self.path)
+        reader = TokenSecrets(self.path, readOnly=True)
+        (current, previous) = writer.secrets()
+        (generation,) = tokensecret.GENERATION.unpack_from(writer._map, len(tokensecret.MAGIC))
+
+        # Start a rotation by hand: an odd generation, and half of the state
+        newCurrent = b'\x02' * 20
+        offset = len(tokensecret.MAGIC)
+        tokensecret.GENERATION.pack_into(writer._map, offset, generation + 1)
+        writer._map[offset + 16:offset + 36] = newCurrent
+
+        def finish():
+            time.sleep(0.05)
+            tokensecret.STATE.pack_into(writer._map, offset, generation + 1, time.time(), newCurrent, current)
+            tokensecret.GENERATION.pack_into(writer._map, offset, generation + 2)
+        thread = threading.Thread(target=finish)
+        thread.start()
+
+        # Does not return the torn state
+        self.assertEqual(reader.secrets(), (newCurrent, current))
+        thread.join()
+        reader.close()
+        writer.close()
+
+    def testWriterDiedWhileWriting(self):
+        writer = TokenSecrets(self.path)
+        reader = TokenSecrets(self.path, readOnly=True)
+        secrets = reader.secrets()
+        offset = len(tokensecret.MAGIC)
+        (generation,) = tokensecret.GENERATION.unpack_from(writer._map, offset)
+
+        # The writer dies after marking a rotation as being written
+        tokensecret.GENERATION.pack_into(writer._map, offset, generation + 1)
+        writer.close()
+
+        timeout = tokensecret.READ_TIMEOUT
+        tokensecret.READ_TIMEOUT = 0.05
+        try:
+            # Readers keep the secrets they last read; once they gave up,
+            # they do not wait again
+            self.assertEqual(reader.secrets(), secrets)
+            started = time.monotonic()
+            self.assertEqual(reader.secrets(), secrets)
+            self.assertLess(time.monotonic() - started, 0.05)
+
+            # Readers opening the file take the torn state
+            other = TokenSecrets(self.path, readOnly=True)
+            self.assertEqual(other.secrets(), secrets)
+            other.close()
+        finally:
+            tokensecret.READ_TIMEOUT = timeout
+
+        # A writable store repairs the state
+        writer = TokenSecrets(self.path)
+        (repaired,) = tokensecret.GENERATION.unpack_from(writer._map, offset)
+        self.assertEqual(repaired % 2, 0)
+        self.assertEqual(writer.secrets(), secrets)
+        self.assertEqual(reader.secrets(), secrets)
+        writer.close()
+        reader.close()
+
+    def testRestore(self):
+        secrets = TokenSecrets(self.path)
+        other = TokenSecrets()
+        other.rotate(other.rotatedAt() + 300)
+        secrets.restore(*other.state())
+        self.assertEqual(secrets.state(), other.state())
+        self.assertEqual(secrets.secrets(), other.secrets())
+        secrets.close()
+
+    def testNotATokenSecretFile(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x00' * tokensecret.SIZE)
+        with self.assertRaises(Exception):
+            TokenSecrets(self.path, readOnly=True)
+
+if __name__ == '__main__':
+    unittest.main()
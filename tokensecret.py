@@ -0,0 +1,194 @@
+"""
+@author Thomas Churchman
+
+Module that provides the rotating secrets get_peers tokens are derived from.
+
+A token is derived from the current secret and the address of the node it
+is handed to (see utils.getToken). The secret is replaced every interval
+seconds; tokens derived from the current or the previous secret are valid,
+so a token stays valid for between one and two intervals.
+
+The secrets and the time of the last rotation are kept in a small
+memory-mapped file, so tokens handed out before a restart are still
+accepted after it, and several processes (the workers spawned by a
+supervisor) can share the secrets: one process rotates them, the others map
+the file read-only and see the rotations immediately. Without a path, the
+secrets are kept in anonymous memory and are not persisted.
+
+Layout of the file (SIZE bytes):
+- MAGIC;
+- a generation counter, odd while a rotation is being written, so readers
+  can detect (and retry) a torn read. A generation that stays odd (the
+  writer died while writing) is repaired by the next writable store;
+  readers keep the secrets they last read until then;
+- the time of the last rotation in seconds since the epoch;
+- the current and the previous secret (20 bytes each).
+"""
+
+import os
+import time
+import mmap
+import struct
+
+MAGIC = b'OTDHTTOK'
+
+# Format >Qd20s20s: generation, time of the last rotation, current secret,
+# previous secret (big endian)
+STATE = struct.Struct('>Qd20s20s')
+GENERATION = struct.Struct('>Q')
+
+SIZE = len(MAGIC) + STATE.size
+
+SECRET_SIZE = 20
+
+# Seconds a reader retries a torn read before keeping the secrets it last
+# read, and the interval in seconds between retries
+READ_TIMEOUT = 1.0
+READ_RETRY_INTERVAL = 0.0001
+
+class TokenSecrets:
+    """
+    Class to represent the current and previous token secret, stored in the
+    file at the given path (or in memory if path is None).
+
+    A read-only store only reads the secrets another process rotates. A
+    writable store creates the file if it does not exist yet; rotate (called
+    on the heartbeat) replaces the secrets every interval seconds. secret is
+    the first current secret of a new store (random by default).
+    """
+    def __init__(self, path=None, interval=300, readOnly=False, secret=None):
+        self.path = path
+        self.interval = interval
+        self.readOnly = readOnly
+
+        if path is None:
+            self._map = mmap.mmap(-1, SIZE)
+        elif readOnly:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if os.fstat(fd).st_size < SIZE:
+                    raise Exception('%s is not a token secret file' % path)
+                self._map = mmap.mmap(fd, SIZE, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < SIZE:
+                    os.ftruncate(fd, SIZE)
+                self._map = mmap.mmap(fd, SIZE)
+            finally:
+                os.close(fd)
+
+        if not readOnly and self._map[:len(MAGIC)] != MAGIC:
+            self._map[:len(MAGIC)] = MAGIC
+            self.__write(0, time.time(), secret or os.urandom(SECRET_SIZE), os.urandom(SECRET_SIZE))
+        elif self._map[:len(MAGIC)] != MAGIC:
+            raise Exception('%s is not a token secret file' % path)
+        elif not readOnly:
+            (generation,) = GENERATION.unpack_from(self._map, len(MAGIC))
+            if generation % 2 == 1:
+                # A writer died while writing; the state is packed in one
+                # piece, so rewrite it under an even generation
+                state = STATE.unpack_from(self._map, len(MAGIC))
+                self.__write(generation + 1, *state[1:])
+
+        # Secrets as of the generation last read
+        self._generation = None
+        self._secrets = None
+
+        if not readOnly:
+            self.rotate()
+
+    def secrets(self):
+        """
+        Get the (current, previous) token secrets.
+        """
+        (generation,) = GENERATION.unpack_from(self._map, len(MAGIC))
+        if generation != self._generation:
+            self.__read()
+        return self._secrets
+
+    def current(self):
+        return self.secrets()[0]
+
+    def rotatedAt(self):
+        """
+        Get the time of the last rotation in seconds since the epoch.
+        """
+        return self.__read()[1]
+
+    def state(self):
+        """
+        Get the (time of the last rotation, current secret, previous secret).
+        """
+        return self.__read()[1:]
+
+    def restore(self, rotatedAt, current, previous):
+        """
+        Replace the secrets with those of another store (see handoff.py).
+        """
+        if self.readOnly:
+            raise Exception('Cannot restore the secrets of a read-only store')
+        self.__write(self.__read()[0], rotatedAt, current, previous)
+
+    def rotate(self, now=None):
+        """
+        Replace the secrets if they are due. After a pause (e.g., the node
+        was stopped) of more than two intervals, no token handed out before
+        can be valid, so both secrets are replaced.
+        """
+        if self.readOnly:
+            return
+        if now is None:
+            now = time.time()
+        (generation, rotatedAt, current, previous) = self.__read()
+        if now - rotatedAt >= 2 * self.interval:
+            self.__write(generation, now, os.urandom(SECRET_SIZE), os.urandom(SECRET_SIZE))
+        elif now - rotatedAt >= self.interval:
+            self.__write(generation, now, os.urandom(SECRET_SIZE), current)
+
+    def close(self):
+        self._map.close()
+
+    def __read(self):
+        """
+        Read the state, retrying while a rotation is being written. If the
+        read stays torn for READ_TIMEOUT seconds, the secrets last read are
+        kept until the generation changes.
+        """
+        deadline = None
+        while True:
+            state = STATE.unpack_from(self._map, len(MAGIC))
+            (generation,) = GENERATION.unpack_from(self._map, len(MAGIC))
+            if generation % 2 == 0 and generation == state[0]:
+                break
+            if deadline is None:
+                if generation == self._generation:
+                    return self.__torn(generation, state)
+                deadline = time.monotonic() + READ_TIMEOUT
+            elif time.monotonic() >= deadline:
+                print("warning: the token secrets in %s are torn; keeping the secrets last read" % self.path)
+                return self.__torn(generation, state)
+            time.sleep(READ_RETRY_INTERVAL)
+        self._generation = generation
+        self._secrets = (state[2], state[3])
+        return state
+
+    def __torn(self, generation, state):
+        """
+        Keep the secrets last read (those of the torn state if none were
+        read yet) for the given generation.
+        """
+        self._generation = generation
+        if self._secrets is None:
+            self._secrets = (state[2], state[3])
+        return (generation, state[1]) + self._secrets
+
+    def __write(self, generation, rotatedAt, current, previous):
+        # An odd generation marks the state as being written
+        GENERATION.pack_into(self._map, len(MAGIC), generation + 1)
+        STATE.pack_into(self._map, len(MAGIC), generation + 1, rotatedAt, current, previous)
+        GENERATION.pack_into(self._map, len(MAGIC), generation + 2)
+        if self.path is not None:
+            self._map.flush()
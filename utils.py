@@ -6,11 +6,11 @@ Module to provide some utility functions.
 
 from hashlib import sha1
 import random
-import time
 import ctypes
-import appstate
 import struct
-from socket import inet_aton
+from socket import inet_pton
+from socket import AF_INET
+from socket import AF_INET6
 from hash.hash import Hash
 
 def chunks(str, chunkLength):
@@ -22,24 +22,32 @@ def chunks(str, chunkLength):
         
     return (str[0+i:chunkLength+i] for i in range(0, len(str), chunkLength))
     
+def isIPv6(address):
+    """
+    Check whether the given address string is an IPv6 address.
+    """
+    return ':' in address
+    
+def addressFamily(address):
+    """
+    Get the address family (AF_INET or AF_INET6) of the given address string.
+    """
+    return AF_INET6 if isIPv6(address) else AF_INET
+    
 def randomBits(numBits):
     """
     Generate random bits
     """
     return random.getrandbits(numBits)
     
-def getToken(node, timeDiff=0):
+def getToken(node, tokenSecret):
     """
-    Procedurally generate a token for a node for get_peers and announce_peer.
-    
-    Tokens changes every 5 minutes.
+    Procedurally generate a token for a node for get_peers and announce_peer,
+    from the given token secret (bytes; see tokensecret.py).
     """
-    t = int(time.time() / (60 * 5)) + int(timeDiff)
-    ip = struct.unpack("<L", inet_aton(node.address()))[0]
-    port = node.port()
-    secret = appstate.AppState.tokenSecret
-    
-    return Hash(sha1(str(t + ip + port + secret).encode("utf-8")).digest())
+    address = node.address()
+    packed = inet_pton(addressFamily(address), address) + struct.pack('>H', node.port())
+    return Hash(sha1(tokenSecret + packed).digest())
 
 def signedToUnsigned(i, bits=160):
     """
@@ -47,10 +55,14 @@ def signedToUnsigned(i, bits=160):
     """
     return i % (2**bits)
 
-def isTokenValid(node, token):
+def isTokenValid(node, token, tokenSecrets):
     """
     Validate a given token for a given node.
     
-    Tokens of up to 10 minutes old are accepted.
+    Tokens derived from the current or the previous secret of the given
+    tokensecret.TokenSecrets are accepted; secrets are rotated every 5
+    minutes by default, so tokens of up to 10 minutes old are accepted.
     """
-    return token == getToken(node, 0) or token == getToken(node, -1)
\ No newline at end of file
+    (current, previous) = tokenSecrets.secrets()
+    token = bytes(token)
+    return token == bytes(getToken(node, current)) or token == bytes(getToken(node, previous))
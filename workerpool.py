@@ -0,0 +1,257 @@
+"""
+@author Thomas Churchman
+
+Module that provides a bounded pool of worker threads for blocking work
+(such as disk I/O) that should not run on the event loop thread, and the
+Completion objects its results are delivered through.
+
+Completions do not depend on an event loop, so the pool (and the peer
+storage built on it) can be used from the Twisted reactor and from an
+asyncio event loop alike; in particular, the asyncio loop does not load
+Twisted.
+"""
+
+import sys
+import queue
+import threading
+
+class PoolSaturatedError(Exception):
+    """
+    Raised when work is submitted to a pool whose queue is full.
+    """
+    def __init__(self):
+        Exception.__init__(self, 'Worker pool is saturated')
+
+class Failure:
+    """
+    Class to represent an exception passed to the errbacks of a Completion.
+
+    Provides the parts of Twisted's Failure the errbacks in this project use.
+    """
+    def __init__(self, exception=None):
+        if exception is None:
+            exception = sys.exc_info()[1]
+        self.value = exception
+
+    def check(self, *exceptionTypes):
+        """
+        Get the first of the given exception types the exception is an
+        instance of, or None.
+        """
+        for exceptionType in exceptionTypes:
+            if isinstance(self.value, exceptionType):
+                return exceptionType
+        return None
+
+    def getErrorMessage(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return '<Failure %r>' % self.value
+
+class Completion:
+    """
+    Class to represent the result of work that completes later.
+
+    Like a Twisted Deferred, a Completion holds a chain of (callback,
+    errback) pairs. Once it is completed with callback(result) or
+    errback(failure), the result is passed down the chain: each callback
+    (or errback, if the result is a Failure) gets the result of the
+    previous one, and an exception raised by either turns the result into
+    a Failure. Pairs added after completion run right away.
+    """
+    def __init__(self):
+        self.called = False
+        self.result = None
+
+        # [(callback, callbackArgs, errback, errbackArgs)]
+        self._chain = []
+        self._running = False
+
+    def addCallbacks(self, callback, errback, callbackArgs=(), errbackArgs=()):
+        self._chain.append((callback, callbackArgs, errback, errbackArgs))
+        if self.called:
+            self.__run()
+        return self
+
+    def addCallback(self, callback, *args):
+        return self.addCallbacks(callback, None, args)
+
+    def addErrback(self, errback, *args):
+        return self.addCallbacks(None, errback, (), args)
+
+    def addBoth(self, f, *args):
+        return self.addCallbacks(f, f, args, args)
+
+    def callback(self, result):
+        if self.called:
+            raise Exception('Completion already completed')
+        self.called = True
+        self.result = result
+        self.__run()
+
+    def errback(self, failure=None):
+        if not isinstance(failure, Failure):
+            failure = Failure(failure)
+        self.callback(failure)
+
+    def __run(self):
+        if self._running:
+            # A callback added to the chain; the outer loop runs it
+            return
+        self._running = True
+        try:
+            while self._chain:
+                (callback, callbackArgs, errback, errbackArgs) = self._chain.pop(0)
+                if isinstance(self.result, Failure):
+                    (f, args) = (errback, errbackArgs)
+                else:
+                    (f, args) = (callback, callbackArgs)
+                if f is None:
+                    continue
+                try:
+                    self.result = f(self.result, *args)
+                except Exception:
+                    self.result = Failure()
+        finally:
+            self._running = False
+
+def succeed(result):
+    """
+    Get a Completion completed with the given result.
+    """
+    completion = Completion()
+    completion.callback(result)
+    return completion
+
+def fail(exception):
+    """
+    Get a Completion failed with the given exception.
+    """
+    completion = Completion()
+    completion.errback(exception)
+    return completion
+
+def execute(f, *args):
+    """
+    Call f(*args) and get a Completion with its result (or failure).
+    """
+    try:
+        result = f(*args)
+    except Exception:
+        return fail(Failure())
+    return succeed(result)
+
+def gather(completions):
+    """
+    Get a Completion firing with the list of results of the given
+    completions once all have succeeded, or failing with the first failure.
+    The failures of the given completions are consumed.
+    """
+    gathered = Completion()
+    results = [None] * len(completions)
+    remaining = [len(completions)]
+
+    def done(result, i):
+        if isinstance(result, Failure):
+            if not gathered.called:
+                gathered.errback(result)
+            return None
+        results[i] = result
+        remaining[0] -= 1
+        if remaining[0] == 0 and not gathered.called:
+            gathered.callback(results)
+
+    if not completions:
+        gathered.callback(results)
+    for (i, completion) in enumerate(completions):
+        completion.addBoth(done, i)
+    return gathered
+
+class WorkerPool:
+    """
+    Class to represent a bounded pool of worker threads.
+
+    Work is submitted from the event loop thread and results are delivered
+    back on the event loop thread through the callFromThread function passed
+    to start() (e.g., reactor.callFromThread or loop.call_soon_threadsafe).
+    """
+    def __init__(self, numThreads, maxQueueDepth):
+        self.numThreads = numThreads
+        self.maxQueueDepth = maxQueueDepth
+
+        # Number of submitted jobs that have not completed yet.
+        # Only touched from the event loop thread.
+        self.depth = 0
+
+        self._queue = queue.Queue()
+        self._threads = []
+        self._callFromThread = None
+
+    def start(self, callFromThread):
+        """
+        Start the worker threads.
+        """
+        self._callFromThread = callFromThread
+        for i in range(self.numThreads):
+            thread = threading.Thread(target=self._work, name='WorkerPool-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stop the worker threads after they have finished the queued work.
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def isSaturated(self):
+        """
+        Check whether the queue is full.
+        """
+        return self.depth >= self.maxQueueDepth
+
+    def submit(self, f, *args):
+        """
+        Run f(*args) on a worker thread.
+
+        Returns a Completion firing with the result on the event loop thread.
+        If the queue is full, the Completion fails with PoolSaturatedError.
+        """
+        if self.isSaturated():
+            return fail(PoolSaturatedError())
+
+        d = Completion()
+        self.depth += 1
+        self._queue.put((d, f, args))
+        return d
+
+    def _work(self):
+        """
+        Worker thread main loop.
+        """
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            (d, f, args) = job
+            try:
+                result = f(*args)
+            except Exception:
+                result = Failure()
+            self._callFromThread(self._done, d, result)
+
+    def _done(self, d, result):
+        """
+        Called on the event loop thread when a job has completed.
+        """
+        self.depth -= 1
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)